@@ -0,0 +1,71 @@
+#!/bin/bash
+# Starts or stops the optional azurecc provider daemon in a long-lived container, so that invoke_provider.sh
+# can docker exec into it instead of starting a new container for every HostFactory call.
+#   ./azurecc_daemon.sh start|stop|status
+
+# HF_ variables should come from Symphony environment (defaults provided for debugging)
+export HF_TOP=${HF_TOP:-/opt/ibm/spectrumcomputing/hostfactory}
+export HF_LOGDIR=${HF_LOGDIR:-${HF_TOP}/log}
+export HF_CONFDIR=${HF_CONFDIR:-${HF_TOP}/conf}
+export HF_WORKDIR=${HF_WORKDIR:-${HF_TOP}/work}
+
+export PRO_IMAGE_TAG=${PRO_IMAGE_TAG:-azurecc:latest}
+export PRO_HF_TOP=/opt/ibm/spectrumcomputing/hostfactory
+export PRO_SCRIPTDIR=${PRO_HF_TOP}/1.1/providerplugins/azurecc/scripts
+export PRO_VENV=${PRO_HF_TOP}/1.1/providerplugins/azurecc/venv
+export PRO_HF_LOGDIR=${PRO_HF_TOP}/log
+export PRO_HF_CONFDIR=${PRO_HF_TOP}/conf
+export PRO_HF_WORKDIR=${PRO_HF_TOP}/work
+
+if [ -f "/etc/profile.d/azurecc.sh" ]; then
+	source /etc/profile.d/azurecc.sh
+fi
+
+export AZURECC_DAEMON_CONTAINER=${AZURECC_DAEMON_CONTAINER:-azurecc-daemon}
+
+function is_running {
+	[ "$(docker inspect -f '{{.State.Running}}' ${AZURECC_DAEMON_CONTAINER} 2>/dev/null)" == "true" ]
+}
+
+case "$1" in
+	start)
+		if is_running; then
+			echo "azurecc provider daemon is already running"
+			exit 0
+		fi
+		docker rm -f ${AZURECC_DAEMON_CONTAINER} >/dev/null 2>&1
+		# same directories as the container invoke_provider.sh uses, so the daemon accepts its commands
+		docker run -d --name ${AZURECC_DAEMON_CONTAINER} \
+			   -v ${HF_LOGDIR}:${PRO_HF_LOGDIR} \
+			   -v ${HF_CONFDIR}:${PRO_HF_CONFDIR} \
+			   -v ${HF_WORKDIR}:${PRO_HF_WORKDIR} \
+			   -e PRO_LOG_DIR=${PRO_HF_LOGDIR} \
+			   -e PRO_CONF_DIR=${PRO_HF_CONFDIR}/providers/azurecc \
+			   -e PRO_DATA_DIR=${PRO_HF_WORKDIR} \
+			   -e PYTHONPATH=${PRO_SCRIPTDIR}/src \
+			   --network host \
+			   ${PRO_IMAGE_TAG} \
+			   ${PRO_VENV}/bin/python3 -m provider_daemon >/dev/null || exit 1
+		echo "Started azurecc provider daemon in container ${AZURECC_DAEMON_CONTAINER}"
+		;;
+	stop)
+		if is_running; then
+			docker stop ${AZURECC_DAEMON_CONTAINER} >/dev/null
+			echo "Stopped azurecc provider daemon"
+		fi
+		docker rm -f ${AZURECC_DAEMON_CONTAINER} >/dev/null 2>&1
+		;;
+	status)
+		if is_running; then
+			echo "azurecc provider daemon is running"
+		else
+			echo "azurecc provider daemon is not running"
+			exit 1
+		fi
+		;;
+	*)
+		echo "Usage: $0 start|stop|status"
+		exit 1
+		;;
+esac
+exit 0
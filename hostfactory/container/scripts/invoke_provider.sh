@@ -28,6 +28,14 @@ echo `date` "  Invoking:" >> /tmp/invoke_provider_container.${USER}.log
 exec {BASH_XTRACEFD}>>/tmp/invoke_provider_container.${USER}.log # redirect bash echo / xtrace
 set -x
 
+# Use the provider container started by azurecc_daemon.sh when it is running. docker exec skips creating a
+# container, and the provider's own invoke_provider.sh then sends the command to the daemon socket.
+export AZURECC_DAEMON_CONTAINER=${AZURECC_DAEMON_CONTAINER:-azurecc-daemon}
+if [ "$(docker inspect -f '{{.State.Running}}' ${AZURECC_DAEMON_CONTAINER} 2>/dev/null)" == "true" ]; then
+	exec docker exec ${AZURECC_DAEMON_CONTAINER} \
+		 ${PRO_SCRIPTDIR}/invoke_provider.sh ${PLUGIN_ACTION} -f "${PRO_INPUT_FILE}"
+fi
+
 docker run -v ${HF_LOGDIR}:${PRO_HF_LOGDIR} \
 		   -v ${HF_CONFDIR}:${PRO_HF_CONFDIR} \
 		   -v ${HF_WORKDIR}:${PRO_HF_WORKDIR} \
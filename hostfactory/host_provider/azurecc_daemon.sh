@@ -0,0 +1,55 @@
+#!/bin/bash
+# Starts or stops the optional azurecc provider daemon. Run it as the same user as HostFactory.
+#   ./azurecc_daemon.sh start|stop|status
+export PRO_LOG_DIR=${HF_LOGDIR}
+export PRO_CONF_DIR=${HF_CONFDIR}/providers/azurecc
+export PRO_DATA_DIR=${HF_WORKDIR}
+
+export STDERR_FILE=${HF_LOGDIR}/azurecc_daemon.err
+
+scriptDir=`dirname $0`
+export PYTHONPATH=$PYTHONPATH:$scriptDir/src
+
+venv_path=$HF_TOP/$HF_VERSION/providerplugins/azurecc/venv/bin
+pid_file=$PRO_DATA_DIR/azurecc_provider.pid
+
+function is_running {
+	[ -e $pid_file ] && kill -0 $(cat $pid_file) 2>/dev/null
+}
+
+case "$1" in
+	start)
+		if is_running; then
+			echo "azurecc provider daemon is already running"
+			exit 0
+		fi
+		if [ ! -e $venv_path ]; then
+			echo "ERROR: Could not find venv at $venv_path"
+			exit 1
+		fi
+		. $venv_path/activate
+		nohup $venv_path/python3 -m provider_daemon >/dev/null 2>>$STDERR_FILE &
+		echo $! > $pid_file
+		echo "Started azurecc provider daemon"
+		;;
+	stop)
+		if is_running; then
+			kill $(cat $pid_file)
+			echo "Stopped azurecc provider daemon"
+		fi
+		rm -f $pid_file
+		;;
+	status)
+		if is_running; then
+			echo "azurecc provider daemon is running"
+		else
+			echo "azurecc provider daemon is not running"
+			exit 1
+		fi
+		;;
+	*)
+		echo "Usage: $0 start|stop|status"
+		exit 1
+		;;
+esac
+exit 0
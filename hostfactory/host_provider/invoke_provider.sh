@@ -16,6 +16,15 @@ venv_path=$HF_TOP/$HF_VERSION/providerplugins/azurecc/venv/bin
 if [ -e $venv_path ]; then
 	args=$@
 	. $venv_path/activate
+	# Use the provider daemon (azurecc_daemon.sh) when it is running
+	if [ -S "${AZURECC_DAEMON_SOCKET:-$PRO_DATA_DIR/azurecc_provider.sock}" ]; then
+		$venv_path/python3 -m provider_client $args 2>>$STDERR_FILE
+		rc=$?
+		# 75 means the daemon is not accepting connections, fall back to the one-shot provider
+		if [ $rc -ne 75 ]; then
+			exit $rc
+		fi
+	fi
 	$venv_path/python3 -m cyclecloud_provider $args 2>>$STDERR_FILE
 	exit $?
 else
@@ -2,6 +2,7 @@ from math import ceil, floor
 from enum import Enum
 import logging
 from venv import logger
+import metrics
 
 
 class AllocationStrategies(Enum):
@@ -23,6 +24,10 @@ def normalize_list(percentage_weights):
         raise ValueError("Total of percentage weights is 0 - no slots would be allocated")
     return [x / total for x in percentage_weights]
 
+def _positive_ints(weights):
+    # the shortcuts below are exact for whole slot weights; anything else takes the original loops
+    return all(isinstance(w, int) and w > 0 for w in weights)
+
 def calculate_vm_dist_capacity(vm_types, total_slot_count, logger=None):
     vm_dist = {}
     slots_per_vm_type = total_slot_count // len(vm_types) # balanced distribution
@@ -70,7 +75,15 @@ def calculate_vm_dist_weighted(vm_types, requested_slot_count, percentage_weight
         if remaining_slots <= 0:
             break
 
-    # Fill in any remaining slots
+    # Fill in any remaining slots. Every full pass over the vm types adds each weight once, so skip straight
+    # to the pass that fills the request instead of looping over possibly hundreds of thousands of slots.
+    if remaining_slots > 0 and isinstance(remaining_slots, int) and vm_types and _positive_ints(vm_types.values()):
+        full_passes = (remaining_slots - 1) // sum(vm_types.values())
+        if full_passes:
+            for vm, weight in vm_types.items():
+                vm_dist[vm] += full_passes * weight
+            remaining_slots -= full_passes * sum(vm_types.values())
+
     while remaining_slots > 0:
         for n, p in enumerate(vm_types.items()):
             vm, weight = p
@@ -103,6 +116,19 @@ def calculate_vm_dist_decay(vm_types, total_slot_count, logger=None):
     remaining = total_slot_count
     max_core_count = max(vm_types.values())
     weighted_increment_per_sku = [num_skus / (1 + idx) for idx in range(num_skus)]
+
+    # While at least the largest increment (max_core_count * num_skus) is left after a pass, every sku adds the
+    # same whole number of instances on each pass. Apply all of those passes at once; the loop below then only
+    # runs the last few passes where the increments shrink.
+    if remaining > 0 and isinstance(remaining, int) and _positive_ints(vm_types.values()):
+        full_increments = [round_down_to_nearest_multiple(max_core_count * weighted_increment_per_sku[idx], weight)
+                           for idx, weight in enumerate(vm_types.values())]
+        full_passes = max(0, (remaining - ceil(max_core_count * weighted_increment_per_sku[0])) // sum(full_increments))
+        if full_passes:
+            for sku, increment in zip(vm_types.keys(), full_increments):
+                vm_dist[sku] += full_passes * increment
+            remaining -= full_passes * sum(full_increments)
+
     while remaining > 0:
         for idx, p in enumerate(vm_types.items()):
             sku, symphony_slot_weight = p
@@ -120,6 +146,30 @@ def calculate_vm_dist_decay(vm_types, total_slot_count, logger=None):
     return vm_dist
 
 
+def split_nodes_by_slots(nodes, slot_counts):
+    '''
+    Splits the nodes of one allocation between the requests it was made for, in proportion to the slots each
+    request asked for. Nodes go out largest first, each to the request furthest below its share of the slots
+    that were actually allocated. Returns the nodes by request, in the order of slot_counts.
+    '''
+    def _weight(node):
+        return node.resources.get("weight") or 1
+
+    split = {key: [] for key in slot_counts}
+    requested = sum(slot_counts.values())
+    if not split or requested <= 0:
+        return split
+    allocated = sum(_weight(n) for n in nodes)
+    shares = {key: allocated * count / requested for key, count in slot_counts.items()}
+    assigned = {key: 0 for key in slot_counts}
+    for node in sorted(nodes, key=_weight, reverse=True):
+        # max() keeps the first of equal candidates, so earlier requests win ties
+        key = max(split, key=lambda k: shares[k] - assigned[k])
+        split[key].append(node)
+        assigned[key] += _weight(node)
+    return split
+
+
 
 class AllocationStrategy:
 
@@ -138,7 +188,8 @@ class AllocationStrategy:
         '''Filter out vmTypes that have no available capacity'''
 
         use_spot_placement_score = self.provider_config.get("symphony.autoscaling.use_spot_placement_score", True)
-        buckets = self.node_mgr.get_buckets()
+        with metrics.span("scalelib.get_buckets"):
+            buckets = self.node_mgr.get_buckets()
         filtered_vmTypes = {}
         def _categorize_buckets(candidate_buckets):
             high, medium, low = [], [], []
@@ -189,18 +240,20 @@ class AllocationStrategy:
         self.logger.info("Allocating %s slots for template_id %s using strategy %s", requested_slot_count, 
                          template_id, self.auto_scaling_strategy)
         # Filter out vmTypes that have no available capacity
-        filtered_vm_types = self.filter_available_vmTypes(vm_types)
+        with metrics.span("allocation.filter_vm_types"):
+            filtered_vm_types = self.filter_available_vmTypes(vm_types)
         if len(filtered_vm_types) == 0:
             self.logger.warning("No available VM types found - cannot allocate nodes")
             return []
-        if self.auto_scaling_strategy == AllocationStrategies.CAPACITY:
-            result = self.allocate_slots_capacity(requested_slot_count, template_id, filtered_vm_types)
-        elif self.auto_scaling_strategy == AllocationStrategies.WEIGHTED:
-            result = self.allocate_slots_weighted(requested_slot_count, template_id, filtered_vm_types)
-        elif self.auto_scaling_strategy == AllocationStrategies.DECAY:
-            result = self.allocate_slots_decay(requested_slot_count, template_id, filtered_vm_types)
-        else: # PRICE          
-            result = self.allocate_slots_price(requested_slot_count, template_id, filtered_vm_types)
+        with metrics.span("allocation." + self.auto_scaling_strategy.value):
+            if self.auto_scaling_strategy == AllocationStrategies.CAPACITY:
+                result = self.allocate_slots_capacity(requested_slot_count, template_id, filtered_vm_types)
+            elif self.auto_scaling_strategy == AllocationStrategies.WEIGHTED:
+                result = self.allocate_slots_weighted(requested_slot_count, template_id, filtered_vm_types)
+            elif self.auto_scaling_strategy == AllocationStrategies.DECAY:
+                result = self.allocate_slots_decay(requested_slot_count, template_id, filtered_vm_types)
+            else: # PRICE          
+                result = self.allocate_slots_price(requested_slot_count, template_id, filtered_vm_types)
             
         return result
     
@@ -233,10 +286,11 @@ class AllocationStrategy:
         result = None
         self.logger.debug("Using price based allocation")
         # Let node_mgr choose the vm_types
-        result = self.node_mgr.allocate({"weight": 1, "template_id": template_id, 
-                                        "capacity-failure-backoff": self.capacity_limit_timeout},
-                                        slot_count=requested_slots,
-                                        allow_existing=False)
+        with metrics.span("scalelib.allocate"):
+            result = self.node_mgr.allocate({"weight": 1, "template_id": template_id, 
+                                            "capacity-failure-backoff": self.capacity_limit_timeout},
+                                            slot_count=requested_slots,
+                                            allow_existing=False)
         return result.nodes or []
     
     
@@ -248,10 +302,11 @@ class AllocationStrategy:
             vm_slot_count = vm_dist[vmsize]
             self.logger.debug(f"Allocating {vm_slot_count} slots of {vmsize}")
             if vm_slot_count > 0:
-                check_allocate = self.node_mgr.allocate({"node.vm_size": vmsize, "weight": 1, 
-                                                         "template_id": template_id, 
-                                                         "capacity-failure-backoff": self.capacity_limit_timeout},
-                                                        slot_count=vm_slot_count, allow_existing=False)
+                with metrics.span("scalelib.allocate"):
+                    check_allocate = self.node_mgr.allocate({"node.vm_size": vmsize, "weight": 1, 
+                                                             "template_id": template_id, 
+                                                             "capacity-failure-backoff": self.capacity_limit_timeout},
+                                                            slot_count=vm_slot_count, allow_existing=False)
                 if not check_allocate.nodes:
                     self.logger.debug("0 new nodes allocated for %s", vmsize)
                     break
@@ -263,10 +318,11 @@ class AllocationStrategy:
         # Allocate remaining slots with any available vm size
         if remaining_count > 0:
             self.logger.warning("Allocating remaining: %s slots", remaining_count)
-            check_allocate = self.node_mgr.allocate({"weight": 1, 
-                                                     "template_id": template_id, 
-                                                     "capacity-failure-backoff": self.capacity_limit_timeout},
-                                                    slot_count=remaining_count, allow_existing=False) 
+            with metrics.span("scalelib.allocate"):
+                check_allocate = self.node_mgr.allocate({"weight": 1, 
+                                                         "template_id": template_id, 
+                                                         "capacity-failure-backoff": self.capacity_limit_timeout},
+                                                        slot_count=remaining_count, allow_existing=False) 
             if check_allocate.nodes:
                 allocation_results.extend(check_allocate.nodes)
         return allocation_results
@@ -1,39 +1,115 @@
 import version
+from concurrent.futures import ThreadPoolExecutor
 import json
-import requests
+import os
+import queue
+import random
 from math import ceil, floor
 import time
 import logging
 from util import ConfigError, UserError
+import metrics
 from urllib.parse import urlencode
 from builtins import str
 from allocation_strategy import AllocationStrategy
-from hpc.autoscale.node.nodemanager import new_node_manager
-from hpc.autoscale.util import partition
+from cluster_snapshot import ClusterSnapshot, NodeRecord
 
-try:
-    from requests.packages import urllib3
-    if hasattr(urllib3, "disable_warnings"):
-        urllib3.disable_warnings()
-except ImportError:
-    pass
+# requests and scalelib (hpc.autoscale) are imported where they are first used: together they are most of
+# the provider's start up time, and commands like templates never talk to CycleCloud.
+
+
+# The node fields the provider reads from /clusters/{name}/nodes, see all_nodes().
+NODE_FIELDS = ["Name", "NodeId", "Hostname", "PrivateIp", "Status", "StatusMessage", "TargetState"]
+
+# Throttled or temporarily unavailable. Only statuses that mean the request was refused are safe to retry for a POST.
+RETRY_STATUSES_GET = (429, 500, 502, 503, 504)
+RETRY_STATUSES_POST = (429, 503)
+
+
+class ChunkedBootupResult:
+    '''
+    The combined bootup result of a request that was booted in chunks. A chunk whose bootup raised holds the
+    exception; its nodes may or may not have been created, so the request is not complete.
+    '''
+
+    def __init__(self, sub_request_ids, results):
+        self.sub_request_ids = sub_request_ids
+        self.results = results
+        self.nodes = [node for result in results if not isinstance(result, Exception) and result
+                      for node in (result.nodes or [])]
+        self.complete = not any(isinstance(result, Exception) for result in results)
+        failed = [sub_request_id for sub_request_id, result in zip(sub_request_ids, results)
+                  if isinstance(result, Exception) or not result]
+        self.status = "success" if not failed else ("partial" if self.nodes else "failed")
+        self.message = "Chunks failed: %s" % ", ".join(failed) if failed else ""
+
+    def __bool__(self):
+        return bool(self.nodes)
+
+
+class ShutdownResult:
+    '''
+    Per node id outcome of Cluster.shutdown_nodes. succeeded holds the ids CycleCloud accepted, and ids it does not
+    know, which leave nothing to shut down. failed maps every other id to why it failed, so that only those are retried.
+    '''
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = {}
+
+    @property
+    def message(self):
+        return "; ".join("%s: %s" % (node_id, error) for node_id, error in self.failed.items())
+
+    def __bool__(self):
+        return not self.failed
 
 
 class Cluster:
     
-    def __init__(self, cluster_name, provider_config, logger=None):
+    def __init__(self, cluster_name, provider_config, logger=None, data_dir=None):
         self.cluster_name = cluster_name
         self.provider_config = provider_config
         self.logger = logger or logging.getLogger()
+        self._node_mgr = None
+        self._http_session = None
+        self._http_adapter = None
+        self._http_retry_count = 0
+        # request ids looked up by operation are fetched this many at a time
+        self.status_workers = max(1, int(self.provider_config.get("symphony.hostfactory.status_workers", 1)))
+        data_dir = data_dir or os.getenv('PRO_DATA_DIR', os.getcwd())
+        self.snapshot = ClusterSnapshot(cluster_name, data_dir,
+                                        ttl=self.provider_config.get("cyclecloud.snapshot.ttl", 0),
+                                        logger=self.logger)
+
+    @property
+    def node_mgr(self):
+        # Building the node manager loads every bucket and node from CycleCloud, so only do it
+        # when a command actually needs it.
+        if self._node_mgr is None:
+            self._node_mgr = self._new_node_manager()
+        return self._node_mgr
+
+    def _new_node_manager(self):
         CC_CONFIG = {}
         CC_CONFIG["url"] = self.provider_config.get("cyclecloud.config.web_server")
         CC_CONFIG["username"] = self.provider_config.get("cyclecloud.config.username")
         CC_CONFIG["password"] = self.provider_config.get("cyclecloud.config.password")
         CC_CONFIG["cluster_name"] = self.cluster_name
-        self.node_mgr = new_node_manager(CC_CONFIG)
+        from hpc.autoscale.node.nodemanager import new_node_manager
+        with metrics.span("scalelib.new_node_manager"):
+            return new_node_manager(CC_CONFIG)
+
+    @node_mgr.setter
+    def node_mgr(self, node_mgr):
+        self._node_mgr = node_mgr
+
+    def refresh(self):
+        '''Forget the node manager so that the next use reloads cluster state. The http session is kept.'''
+        self._node_mgr = None
     
     def status(self):
-        status_json = self.get("/clusters/%s/status" % self.cluster_name)
+        status_json = self.snapshot.get_or_fetch("status", lambda: self.get("/clusters/%s/status" % self.cluster_name))
 
         nodearrays = status_json["nodearrays"]
         #log the buckets of nodearray
@@ -45,7 +121,9 @@ class Cluster:
         return status_json
     
     def get_buckets(self):
-        buckets = self.node_mgr.get_buckets()
+        node_mgr = self.node_mgr
+        with metrics.span("scalelib.get_buckets"):
+            buckets = node_mgr.get_buckets()
         self.logger.debug("Buckets: count=%d", len(buckets))
         for b in buckets:
             self.logger.info(f"{b.nodearray}/{b.vm_size} available={b.available_count} based on {b.limits} bucket_id={b.bucket_id}  (last capacity failure {b.last_capacity_failure})")           
@@ -71,7 +149,7 @@ class Cluster:
             self.node_mgr.add_default_resource(selection={}, resource_name="weight", default_value=1)
 
     def add_nodes(self, request_id, template_id, requested_slot_count, use_weighted_templates=False, vm_types={},
-                  capacity_limit_timeout=300, autoscaling_strategy="price", dry_run=False):
+                  capacity_limit_timeout=300, autoscaling_strategy="price", dry_run=False, record_chunks=None):
 
         # Add custom resources for nodes in scalelib (each pass may be a new process, so do this each time)
         self.configure_node_resources_scalelib(use_weighted_templates, vm_types)
@@ -80,6 +158,7 @@ class Cluster:
                                                  capacity_limit_timeout=capacity_limit_timeout, logger=self.logger)
         allocation_results = allocation_strategy.allocate_slots(requested_slot_count, template_id, vm_types)
 
+        from hpc.autoscale.util import partition
         by_vm_size = partition(self.node_mgr.new_nodes, lambda node: node.vm_size)
         for key,value in by_vm_size.items():
             self.logger.info("Requesting %s nodes of %s", len(value), key)
@@ -88,15 +167,89 @@ class Cluster:
             self.logger.info("Dry run: Would have booted %s nodes", len(self.node_mgr.new_nodes))
             return True
         if allocation_results:
+            chunk_size = int(self.provider_config.get("cyclecloud.bootup.chunk_size", 0))
+            if chunk_size > 0 and len(self.node_mgr.new_nodes) > chunk_size:
+                return self._bootup_chunks(request_id, by_vm_size, chunk_size, record_chunks)
             request_id_start = f"{request_id}-start"
             request_id_create = f"{request_id}-create"
-            result = self.node_mgr.bootup(request_id_start=request_id_start, request_id_create=request_id_create)
+            node_mgr = self.node_mgr
+            try:
+                with metrics.span("scalelib.bootup"):
+                    result = node_mgr.bootup(request_id_start=request_id_start, request_id_create=request_id_create)
+            finally:
+                self.snapshot.invalidate()
             return result
         return False
 
 
+    def _bootup_chunks(self, request_id, by_vm_size, chunk_size, record_chunks=None):
+        '''
+        Boots the new nodes in chunks of at most chunk_size nodes of one vm size, a few chunks at a time, so
+        that a very large request is not one create call that can time out as a whole. Chunk n is created
+        under the sub request id <request_id>-c<n>. record_chunks is called with the sub request ids before
+        anything is booted, so that the nodes of the request can be found even if this process dies.
+        '''
+        chunks = []
+        for nodes in by_vm_size.values():
+            for i in range(0, len(nodes), chunk_size):
+                chunks.append(nodes[i:i + chunk_size])
+        sub_request_ids = ["%s-c%d" % (request_id, n) for n in range(len(chunks))]
+        if record_chunks:
+            record_chunks(sub_request_ids)
+
+        def _bootup(node_mgr, chunk):
+            sub_request_id, nodes = chunk
+            try:
+                with metrics.span("scalelib.bootup"):
+                    return node_mgr.bootup(nodes=nodes, request_id_start=f"{sub_request_id}-start",
+                                           request_id_create=f"{sub_request_id}-create")
+            except Exception as e:
+                # the other chunks are still booted, a failed chunk only leaves the request incomplete
+                self.logger.exception("Could not boot %d nodes of %s", len(nodes), sub_request_id)
+                return e
+
+        workers = max(1, min(int(self.provider_config.get("cyclecloud.bootup.max_workers", 4)), len(chunks)))
+        self.logger.info("Booting %d nodes for %s in %d chunks, %d at a time", sum(len(c) for c in chunks), request_id,
+                         len(chunks), workers)
+        try:
+            results = self._map_node_mgrs(_bootup, list(zip(sub_request_ids, chunks)), workers)
+        finally:
+            self.snapshot.invalidate()
+        return ChunkedBootupResult(sub_request_ids, results)
+
+    def _map_node_mgrs(self, fn, items, workers):
+        '''
+        Returns [fn(node_mgr, item) for item in items], run on up to workers threads. scalelib's NodeManager and
+        its cluster bindings are not thread safe, so no two threads use the same one at the same time: self.node_mgr
+        is used by one thread, and every other thread that is needed loads a NodeManager of its own.
+        '''
+        if workers <= 1:
+            node_mgr = self.node_mgr
+            return [fn(node_mgr, item) for item in items]
+
+        # at most workers calls run at once, so at most workers - 1 node managers are built
+        idle = queue.SimpleQueue()
+        idle.put(self.node_mgr)
+
+        def _run(item):
+            try:
+                node_mgr = idle.get_nowait()
+            except queue.Empty:
+                node_mgr = self._new_node_manager()
+            try:
+                return fn(node_mgr, item)
+            finally:
+                idle.put(node_mgr)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_run, items))
+
     def all_nodes(self):
-        all_nodes_json = self.get(f"/clusters/{self.cluster_name}/nodes")
+        if self.provider_config.get("cyclecloud.nodes.streaming", False):
+            # the slim nodes are cached separately, a process without streaming expects full nodes
+            all_nodes_json = self.snapshot.get_or_fetch("all_nodes_slim", self._stream_nodes)
+        else:
+            all_nodes_json = self.snapshot.get_or_fetch("all_nodes", lambda: self.get(f"/clusters/{self.cluster_name}/nodes"))
         count_status = {}
         nodes = all_nodes_json['nodes']
         for node in nodes:
@@ -110,35 +263,121 @@ class Cluster:
         # count by status
         return all_nodes_json
  
-    def nodes(self, request_ids):
-        responses = {}
+    def _stream_nodes(self):
+        '''
+        The node listing, parsed one node at a time as it is downloaded and cut down to NODE_FIELDS and the
+        autoscaling flag, so that neither the response body nor the full nodes are ever held in memory.
+        '''
+        import json_stream
+
+        url = f"/clusters/{self.cluster_name}/nodes"
+        self.logger.debug("GET %s (streaming)", self._get_or_raise("cyclecloud.config.web_server") + url)
+        with metrics.span("cluster.get"):
+            response = self._request("GET", url, stream=True)
+            try:
+                if response.status_code < 200 or response.status_code > 299:
+                    raise ValueError(response.content.decode())
+                nodes = [_slim_node(node) for node in json_stream.iter_array(response.iter_content(65536), "nodes")]
+            finally:
+                response.close()
+        return {"nodes": nodes}
+
+    def nodes(self, request_ids, chunk_ids_by_request_id=None):
+        responses = self.nodes_by_request_ids(request_ids, chunk_ids_by_request_id=chunk_ids_by_request_id)
         for request_id in request_ids:
-            def _get_nodes_by_request_id(req_id, action):
-                try:
-                    affected_nodes = self.node_mgr.get_nodes_by_request_id(req_id)
-                    self.logger.debug("Nodes %s %s", action, affected_nodes)
-                    return affected_nodes
-                except Exception as e:
-                    if "No operation found for request id" in str(e):
-                        self.logger.debug("No new nodes have been %s", action)
-                        return None 
-                    raise
-                    
-            # : Optional[str]
-            request_id_start = f"{request_id}-start"
-            request_id_create = f"{request_id}-create"
-            nodes_started = _get_nodes_by_request_id(request_id_start, "started")
-            nodes_created = _get_nodes_by_request_id(request_id_create, "created")
-            if nodes_created is None and nodes_started is None:
+            if responses[request_id] is None:
                 raise RuntimeError(f"Could not find request id {request_id}")
+        return responses
 
-            responses[request_id] = []
-            if nodes_started: 
-                responses[request_id].extend(nodes_started)
-            if nodes_created: 
-                responses[request_id].extend(nodes_created)
-            self.logger.debug(responses)
+    def nodes_by_request_ids(self, request_ids, node_ids_by_request_id=None, chunk_ids_by_request_id=None):
+        '''
+        Returns {request_id: [nodes]} for every request id, with None when CycleCloud has no operation for
+        either the -start or -create half of the request (i.e. "Could not find request id").
+
+        Request ids whose node ids are already known (recorded when the nodes were booted) are resolved from
+        the node manager's single listing of the cluster's nodes. Only the rest fall back to looking up the
+        -start and -create operations, which is two round trips per request id, or per chunk for requests that
+        were booted in chunks (see _bootup_chunks).
+        '''
+        node_ids_by_request_id = node_ids_by_request_id or {}
+        chunk_ids_by_request_id = chunk_ids_by_request_id or {}
+        responses = {}
+        from_listing = []
+        from_operations = []
+        for request_id in request_ids:
+            cached = self.snapshot.get(f"nodes:{request_id}")
+            if cached is not None:
+                responses[request_id] = [NodeRecord.from_dict(x) for x in cached]
+            elif node_ids_by_request_id.get(request_id):
+                from_listing.append(request_id)
+            else:
+                from_operations.append(request_id)
+
+        if from_listing:
+            fetched_at = self.snapshot.clock()
+            nodes_by_id = self._node_index()
+            for request_id in from_listing:
+                responses[request_id] = [nodes_by_id[node_id] for node_id in node_ids_by_request_id[request_id] if node_id in nodes_by_id]
+                self._put_nodes_snapshot(request_id, responses[request_id], fetched_at)
+
+        if from_operations:
+            fetched_at = self.snapshot.clock()
+            lookups = [sub_request_id for request_id in from_operations
+                       for sub_request_id in chunk_ids_by_request_id.get(request_id) or [request_id]]
+            workers = min(self.status_workers, len(lookups))
+            results = self._map_node_mgrs(lambda node_mgr, sub_request_id: self._nodes_by_operations(sub_request_id, node_mgr),
+                                          lookups, workers)
+            found = dict(zip(lookups, results))
+            for request_id in from_operations:
+                parts = [found[sub_request_id] for sub_request_id in chunk_ids_by_request_id.get(request_id) or [request_id]]
+                if all(part is None for part in parts):
+                    responses[request_id] = None
+                    continue
+                responses[request_id] = [node for part in parts if part for node in part]
+                self._put_nodes_snapshot(request_id, responses[request_id], fetched_at)
+
+        self.logger.debug(responses)
         return responses
+
+    def _node_index(self):
+        node_mgr = self.node_mgr
+        with metrics.span("scalelib.get_nodes"):
+            nodes = node_mgr.get_nodes()
+        return {node.delayed_node_id.node_id: node for node in nodes}
+
+    def _put_nodes_snapshot(self, request_id, nodes, fetched_at):
+        if self.snapshot.enabled:
+            self.snapshot.put(f"nodes:{request_id}", [NodeRecord.from_node(x).to_dict() for x in nodes], fetched_at)
+
+    def _nodes_by_operations(self, request_id, node_mgr=None):
+        node_mgr = node_mgr or self.node_mgr
+
+        def _get_nodes_by_request_id(req_id, action):
+            try:
+                with metrics.span("scalelib.get_nodes_by_request_id"):
+                    affected_nodes = node_mgr.get_nodes_by_request_id(req_id)
+                self.logger.debug("Nodes %s %s", action, affected_nodes)
+                return affected_nodes
+            except Exception as e:
+                if "No operation found for request id" in str(e):
+                    self.logger.debug("No new nodes have been %s", action)
+                    return None 
+                raise
+
+        # : Optional[str]
+        request_id_start = f"{request_id}-start"
+        request_id_create = f"{request_id}-create"
+        nodes_started = _get_nodes_by_request_id(request_id_start, "started")
+        nodes_created = _get_nodes_by_request_id(request_id_create, "created")
+        if nodes_created is None and nodes_started is None:
+            return None
+
+        ret = []
+        if nodes_started: 
+            ret.extend(nodes_started)
+        if nodes_created: 
+            ret.extend(nodes_created)
+        return ret
     
     def nodes_by_operation_id(self, operation_id):
         if not operation_id:
@@ -149,13 +388,62 @@ class Cluster:
         return node.delayed_node_id.node_id
 
     def shutdown_nodes(self, machines):
-        machine_ids = [machine["machineId"] for machine in machines]
-        nodes_to_shutdown = [x for x in self.node_mgr.get_nodes() if x.delayed_node_id.node_id in machine_ids]
-        self.node_mgr.shutdown_nodes(nodes_to_shutdown)
+        '''
+        Shuts down the machines by node id, without loading the cluster's nodes, and returns a ShutdownResult.
+        '''
+        return self.shutdown_node_ids([machine["machineId"] for machine in machines])
+
+    def shutdown_node_ids(self, node_ids):
+        # ids go out cyclecloud.shutdown.batch_size at a time; a failed batch only fails its own ids
+        node_ids = list(dict.fromkeys(node_ids))
+        batch_size = max(1, int(self.provider_config.get("cyclecloud.shutdown.batch_size", 500)))
+        result = ShutdownResult()
+        try:
+            for start in range(0, len(node_ids), batch_size):
+                batch = node_ids[start:start + batch_size]
+                try:
+                    with metrics.span("cluster.shutdown_nodes"):
+                        response_raw = self.post(f"/clusters/{self.cluster_name}/nodes/shutdown", json={"ids": batch})
+                except Exception as e:
+                    self.logger.exception("Could not shut down %d nodes", len(batch))
+                    for node_id in batch:
+                        result.failed[node_id] = str(e) or type(e).__name__
+                    continue
+                errors = self._shutdown_errors(response_raw)
+                for node_id in batch:
+                    if node_id in errors:
+                        result.failed[node_id] = errors[node_id]
+                    else:
+                        result.succeeded.append(node_id)
+        finally:
+            self.snapshot.invalidate()
+        if result.failed:
+            self.logger.warning("Could not shut down %d of %d nodes: %s", len(result.failed), len(node_ids), result.message)
+        return result
+
+    def _shutdown_errors(self, response_raw):
+        try:
+            nodes = (json.loads(response_raw) or {}).get("nodes") or [] if response_raw else []
+        except (ValueError, AttributeError):
+            # the request was accepted, we just cannot tell per node
+            self.logger.warning("Could not parse shutdown response '%s'", response_raw)
+            return {}
+        errors = {}
+        for node in nodes:
+            if node.get("status") != "Error":
+                continue
+            error = node.get("error") or "Error"
+            if "not found" in error.lower():
+                continue
+            errors[node.get("id")] = error
+        return errors
         
     def terminate(self, machines):
         machine_ids = [machine["machineId"] for machine in machines]
-        response_raw = self.post(f"/clusters/{self.cluster_name}/nodes/terminate", json={"ids": machine_ids})
+        try:
+            response_raw = self.post(f"/clusters/{self.cluster_name}/nodes/terminate", json={"ids": machine_ids})
+        finally:
+            self.snapshot.invalidate()
         try:
             self.logger.info("Terminate Response: %s", response_raw)
             return json.loads(response_raw)
@@ -163,23 +451,82 @@ class Cluster:
             raise RuntimeError(f"Could not parse response as json to terminate! '{response_raw}'") from exc
             
     def _session(self):
-        config = {"verify_certificates": False,
-                  "username": self._get_or_raise("cyclecloud.config.username"),
-                  "password": self._get_or_raise("cyclecloud.config.password"),
-        }
-        retries = 3
-        while retries > 0:
+        # One pooled, keep-alive session per Cluster so that REST calls reuse TCP/TLS connections.
+        if self._http_session is None:
+            import requests
+            try:
+                from requests.packages import urllib3
+                if hasattr(urllib3, "disable_warnings"):
+                    urllib3.disable_warnings()
+            except ImportError:
+                pass
+
+            session = requests.session()
+            session.auth = (self._get_or_raise("cyclecloud.config.username"),
+                            self._get_or_raise("cyclecloud.config.password"))
+            session.verify = False  # Should we auto-accept unrecognized certs?
+            session.headers = {"X-Cycle-Client-Version": f"cyclecloud-symphony:{version.get_version()}"}
+            pool_size = int(self.provider_config.get("cyclecloud.http.pool_size", 10))
+            # retries are handled in _request so that we can back off with jitter and honor Retry-After
+            self._http_adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+            session.mount("https://", self._http_adapter)
+            session.mount("http://", self._http_adapter)
+            self._http_session = session
+        return self._http_session
+
+    def connection_stats(self):
+        stats = {"requests": 0, "new_connections": 0, "reused_connections": 0, "retries": self._http_retry_count}
+        if self._http_adapter is None:
+            return stats
+        pool = self._http_adapter.poolmanager.connection_from_url(self._get_or_raise("cyclecloud.config.web_server"))
+        stats["requests"] = pool.num_requests
+        stats["new_connections"] = pool.num_connections
+        stats["reused_connections"] = max(0, pool.num_requests - pool.num_connections)
+        return stats
+
+    def _backoff(self, attempt, response=None):
+        base = float(self.provider_config.get("cyclecloud.http.backoff", 1.0))
+        max_backoff = float(self.provider_config.get("cyclecloud.http.backoff_max", 30))
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(max_backoff, float(retry_after))
+            except ValueError:
+                pass
+        # exponential backoff with full jitter
+        return random.uniform(0, min(max_backoff, base * (2 ** attempt)))
+
+    def _request(self, method, url, **kwargs):
+        root_url = self._get_or_raise("cyclecloud.config.web_server")
+        timeout = (float(self.provider_config.get("cyclecloud.http.connect_timeout", 10)),
+                   float(self.provider_config.get("cyclecloud.http.read_timeout", 60)))
+        max_retries = int(self.provider_config.get("cyclecloud.http.retries", 3))
+        # a POST that failed with anything else may have been applied, so only retry it when it was refused.
+        retry_statuses = RETRY_STATUSES_GET if method == "GET" else RETRY_STATUSES_POST
+        session = self._session()
+        import requests
+
+        attempt = 0
+        while True:
             try:
-                s = requests.session()
-                s.auth = (config["username"], config["password"])
-                s.timeout = 60
-                s.verify = config["verify_certificates"]  # Should we auto-accept unrecognized certs?
-                s.headers = {"X-Cycle-Client-Version": f"cyclecloud-symphony:{version.get_version()}"}
-                return s
-            except requests.exceptions.SSLError:
-                retries = retries - 1
-                if retries < 1:
+                response = session.request(method, root_url + url, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # a read timeout means the server may have acted on the request
+                retryable = method == "GET" or not isinstance(e, requests.exceptions.ReadTimeout)
+                if not retryable or attempt >= max_retries:
                     raise
+                delay = self._backoff(attempt)
+                self.logger.warning("%s %s failed (%s), retrying in %.1fs", method, url, e, delay)
+            else:
+                if response.status_code not in retry_statuses or attempt >= max_retries:
+                    return response
+                delay = self._backoff(attempt, response)
+                self.logger.warning("%s %s returned %s, retrying in %.1fs", method, url, response.status_code, delay)
+                # hands the connection back to the pool, which a streamed response only does once closed
+                response.close()
+            attempt += 1
+            self._http_retry_count += 1
+            time.sleep(delay)
     
     def _get_or_raise(self, key):
         value = self.provider_config.get(key)
@@ -191,8 +538,8 @@ class Cluster:
     def post(self, url, data=None, json=None, **kwargs):
         root_url = self._get_or_raise("cyclecloud.config.web_server")
         self.logger.debug("POST %s with data %s json %s kwargs %s", root_url + url, data, json, kwargs)
-        session = self._session()
-        response = session.post(root_url + url, data, json, **kwargs)
+        with metrics.span("cluster.post"):
+            response = self._request("POST", url, data=data, json=json, **kwargs)
         response_content = response.content
         if response_content is not None and isinstance(response_content, bytes):
             response_content = response_content.decode()
@@ -203,8 +550,8 @@ class Cluster:
     def get(self, url, **params):
         root_url = self._get_or_raise("cyclecloud.config.web_server")
         self.logger.debug("GET %s with params %s", root_url + url, params)
-        session = self._session()
-        response = session.get(root_url + url, params=params)
+        with metrics.span("cluster.get"):
+            response = self._request("GET", url, params=params)
         response_content = response.content
         if response_content is not None and isinstance(response_content, bytes):
             response_content = response_content.decode()
@@ -212,3 +559,10 @@ class Cluster:
         if response.status_code < 200 or response.status_code > 299:
             raise ValueError(response_content)
         return json.loads(response_content)
+
+
+def _slim_node(node):
+    ret = {k: node[k] for k in NODE_FIELDS if k in node}
+    enabled = ((node.get("Configuration") or {}).get("autoscaling") or {}).get("enabled", False)
+    ret["Configuration"] = {"autoscaling": {"enabled": enabled}}
+    return ret
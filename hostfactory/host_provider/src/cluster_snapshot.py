@@ -0,0 +1,150 @@
+'''
+On disk snapshot of CycleCloud cluster state that is shared between provider invocations.
+
+HostFactory polls status and return requests many times a minute, each from a new process. With a ttl
+configured (cyclecloud.snapshot.ttl, in seconds) Cluster answers status(), all_nodes() and nodes() from
+this snapshot when a fresh enough copy exists. Any call that changes the cluster (bootup, shutdown,
+terminate) invalidates the snapshot for every process by touching the .invalidated marker file; entries
+that were fetched before the last invalidation are ignored.
+'''
+from collections import namedtuple
+import json
+import logging
+import os
+import re
+import time
+
+
+DelayedNodeId = namedtuple("DelayedNodeId", ["node_id"])
+
+
+class NodeRecord:
+    '''
+    The attributes of a scalelib Node that the provider reads when reporting status, in a form that can
+    be stored in the snapshot.
+    '''
+
+    FIELDS = ["node_id", "name", "state", "target_state", "hostname", "private_ip", "instance_id"]
+
+    def __init__(self, node_id, name, state=None, target_state=None, hostname=None, private_ip=None, instance_id=None):
+        self.delayed_node_id = DelayedNodeId(node_id)
+        self.name = name
+        self.state = state
+        self.target_state = target_state
+        self.hostname = hostname
+        self.private_ip = private_ip
+        self.instance_id = instance_id
+
+    @classmethod
+    def from_node(cls, node):
+        return cls(node.delayed_node_id.node_id, node.name, node.state, node.target_state,
+                   node.hostname, node.private_ip, node.instance_id)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**{k: d.get(k) for k in cls.FIELDS})
+
+    def to_dict(self):
+        ret = {k: getattr(self, k) for k in self.FIELDS if k != "node_id"}
+        ret["node_id"] = self.delayed_node_id.node_id
+        return ret
+
+    def __repr__(self):
+        return "NodeRecord(%s)" % self.to_dict()
+
+
+class ClusterSnapshot:
+
+    def __init__(self, cluster_name, directory, ttl=0, clock=time.time, logger=None):
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", cluster_name or "cluster")
+        self.path = os.path.join(directory, "%s_snapshot.json" % safe_name)
+        self.invalidated_path = self.path + ".invalidated"
+        self.ttl = float(ttl or 0)
+        self.clock = clock
+        self.logger = logger or logging.getLogger()
+        self._entries = None
+        self._entries_mtime = None
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def _invalidated_at(self):
+        try:
+            return os.path.getmtime(self.invalidated_path)
+        except OSError:
+            return 0
+
+    def _load(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            self._entries, self._entries_mtime = {}, None
+            return self._entries
+
+        if self._entries is None or mtime != self._entries_mtime:
+            try:
+                with open(self.path) as fr:
+                    self._entries = json.load(fr)
+            except (IOError, ValueError):
+                self.logger.warning("Ignoring unreadable cluster snapshot %s", self.path)
+                self._entries = {}
+            self._entries_mtime = mtime
+        return self._entries
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+
+        entry = self._load().get(key)
+        if not entry:
+            return None
+
+        fetched_at = entry["fetched_at"]
+        if self.clock() - fetched_at > self.ttl:
+            return None
+        if fetched_at <= self._invalidated_at():
+            return None
+        self.logger.debug("Using cluster snapshot for %s (age %.1fs)", key, self.clock() - fetched_at)
+        return entry["value"]
+
+    def put(self, key, value, fetched_at):
+        if not self.enabled:
+            return
+
+        now = self.clock()
+        invalidated_at = self._invalidated_at()
+        entries = {k: v for k, v in self._load().items()
+                   if now - v["fetched_at"] <= self.ttl and v["fetched_at"] > invalidated_at}
+        entries[key] = {"fetched_at": fetched_at, "value": value}
+
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as fw:
+                json.dump(entries, fw)
+            os.replace(tmp_path, self.path)
+        except IOError:
+            self.logger.exception("Could not write cluster snapshot %s", self.path)
+            return
+        self._entries = entries
+        self._entries_mtime = None
+
+    def get_or_fetch(self, key, fetch):
+        value = self.get(key)
+        if value is not None:
+            return value
+        fetched_at = self.clock()
+        value = fetch()
+        self.put(key, value, fetched_at)
+        return value
+
+    def invalidate(self):
+        if not self.enabled:
+            return
+        try:
+            with open(self.invalidated_path, "a"):
+                pass
+            os.utime(self.invalidated_path)
+        except IOError:
+            self.logger.exception("Could not invalidate cluster snapshot %s", self.path)
+        self._entries = None
@@ -1,21 +1,24 @@
 import time
 import calendar
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-import difflib
 import json
 import os
-import pprint
 import sys
 import uuid
 from builtins import str
-import weighted_template_parse
 
 
 from symphony import RequestStates, MachineStates, MachineResults
-import cluster
+from allocation_strategy import split_nodes_by_slots
+import metrics
+import profiler
+import return_digest
+import template_index
+import termination_queue
 from request_tracking_db import RequestTrackingDb
-from util import JsonStore, failureresponse
+from util import failureresponse
 import util
 from util import UserError
 import symphony
@@ -24,6 +27,12 @@ import version
 
 logger = None
 
+# detached processes started by another command, which already runs the periodic cleanup
+BACKGROUND_COMMANDS = ["create_machines_worker", "drain_terminations"]
+
+# a coalesced request that got none of the nodes, because the allocation was smaller than the requests asked for
+EMPTY_SHARE_MESSAGE = "No nodes were created for this request, they went to the requests coalesced with %s"
+
 PLACEHOLDER_TEMPLATE = {"templateId": "exceptionPlaceholder", 
                         "maxNumber": 1,
                         "attributes": {
@@ -63,15 +72,41 @@ class CycleCloudProvider:
         self.symphony_ncpus = int(self.config.get("symphony.autoscaling.ncpus", 1))
         self.symphony_ncores = int(self.config.get("symphony.autoscaling.ncores", 1))
         self.symphony_nram = int(self.config.get("symphony.autoscaling.nram", 4096))
+        self.allocation_lock_timeout = float(self.config.get("symphony.hostfactory.allocation_lock_timeout", 300))
+        self.status_workers = max(1, int(self.config.get("symphony.hostfactory.status_workers", 1)))
+        self.async_create = bool(self.config.get("symphony.hostfactory.async_create.enabled", False))
+        self.async_create_timeout = float(self.config.get("symphony.hostfactory.async_create.timeout", 900))
+        self.async_create_claim_timeout = float(self.config.get("symphony.hostfactory.async_create.claim_timeout", 60))
+        self.coalesce_window = float(self.config.get("symphony.hostfactory.coalesce_window", 0))
+        self.termination_drain = self.config.get("symphony.hostfactory.termination_queue.drain", "inline")
         self.fine = False
         self.request_tracker = RequestTrackingDb(self.config, self.cluster.cluster_name, self.clock)
-        self.weighted_template = weighted_template_parse.WeightedTemplates(logger)
+        # set to keep a compiled template index on disk between invocations, see template_index.py
+        self.template_cache_dir = None
+        # set to remember per node state between get_return_requests calls, see return_digest.py
+        self.return_digest = None
+        # set to shut machines down through one durable, deduplicated queue, see termination_queue.py
+        self.termination_queue = None
+        # set while this process is the background drainer, which must never start another one
+        self.in_drainer = False
         self.dry_run = False
 
         logger.info("Using %s based autoscaling strategy", self.autoscaling_strategy)
         
+    def _template_index(self, conf_path=None):
+        return template_index.load(conf_path or template_index.templates_path(), self.template_cache_dir, logger)
+
     def _escape_id(self, name):
         return name.lower().replace("_", "")
+
+    def _prefetch_hostnames(self, node_ids_by_ip):
+        # resolve in parallel up front, so that the hostname() calls for each node are cache hits.
+        if not hasattr(self.hostnamer, "resolve_many"):
+            return
+        try:
+            self.hostnamer.resolve_many([ip for ip in node_ids_by_ip if ip], node_ids_by_ip)
+        except Exception:
+            logger.exception("Could not resolve hostnames for %d ips", len(node_ids_by_ip))
     
      
     # If we return an empty list or templates with 0 hosts, it removes us forever and ever more, so _always_
@@ -79,12 +114,9 @@ class CycleCloudProvider:
     # BUGFIX: exiting non-zero code will make symphony retry.
     def templates(self): 
         try:
-            pro_conf_dir = os.getenv('PRO_CONF_DIR', os.getcwd())
-            conf_path = os.path.join(pro_conf_dir, "conf", "azureccprov_templates.json")
-            with open(conf_path, 'r') as json_file:
-                templates_json = json.load(json_file)
-            templates_json["message"] = "Get available templates success."   
-            return self.stdout_handler.handle(templates_json, debug_output=False)
+            conf_path = template_index.templates_path()
+            index = self._template_index(conf_path)
+            return self.stdout_handler.handle(index.response, debug_output=False, serialized=index.serialized_response)
         except:
             logger.warning("Exiting Non-zero so that symphony will retry")
             logger.exception(f"Could not get azureccprov_templates.json at {conf_path}")
@@ -135,6 +167,8 @@ class CycleCloudProvider:
         """ 
         request_id = str(uuid.uuid4())
         logger.info("Creating requestId %s", request_id)
+        async_create = self.async_create and not self.dry_run
+        coalesce = self.coalesce_window > 0 and not self.dry_run
         if not self.dry_run:
             try:
                 # save the request so we can time it out
@@ -143,58 +177,271 @@ class CycleCloudProvider:
                                                 "completedNodes": [],
                                                 "allNodes": None,
                                                 "completed": False}
+                    if async_create or coalesce:
+                        # the intent, for the worker, or the request, that allocates and boots the nodes
+                        requests_store[request_id]["pending"] = {"template": input_json["template"]}
             except:
                 logger.exception("Could not open creation_json")
                 sys.exit(1)    
+
+        if async_create:
+            try:
+                self.launch_create_worker(request_id)
+                return self.stdout_handler.handle({"requestId": request_id, "status": RequestStates.running,
+                                                   "message": "Request instances accepted by Azure CycleCloud."})
+            except Exception:
+                logger.exception("Could not start a create worker for %s, creating the nodes now", request_id)
+                return self.stdout_handler.handle(self._create_pending(request_id))
+
+        if coalesce:
+            return self.stdout_handler.handle(self._create_pending(request_id))
+
+        return self.stdout_handler.handle(self._create_nodes(request_id, input_json))
+
+    def _create_nodes(self, request_id, input_json, coalesced=None):
+        '''
+        Allocates and boots the nodes of a create request that is already in the creation store and returns
+        the response for Symphony.
+
+        coalesced maps the ids of the requests for the same template that are created along with this one, itself
+        included, to their machine counts. They get one allocation and one bootup, and the nodes are split
+        between them in proportion to their counts.
+        '''
         try:            
             use_weighted_templates = False
             vmTypes = {}
             if self.config.get("symphony.enable_weighted_templates", True):
-                pro_conf_dir = os.getenv('PRO_CONF_DIR', os.getcwd())
-                conf_path = os.path.join(pro_conf_dir, "conf", "azureccprov_templates.json")
-                with open(conf_path, 'r') as json_file:
-                    templates_json = json.load(json_file)
-                vmTypes = self.weighted_template.parse_weighted_template(input_json, templates_json["templates"])
+                vmTypes = self._template_index().vm_types(input_json["template"]["templateId"])
                 logger.debug("Current weightings: %s", ", ".join([f"{x}={y}" for x,y in vmTypes.items()]))
                 use_weighted_templates = True 
                 request_set = { 'count': input_json["template"]["machineCount"],
                                  'definition':{'templateId':input_json["template"]["templateId"]}} 
             
-            # We are grabbing the lock to serialize this call.
-            try:
+            def _record_chunks(sub_request_ids):
+                # a large request is booted in chunks, each with its own sub request id, see Cluster._bootup_chunks
                 with self.creation_json as requests_store:
-                    template_id = request_set['definition']['templateId']                    
-                    requested_slot_count = request_set['count']
+                    requests_store[request_id]["chunks"] = sub_request_ids
+
+            # Allocation is serialized per template by a lease, not by the creation_json lock, so that status
+            # and terminate calls are not blocked for the whole bootup round trip.
+            try:
+                template_id = request_set['definition']['templateId']
+                requested_slot_count = sum(coalesced.values()) if coalesced else request_set['count']
+                with util.allocation_lease(self.request_tracker.db_dir, template_id, self.allocation_lock_timeout):
                     add_nodes_response = self.cluster.add_nodes(request_id, template_id, requested_slot_count,
                                                                 use_weighted_templates, vmTypes,
                                                                 self.capacity_limit_timeout,
-                                                                self.autoscaling_strategy, self.dry_run)
+                                                                self.autoscaling_strategy, self.dry_run,
+                                                                record_chunks=None if self.dry_run else _record_chunks)
                 if self.dry_run and add_nodes_response:
                     print("Dry run succeeded")
                     exit(0)
             finally:
-                request_set['requestId'] = request_id
-                self.request_tracker.add_request(request_set) 
+                if coalesced:
+                    for member_id, count in coalesced.items():
+                        self.request_tracker.add_request(dict(request_set, count=count, requestId=member_id))
+                else:
+                    request_set['requestId'] = request_id
+                    self.request_tracker.add_request(request_set) 
             
             if not add_nodes_response:
-                raise ValueError("No nodes were created")
+                # also when every chunk failed; nodes a failed chunk did create are still found by chunk id
+                raise ValueError("No nodes were created" + (": %s" % add_nodes_response.message
+                                                            if getattr(add_nodes_response, "message", "") else ""))
             
             logger.info("Create nodes response status: %s  nodes: %s", add_nodes_response.status, [(n.name, n.vm_size) for n in add_nodes_response.nodes])
             
-            with self.creation_json as requests_store:
-                requests_store[request_id]["allNodes"] = [self.cluster.get_node_id(x) for x in add_nodes_response.nodes]
+            if getattr(add_nodes_response, "complete", True):
+                if coalesced:
+                    nodes_by_request_id = split_nodes_by_slots(add_nodes_response.nodes, coalesced)
+                    logger.info("Split the nodes of %s between %s", request_id,
+                                ", ".join("%s=%d" % (k, len(v)) for k, v in nodes_by_request_id.items()))
+                else:
+                    nodes_by_request_id = {request_id: add_nodes_response.nodes}
+                with self.creation_json as requests_store:
+                    for member_id, nodes in nodes_by_request_id.items():
+                        if member_id in requests_store:
+                            self._record_split(requests_store[member_id], nodes, request_id)
+            else:
+                # some chunks may have created nodes we never heard about, so status looks them up by chunk, and
+                # splits them between coalesced requests, see _split_coalesced
+                logger.warning("Not all chunks of %s were booted (%s), its nodes will be looked up by chunk",
+                               request_id, add_nodes_response.message)
             
-            return self.stdout_handler.handle({"requestId": request_id, "status": RequestStates.running,
-                                               "message": "Request instances success from Azure CycleCloud."})
+            return {"requestId": request_id, "status": RequestStates.running,
+                    "message": "Request instances success from Azure CycleCloud."}
 
-        except (ValueError, UserError) as e:
+        except (ValueError, UserError, util.LockTimeout) as e:
             logger.exception("Azure CycleCloud experienced an error and the node creation request failed. %s", e)
-            return self.stdout_handler.handle({"requestId": request_id, "status": RequestStates.complete_with_error,
-                                               "message": "Azure CycleCloud experienced an error: %s" % str(e)})
+            return {"requestId": request_id, "status": RequestStates.complete_with_error,
+                    "message": "Azure CycleCloud experienced an error: %s" % str(e)}
         except Exception as e:
             logger.exception("Azure CycleCloud experienced an error, though it may have succeeded: %s", e)
-            return self.stdout_handler.handle({"requestId": request_id, "status": RequestStates.running,
-                                               "message": "Azure CycleCloud experienced an error, though it may have succeeded: %s" % str(e)})
+            return {"requestId": request_id, "status": RequestStates.running,
+                    "message": "Azure CycleCloud experienced an error, though it may have succeeded: %s" % str(e)}
+
+    def launch_create_worker(self, request_id):  # pragma: no cover
+        # a detached process, so that HostFactory gets the request id back without waiting for allocation and bootup
+        import subprocess
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "create_machines_worker", "-r", request_id],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True, close_fds=True)
+
+    def create_machines_worker(self, input_json):
+        '''
+        Background half of an asynchronous create_machines: allocates and boots the nodes of a pending request.
+        '''
+        return self._create_pending(input_json["requestId"])
+
+    def _create_pending(self, request_id):
+        if self.coalesce_window > 0:
+            self._wait_for_coalesce_window(request_id)
+
+        with self.creation_json as requests_store:
+            pending = requests_store.get(request_id, {}).get("pending")
+            if not pending or pending.get("startedTime"):
+                coalesced_with = requests_store.get(request_id, {}).get("coalescedWith")
+                if coalesced_with:
+                    logger.info("Create request %s is created along with %s", request_id, coalesced_with)
+                    return {"requestId": request_id, "status": RequestStates.running,
+                            "message": "Request instances accepted by Azure CycleCloud."}
+                logger.warning("Create request %s is not waiting to be created", request_id)
+                return {"requestId": request_id, "status": RequestStates.running, "message": ""}
+            # claim it, along with the other waiting requests for the template when coalescing, so that a
+            # second worker leaves them alone
+            member_ids = [request_id]
+            if self.coalesce_window > 0:
+                member_ids = self._coalescible_requests(requests_store, pending["template"]["templateId"])
+            now = calendar.timegm(self.clock())
+            coalesced = OrderedDict()
+            for member_id in member_ids:
+                member = requests_store[member_id]["pending"]
+                member["startedTime"] = now
+                member["pid"] = os.getpid()
+                if member_id != request_id:
+                    requests_store[member_id]["coalescedWith"] = request_id
+                coalesced[member_id] = int(member["template"]["machineCount"])
+            if len(coalesced) > 1:
+                # so that a status call can split the nodes if the bootup did not report all of them
+                requests_store[request_id]["coalesced"] = coalesced
+
+        if len(coalesced) > 1:
+            logger.info("Coalescing create requests %s for template %s", list(coalesced), pending["template"]["templateId"])
+        response = self._create_nodes(request_id, {"template": pending["template"]},
+                                      coalesced if len(coalesced) > 1 else None)
+
+        with self.creation_json as requests_store:
+            for member_id in coalesced:
+                request = requests_store.get(member_id)
+                if request is not None:
+                    request.pop("pending", None)
+                    if response["status"] == RequestStates.complete_with_error:
+                        # reported by the next status call
+                        request["error"] = response["message"]
+                        request["completed"] = True
+        logger.info("Created pending request %s: %s", request_id, response)
+        return response
+
+    def _record_split(self, request, nodes, leader_id):
+        request["allNodes"] = [self.cluster.get_node_id(x) for x in nodes]
+        if not nodes:
+            request["error"] = EMPTY_SHARE_MESSAGE % leader_id
+            request["completed"] = True
+
+    def _coalesced_leader(self, requests_store, request_id):
+        # the request whose bootup created the nodes of a coalesced request whose share is not known yet
+        request = requests_store.get(request_id) or {}
+        if request.get("allNodes") is not None:
+            return None
+        leader_id = request.get("coalescedWith", request_id)
+        return leader_id if (requests_store.get(leader_id) or {}).get("coalesced") else None
+
+    def _split_coalesced(self, requests_store, leaders, found):
+        '''
+        Splits the nodes that were found under the request id of each coalescing leader between the requests it
+        created them for, like _create_nodes does when the bootup reported every node. Returns the nodes by leader
+        and member request id, or None for a leader whose nodes were not found yet.
+        '''
+        split = {}
+        for leader_id in dict.fromkeys(leaders.values()):
+            nodes = found.get(leader_id)
+            split[leader_id] = split_nodes_by_slots(nodes, requests_store[leader_id]["coalesced"]) if nodes else None
+        return split
+
+    def _wait_for_coalesce_window(self, request_id):
+        # requests for the same template that arrive within the window are allocated and booted together
+        with self.creation_json as requests_store:
+            request_time = requests_store.get(request_id, {}).get("requestTime")
+        if request_time is None:
+            return
+        remaining = request_time + self.coalesce_window - calendar.timegm(self.clock())
+        if remaining > 0:
+            time.sleep(min(remaining, self.coalesce_window))
+
+    def _coalescible_requests(self, requests_store, template_id):
+        # unclaimed requests for the template, oldest first
+        waiting = [(request.get("requestTime") or 0, request_id)
+                   for request_id, request in requests_store.items()
+                   if request.get("pending") and not request["pending"].get("startedTime")
+                   and not request.get("completed")
+                   and request["pending"]["template"].get("templateId") == template_id]
+        return [request_id for _, request_id in sorted(waiting, key=lambda w: w[0])]
+
+    def _is_pending(self, request):
+        '''
+        True while the worker of an asynchronous create has not finished. A worker that has not finished within
+        symphony.hostfactory.async_create.timeout most likely died, and the request is looked up like any other.
+        '''
+        pending = request.get("pending")
+        if not pending:
+            return False
+        since = pending.get("startedTime") or pending.get("relaunchedTime") or request.get("requestTime") or 0
+        return calendar.timegm(self.clock()) - since <= self.async_create_timeout
+
+    def _is_unclaimed(self, request, now):
+        # a pending create that no worker claimed in time, the one that was launched for it never started or died
+        pending = request.get("pending")
+        if not pending or pending.get("startedTime"):
+            return False
+        since = pending.get("relaunchedTime") or request.get("requestTime") or 0
+        return now - since > self.async_create_claim_timeout + self.coalesce_window
+
+    def _resume_unclaimed(self, request_ids):
+        '''
+        Launches another worker for each pending create that no worker claimed within
+        symphony.hostfactory.async_create.claim_timeout. If that one does not claim it either, the request fails,
+        so that Symphony does not wait for nodes that nobody is creating. Without async_create the request was
+        left pending by a coalescing create_machines call that died, and fails right away: no worker is ever
+        started unless asynchronous creates are enabled.
+        '''
+        now = calendar.timegm(self.clock())
+        requests_store = self.creation_json.read()
+        if not any(self._is_unclaimed(requests_store.get(request_id) or {}, now) for request_id in request_ids):
+            return
+        relaunch = []
+        with self.creation_json as requests_store:
+            for request_id in request_ids:
+                request = requests_store.get(request_id) or {}
+                if not self._is_unclaimed(request, now):
+                    continue
+                if not self.async_create:
+                    request.pop("pending")
+                    request["error"] = "The create_machines call for this request did not finish"
+                    request["completed"] = True
+                elif request["pending"].get("relaunchedTime"):
+                    request.pop("pending")
+                    request["error"] = "No create worker started for this request"
+                    request["completed"] = True
+                else:
+                    request["pending"]["relaunchedTime"] = now
+                    relaunch.append(request_id)
+        for request_id in relaunch:
+            logger.warning("No create worker claimed request %s, starting another", request_id)
+            try:
+                self.launch_create_worker(request_id)
+            except Exception:
+                # fails the request on a later status call
+                logger.exception("Could not start a create worker for %s", request_id)
 
     @failureresponse({"requests": [], "status": RequestStates.complete_with_error})
     def get_return_requests(self, input_json):
@@ -250,33 +497,71 @@ class CycleCloudProvider:
         cc_existing_hostnames = set()
         to_shutdown = []
 
+        # with a return digest only nodes that changed since the last poll are resolved and classified again
+        known = self.return_digest.load() if self.return_digest else {}
+        now = calendar.timegm(self.clock())
+        digest_nodes = OrderedDict()
+        entries = []
+        changed = []
         for node in all_nodes['nodes']:
             if not node.get("Configuration").get("autoscaling", {}).get("enabled", False):
                 continue
+            node_id = node.get("NodeId")
+            seen = [node.get("Status"), node.get("Hostname"), node.get("PrivateIp")]
+            entry = known.get(node_id) if node_id else None
+            if not entry or entry[:return_digest.HOSTNAME] != seen or not entry[return_digest.HOSTNAME]:
+                # a node keeps its shutdown and last change as long as its status does not change
+                if entry and entry[return_digest.STATUS] == seen[return_digest.STATUS]:
+                    entry = seen + [None, entry[return_digest.LAST_CHANGE], entry[return_digest.SHUTDOWN]]
+                else:
+                    entry = seen + [None, now, None]
+                changed.append((node, entry))
+            entries.append((node_id, entry))
+            if node_id:
+                digest_nodes[node_id] = entry
+
+        self._prefetch_hostnames({node.get("PrivateIp"): node.get("NodeId") for node, _ in changed if not node.get("Hostname")})
+
+        for node, entry in changed:
             hostname = node.get("Hostname")
             if not hostname:
                 try:
-                    hostname = self.hostnamer.hostname(node.get("PrivateIp"))
+                    hostname = self.hostnamer.hostname(node.get("PrivateIp"), node.get("NodeId"))
                 except Exception:
                     logger.warning("get_return_requests: No hostname set and could not convert ip %s to hostname for \"%s\" VM.", node.get("PrivateIp"), node)
+            entry[return_digest.HOSTNAME] = hostname
+            node_status = node.get("Status")
+            if node_status in report_failure_states:
+                node_status_msg = node.get("StatusMessage", "Unknown node failure.")
+                logger.error("Requesting Return for failed node: %s (%s) with State: %s (%s)", hostname, node.get("NodeId") or "", node_status, node_status_msg)
+
+        shutdown_entries = []
+        for node_id, entry in entries:
+            hostname = entry[return_digest.HOSTNAME]
             cc_existing_hostnames.add(hostname)
             machine = {"gracePeriod": 0,
                        "machine": hostname or ""}
-            node_status = node.get("Status")
-            node_status_msg = node.get("StatusMessage", "Unknown node failure.")
 
-            if node_status in report_failure_states:
-                logger.error("Requesting Return for failed node: %s (%s) with State: %s (%s)", hostname, node.get("NodeId") or "", node_status, node_status_msg)
-                to_shutdown.append({"name": hostname, "machineId": node.get("NodeId")})
+            if entry[return_digest.STATUS] in report_failure_states:
                 response["requests"].append(machine)
+                if not self.return_digest or self.return_digest.shutdown_due(entry):
+                    to_shutdown.append({"name": hostname, "machineId": node_id})
+                    shutdown_entries.append(entry)
         # these nodes may not even exist in symphony, so we will just shut them down and then report them
         # to symphony.
         try:
             if to_shutdown:
                 logger.debug("Terminating returned machines: %s", to_shutdown)
-                self.terminate_machines({"machines": to_shutdown}, quiet_output())
+                terminated = self.terminate_machines({"machines": to_shutdown}, quiet_output())
+                if self.return_digest and terminated and terminated.get("status") == RequestStates.complete:
+                    for entry in shutdown_entries:
+                        self.return_digest.shut_down(entry)
         except:
             logger.exception()
+
+        if self.return_digest:
+            self.return_digest.save(digest_nodes)
+
         missing_from_cc = sym_existing_hostnames - cc_existing_hostnames
 
         if len(response["requests"]) > 0:
@@ -321,203 +606,287 @@ class CycleCloudProvider:
         request_ids = [r["requestId"] for r in input_json["requests"]]
         
         nodes_by_request_id = {}
+        # asynchronous creates whose worker has not finished, or failed, have nothing to look up in CycleCloud
+        deferred = {}
         exceptions = []
-        # go one by one in case one of the request_ids does not exist in CycleCloud
-        for request_id in request_ids:
-            try:
-                nodes_by_request_id.update(self.cluster.nodes(request_ids=[request_id]))   
-                logger.debug("Node list by request id %s",nodes_by_request_id)             
-            except Exception as e:
-                if "No operation found for request id" in str(e):
-                    nodes_by_request_id[request_id] = {"nodes": []}
-                elif "Could not find request id" in str(e):
-                    nodes_by_request_id[request_id] = []
-                else:
-                    exceptions.append(e)
-                    # send HF request is still running so that it remembers request.
-                    logger.exception("Azure CycleCloud experienced an error but reporting status as running %s. %s", request_id, e)
-                    return output_handler.handle({"status": RequestStates.running,
-                                        "requests": [{"requestId": request_id, "status": RequestStates.running} for request_id in request_ids],
-                                        "message": "Azure CycleCloud is still requesting nodes"})
+        try:
+            self._resume_unclaimed(request_ids)
+            # the node ids recorded at creation let the cluster resolve these requests from a single node listing
+            requests_store = self.creation_json.read()
+            for request_id in request_ids:
+                request = requests_store.get(request_id) or {}
+                if request.get("error"):
+                    deferred[request_id] = {"requestId": request_id, "machines": [],
+                                            "status": RequestStates.complete_with_error,
+                                            "message": request["error"]}
+                elif self._is_pending(request):
+                    deferred[request_id] = {"requestId": request_id, "machines": [],
+                                            "status": RequestStates.running,
+                                            "message": "Azure CycleCloud is still requesting nodes"}
+            lookup_ids = [request_id for request_id in request_ids if request_id not in deferred]
+            # coalesced requests whose nodes were not split at creation are looked up under their leader's id
+            leaders = {request_id: self._coalesced_leader(requests_store, request_id) for request_id in lookup_ids}
+            leaders = {request_id: leader_id for request_id, leader_id in leaders.items() if leader_id}
+            cluster_ids = list(dict.fromkeys([request_id for request_id in lookup_ids if request_id not in leaders]
+                                             + list(leaders.values())))
+            known_node_ids = {request_id: requests_store[request_id].get("allNodes")
+                              for request_id in cluster_ids if request_id in requests_store
+                              and request_id not in leaders.values()}
+            chunk_ids = {request_id: requests_store[request_id]["chunks"]
+                         for request_id in cluster_ids if requests_store.get(request_id, {}).get("chunks")}
+            found = self.cluster.nodes_by_request_ids(cluster_ids, known_node_ids, chunk_ids) if cluster_ids else {}
+            logger.debug("Node list by request id %s", found)
+            split = self._split_coalesced(requests_store, leaders, found)
+        except Exception as e:
+            exceptions.append(e)
+            # send HF request is still running so that it remembers request.
+            logger.exception("Azure CycleCloud experienced an error but reporting status as running %s. %s", request_ids, e)
+            return output_handler.handle({"status": RequestStates.running,
+                                "requests": [{"requestId": request_id, "status": RequestStates.running} for request_id in request_ids],
+                                "message": "Azure CycleCloud is still requesting nodes"})
+
+        for request_id in lookup_ids:
+            if request_id in leaders:
+                nodes = (split[leaders[request_id]] or {}).get(request_id)
+                if split[leaders[request_id]] is not None and not nodes:
+                    deferred[request_id] = {"requestId": request_id, "machines": [],
+                                            "status": RequestStates.complete_with_error,
+                                            "message": EMPTY_SHARE_MESSAGE % leaders[request_id]}
+                    continue
+                nodes_by_request_id[request_id] = nodes or []
+            else:
+                # None means CycleCloud could not find the request id
+                nodes_by_request_id[request_id] = found.get(request_id) or []
+
+        self._prefetch_hostnames({node.private_ip: self.cluster.get_node_id(node) for nodes in nodes_by_request_id.values()
+                                  for node in nodes if not node.hostname})
 
-                    
 
-        if not nodes_by_request_id:
+        if not nodes_by_request_id and not deferred:
             error_messages = " | ".join(list(set([str(e) for e in exceptions])))
             return output_handler.handle({"status": RequestStates.complete_with_error,
                                         "requests": [{"requestId": request_id, "status": RequestStates.complete_with_error} for request_id in request_ids],
                                         "message": "Azure CycleCloud experienced an error: %s" % error_messages})
         
-        message = ""
-        
-        response = {"requests": []}
+        report_failure_states = ["Unavailable", "Failed"]
+        terminate_states = []
         
-        for request_id, requested_nodes in nodes_by_request_id.items():
-            request_status = RequestStates.complete
-            unknown_state_count = 0
-            requesting_count = 0
-            if not requested_nodes:
-                # nothing to do.
-                logger.warning("No nodes found for request id %s.", request_id)
-            
-            completed_nodes = []
-            # Collect all node ids associated with requestId for recovery of failed request_store operation.
-            all_nodes = []
-            # Collect nodes that have potential to be fulfilled. Excludes failed, terminating and unavailable.
-            valid_nodes = []
-            machines = []
-            request = {"requestId": request_id,
-                        "machines": machines}
-            
-            response["requests"].append(request)
-            
-            report_failure_states = ["Unavailable", "Failed"]
-            terminate_states = []
-            
-            if self.config.get("symphony.terminate_failed_nodes", False):
-                report_failure_states = ["Unavailable"]
-                terminate_states = ["Failed"]
-            
-            for node in requested_nodes:
-                try:
-                    # for new nodes, completion is Ready. For "released" nodes, as long as
-                    # the node has begun terminated etc, we can just say success.
-                    node_status = node.state
-                    node_target_state = node.target_state
-                    node_id = self.cluster.get_node_id(node)
-                    all_nodes.append(node_id)
-                    valid_nodes.append(node_id)
-                    machine_status = MachineStates.active
-                    
-                    hostname = None
-                    private_ip_address = None
+        if self.config.get("symphony.terminate_failed_nodes", False):
+            report_failure_states = ["Unavailable"]
+            terminate_states = ["Failed"]
 
-                    
-                    if not node_target_state:
-                        unknown_state_count = unknown_state_count + 1
-                        continue
-                    
-                    if node_target_state and node_target_state != "Started":
-                        valid_nodes.remove(node_id)
-                        logger.debug("Node %s target state is not started it is %s", node.name, node_target_state) 
-                        continue
-                    
-                    if node_status in report_failure_states:
-                        valid_nodes.remove(node_id)
-                        machine_result = MachineResults.failed
-                        machine_status = MachineStates.error
-                        if request_status != RequestStates.running:
-                            message = "Node entered failure state."   
-                            request_status = RequestStates.complete_with_error
-                            
-                    elif node_status in terminate_states:
-                        # just terminate the node and next iteration the node will be gone. This allows retries of the shutdown to happen, as 
-                        # we will report that the node is still booting.
-                        unknown_state_count = unknown_state_count + 1
-                        machine_result = MachineResults.executing
-                        machine_status = MachineStates.building
-                        request_status = RequestStates.running
+        def _evaluate(item):
+            request_id, requested_nodes = item
+            try:
+                return self._evaluate_create_request(request_id, requested_nodes, report_failure_states, terminate_states)
+            except Exception as e:
+                # only this request is reported as running, so that the next status call evaluates it again
+                logger.exception("Could not evaluate request %s, reporting it as running. %s", request_id, e)
+                deferred[request_id] = {"requestId": request_id, "machines": [], "status": RequestStates.running,
+                                        "message": "Azure CycleCloud is still requesting nodes"}
+                return None
+
+        # requests are independent, so evaluate them concurrently and merge the results in request order below
+        workers = min(self.status_workers, len(nodes_by_request_id))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                evaluations = list(executor.map(_evaluate, nodes_by_request_id.items()))
+        else:
+            evaluations = [_evaluate(item) for item in nodes_by_request_id.items()]
+        evaluations = [evaluation for evaluation in evaluations if evaluation is not None]
 
-                        hostname = node.hostname
-                        if not hostname:
-                            try:
-                                hostname = self.hostnamer.hostname(node.private_ip)
-                            except Exception:                            
-                                logger.warning("_create_status: No hostname set and could not convert ip %s to hostname for \"%s\" VM.", node.private_ip, node_status)
+        # just terminate the failed nodes and next iteration they will be gone. This allows retries of the shutdown to
+        # happen, as we report that they are still booting.
+        to_shutdown = [machine for evaluation in evaluations for machine in evaluation["to_shutdown"]]
+        if to_shutdown:
+            try:
+                logger.warning("Warning: Cluster status check terminating failed nodes %s", to_shutdown)
+                # the ones that fail are still failed nodes on the next status call
+                self._shutdown_machines(to_shutdown)
+            except Exception:
+                logger.exception("Could not terminate nodes with ids %s", [m["machineId"] for m in to_shutdown])
 
-                        try:
-                            logger.warning("Warning: Cluster status check terminating failed node %s", node)
-                            # import traceback
-                            #logger.warning("Traceback:\n%s", '\n'.join([line  for line in traceback.format_stack()]))
-                            self.cluster.shutdown_nodes([{"machineId": self.cluster.get_node_id(node), "name": hostname}])
-                        except Exception:
-                            logger.exception("Could not terminate node with id %s" % self.cluster.get_node_id(node))
-            
-                    elif not node.instance_id:
-                        requesting_count = requesting_count + 1
-                        request_status = RequestStates.running
-                        machine_result = MachineResults.executing
-                        continue
-                    
-                    elif node_status in ["Ready", "Started"]:
-                        machine_result = MachineResults.succeed
-                        machine_status = MachineStates.active
-                        private_ip_address = node.private_ip
-                        if not private_ip_address:
-                            logger.warning("No ip address found for ready node %s", node.name)
-                            machine_result = MachineResults.executing
-                            machine_status = MachineStates.building
-                            request_status = RequestStates.running
-                        else:
-                            hostname = node.hostname
-                            if not hostname:
-                                try:
-                                    hostname = self.hostnamer.hostname(node.private_ip)
-                                    logger.warning("_create_status: Node does not have hostname using %s ", hostname)
-                                except Exception:                                
-                                    # We report status as running even though the node is ready, as we don't have a hostname.
-                                    logger.warning("_create_status: No hostname set and could not convert ip %s to hostname for \"%s\" VM.", node.private_ip, node)
-                                    machine_result = MachineResults.executing
-                                    machine_status = MachineStates.building
-                                    request_status = RequestStates.running
-                                    hostname = ""
-                            if hostname:
-                                completed_nodes.append({"hostname": hostname, "nodeid": node_id})
-                    else:
-                        machine_result = MachineResults.executing
-                        machine_status = MachineStates.building
-                        request_status = RequestStates.running
-                
-                except Exception as e:
-                    logger.exception("Error processing node %s with exception %s but reporting machine status as building", node, e)
-                    machine_result = MachineResults.executing
-                    machine_status = MachineStates.building
-                    request_status = RequestStates.running 
-                machine = {
-                        "name": hostname or "",
-                        "status": machine_status,
-                        "result": machine_result,
-                        "machineId": self.cluster.get_node_id(node) or "",
-                        "launchtime": int(time.time()),
-                        "privateIpAddress": private_ip_address or "",
-                        "message": ""
-                    }
-                    
-                machines.append(machine)
-            
+        evaluated = {evaluation["request"]["requestId"]: evaluation["request"] for evaluation in evaluations}
+        response = {"requests": [deferred.get(request_id) or evaluated[request_id] for request_id in dict.fromkeys(request_ids)]}
+
+        # a single locked read and rewrite of the store for all of the requests
+        now = calendar.timegm(self.clock())
+        if evaluations or any(split.values()):
             with self.creation_json as requests_store:
-                if request_id not in requests_store:
-                    logger.warning("Unknown request_id %s. Creating a new entry and resetting requestTime", request_id)
-                    requests_store[request_id] = {"requestTime": calendar.timegm(self.clock())}
-                #set default
-                requests_store[request_id]["lastUpdateTime"] = calendar.timegm(self.clock())
+                for leader_id, nodes_by_member in split.items():
+                    for member_id, nodes in (nodes_by_member or {}).items():
+                        if member_id in requests_store and requests_store[member_id].get("allNodes") is None:
+                            self._record_split(requests_store[member_id], nodes, leader_id)
+                for evaluation in evaluations:
+                    request_id = evaluation["request"]["requestId"]
+                    completed_nodes = evaluation["completed_nodes"]
+                    if request_id not in requests_store:
+                        logger.warning("Unknown request_id %s. Creating a new entry and resetting requestTime", request_id)
+                        requests_store[request_id] = {"requestTime": now}
+                    #set default
+                    requests_store[request_id]["lastUpdateTime"] = now
                         
-                # Bugfix: Periodic cleanup calls this function however nodes reach ready state after symphony has 
-                # stopped making status calls should not update this.
-                if update_completed_nodes:
-                    requests_store[request_id]["completedNodes"] = completed_nodes
-                if requests_store[request_id].get("allNodes") is None:
-                    requests_store[request_id]["allNodes"] = all_nodes
-                requests_store[request_id]["completed"] = len(requested_nodes) == len(completed_nodes)
-
+                    # Bugfix: Periodic cleanup calls this function however nodes reach ready state after symphony has 
+                    # stopped making status calls should not update this.
+                    if update_completed_nodes:
+                        requests_store[request_id]["completedNodes"] = completed_nodes
+                    if requests_store[request_id].get("allNodes") is None and request_id not in leaders:
+                        requests_store[request_id]["allNodes"] = evaluation["all_nodes"]
+                    requests_store[request_id]["completed"] = evaluation["node_count"] == len(completed_nodes)
+
+        for evaluation in evaluations:
+            request = evaluation["request"]
+            request_id = request["requestId"]
+            machines = request["machines"]
             active = len([x for x in machines if x["status"] == MachineStates.active])
             building = len([x for x in machines if x["status"] == MachineStates.building])
             failed = len([x for x in machines if x["status"] == MachineStates.error])
             
             logger.info("Machine states for requestId %s: %d active, %d building, %d requesting, %d failed and %d in an unknown state.", 
-                        request_id, active, building, requesting_count, failed, unknown_state_count)
+                        request_id, active, building, evaluation["requesting_count"], failed, evaluation["unknown_state_count"])
             
-            request["status"] = request_status
-            if request_status == RequestStates.complete:
+            if request["status"] == RequestStates.complete:
                 logger.info("Request %s is complete.", request_id)
-            elif request_status == RequestStates.complete_with_error:
-                logger.warning("Request %s completed with error: %s.", request_id, message)
-            request["message"] = message
-        
+            elif request["status"] == RequestStates.complete_with_error:
+                logger.warning("Request %s completed with error: %s.", request_id, request["message"])
+
         response["status"] = symphony.RequestStates.complete
         
         return output_handler.handle(response)
         
+    def _evaluate_create_request(self, request_id, requested_nodes, report_failure_states, terminate_states):
+        '''
+        Maps the nodes of one creation request to Symphony machines. Reads no shared state and changes
+        nothing, so that _create_status can evaluate requests concurrently. The nodes to shut down are
+        returned for the caller to terminate.
+        '''
+        request_status = RequestStates.complete
+        message = ""
+        unknown_state_count = 0
+        requesting_count = 0
+        if not requested_nodes:
+            # nothing to do.
+            logger.warning("No nodes found for request id %s.", request_id)
+        
+        completed_nodes = []
+        # Collect all node ids associated with requestId for recovery of failed request_store operation.
+        all_nodes = []
+        # Collect nodes that have potential to be fulfilled. Excludes failed, terminating and unavailable.
+        valid_nodes = []
+        machines = []
+        to_shutdown = []
+        
+        for node in requested_nodes:
+            try:
+                # for new nodes, completion is Ready. For "released" nodes, as long as
+                # the node has begun terminated etc, we can just say success.
+                node_status = node.state
+                node_target_state = node.target_state
+                node_id = self.cluster.get_node_id(node)
+                all_nodes.append(node_id)
+                valid_nodes.append(node_id)
+                machine_status = MachineStates.active
+                
+                hostname = None
+                private_ip_address = None
+
+                
+                if not node_target_state:
+                    unknown_state_count = unknown_state_count + 1
+                    continue
+                
+                if node_target_state and node_target_state != "Started":
+                    valid_nodes.remove(node_id)
+                    logger.debug("Node %s target state is not started it is %s", node.name, node_target_state) 
+                    continue
+                
+                if node_status in report_failure_states:
+                    valid_nodes.remove(node_id)
+                    machine_result = MachineResults.failed
+                    machine_status = MachineStates.error
+                    if request_status != RequestStates.running:
+                        message = "Node entered failure state."   
+                        request_status = RequestStates.complete_with_error
+                        
+                elif node_status in terminate_states:
+                    # the caller shuts these down once every request is evaluated
+                    unknown_state_count = unknown_state_count + 1
+                    machine_result = MachineResults.executing
+                    machine_status = MachineStates.building
+                    request_status = RequestStates.running
+
+                    hostname = node.hostname
+                    if not hostname:
+                        try:
+                            hostname = self.hostnamer.hostname(node.private_ip, node_id)
+                        except Exception:                            
+                            logger.warning("_create_status: No hostname set and could not convert ip %s to hostname for \"%s\" VM.", node.private_ip, node_status)
+
+                    to_shutdown.append({"machineId": node_id, "name": hostname})
+        
+                elif not node.instance_id:
+                    requesting_count = requesting_count + 1
+                    request_status = RequestStates.running
+                    machine_result = MachineResults.executing
+                    continue
+                
+                elif node_status in ["Ready", "Started"]:
+                    machine_result = MachineResults.succeed
+                    machine_status = MachineStates.active
+                    private_ip_address = node.private_ip
+                    if not private_ip_address:
+                        logger.warning("No ip address found for ready node %s", node.name)
+                        machine_result = MachineResults.executing
+                        machine_status = MachineStates.building
+                        request_status = RequestStates.running
+                    else:
+                        hostname = node.hostname
+                        if not hostname:
+                            try:
+                                hostname = self.hostnamer.hostname(node.private_ip, node_id)
+                                logger.warning("_create_status: Node does not have hostname using %s ", hostname)
+                            except Exception:                                
+                                # We report status as running even though the node is ready, as we don't have a hostname.
+                                logger.warning("_create_status: No hostname set and could not convert ip %s to hostname for \"%s\" VM.", node.private_ip, node)
+                                machine_result = MachineResults.executing
+                                machine_status = MachineStates.building
+                                request_status = RequestStates.running
+                                hostname = ""
+                        if hostname:
+                            completed_nodes.append({"hostname": hostname, "nodeid": node_id})
+                else:
+                    machine_result = MachineResults.executing
+                    machine_status = MachineStates.building
+                    request_status = RequestStates.running
+            
+            except Exception as e:
+                logger.exception("Error processing node %s with exception %s but reporting machine status as building", node, e)
+                machine_result = MachineResults.executing
+                machine_status = MachineStates.building
+                request_status = RequestStates.running 
+            machine = {
+                    "name": hostname or "",
+                    "status": machine_status,
+                    "result": machine_result,
+                    "machineId": self.cluster.get_node_id(node) or "",
+                    "launchtime": int(time.time()),
+                    "privateIpAddress": private_ip_address or "",
+                    "message": ""
+                }
+                
+            machines.append(machine)
+        
+        return {"request": {"requestId": request_id,
+                            "machines": machines,
+                            "status": request_status,
+                            "message": message},
+                "completed_nodes": completed_nodes,
+                "all_nodes": all_nodes,
+                "node_count": len(requested_nodes),
+                "requesting_count": requesting_count,
+                "unknown_state_count": unknown_state_count,
+                "to_shutdown": to_shutdown}
+        
     @failureresponse({"requests": [], "status": RequestStates.running})
     def _terminate_status(self, input_json):
         # can transition from complete -> executing or complete -> complete_with_error -> executing
@@ -532,17 +901,18 @@ class CycleCloudProvider:
             
             termination_ids = [r["requestId"] for r in input_json["requests"] if r["requestId"]]
             machines_to_terminate = []
+            requested_at = {}
             for termination_id in termination_ids:
                 if termination_id in terminate_requests:
                     termination = terminate_requests[termination_id]
                     if not termination.get("terminated"):
-                        for machine_id, name in termination["machines"].items():
-                            machines_to_terminate.append({"machineId": machine_id, "name": name})
+                        machines_to_terminate.extend(self._machines_to_shut_down(termination, requested_at))
             
+            failed = {}
             if machines_to_terminate:
                 logger.warning("Re-attempting termination of nodes %s", machines_to_terminate)
                 try:
-                    self.cluster.shutdown(machines_to_terminate)
+                    failed = self._shutdown_machines(machines_to_terminate, requested_at)
                 except Exception:
                     # Send HF request status as running so it remembers the request
                     logger.exception("Could not terminate machines %s due to an exception, reported status as running", machines_to_terminate)
@@ -573,8 +943,7 @@ class CycleCloudProvider:
                 
             for termination_id in termination_ids:
                 if termination_id in terminate_requests:
-                    termination = terminate_requests[termination_id]
-                    termination["terminated"] = True
+                    self._record_shutdown(terminate_requests[termination_id], failed)
                                     
             for termination_id in termination_ids:
                
@@ -599,7 +968,17 @@ class CycleCloudProvider:
                         logger.warning("No machines found for termination request %s. Will retry.", termination_id)
                         request_status = RequestStates.running
                     
+                    still_failed = termination_request.get("failed") or []
+                    if still_failed:
+                        # reported as running so that HF asks again, and the next call retries just these
+                        request_status = RequestStates.running
                     for machine_id, hostname in machines.items():
+                        if machine_id in still_failed:
+                            response_machines.append({"name": hostname,
+                                                       "status": MachineStates.deleting,
+                                                       "result": MachineResults.executing,
+                                                       "machineId": machine_id})
+                            continue
                         response_machines.append({"name": hostname,
                                                    "status": MachineStates.deleted,
                                                    "result": MachineResults.succeed,
@@ -633,24 +1012,89 @@ class CycleCloudProvider:
     def _retry_termination_requests(self):
         with self.terminate_json as terminate_requests:
             machines_to_terminate = []
+            requested_at = {}
             try:
                 for termination_id in terminate_requests:
                     termination = terminate_requests[termination_id]
                     if not termination.get("terminated"):
-                        for machine_id, name in termination["machines"].items():
-                            machines_to_terminate.append({"machineId": machine_id, "name": name})
+                        machines_to_terminate.extend(self._machines_to_shut_down(termination, requested_at))
                 
+                failed = {}
                 if machines_to_terminate:
                     logger.info("Attempting termination of nodes %s", machines_to_terminate)
-                    self.cluster.shutdown_nodes(machines_to_terminate)
+                    failed = self._shutdown_machines(machines_to_terminate, requested_at)
                     
                 for termination_id in terminate_requests:
                     termination = terminate_requests[termination_id]
-                    termination["terminated"] = True
+                    self._record_shutdown(termination, failed)
                     termination["lastUpdateTime"] = calendar.timegm(self.clock())
                         
             except Exception:
                 logger.exception("Could not terminate nodes with ids %s. Will retry", machines_to_terminate)
+
+    def _shutdown_machines(self, machines, requested_at=None):
+        '''
+        Shuts down the machines and returns the ids that failed, with why. With a termination queue these are the
+        ids that are still queued. requested_at marks a retry, see TerminationQueue.enqueue.
+        '''
+        if self.termination_queue is not None:
+            return self._enqueue_shutdown(machines, requested_at)
+        result = self.cluster.shutdown_nodes(machines)
+        failed = getattr(result, "failed", None)
+        return failed if isinstance(failed, dict) else {}
+
+    def _enqueue_shutdown(self, machines, requested_at=None):
+        self.termination_queue.enqueue(machines, requested_at)
+        if self.termination_drain != "background":
+            self.termination_queue.drain()
+        elif not self.in_drainer:
+            # a drainer never starts the next one, or ids waiting out their backoff would chain drainers for
+            # good; the next producer starts it instead
+            try:
+                self.launch_termination_drainer()
+            except Exception:
+                logger.exception("Could not start a termination queue drainer, draining it now")
+                self.termination_queue.drain()
+        return self.termination_queue.pending([machine["machineId"] for machine in machines])
+
+    def launch_termination_drainer(self):  # pragma: no cover
+        # a drainer that finds another one running exits right away, so this is safe to call every time
+        import subprocess
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "drain_terminations", "-q", "termination_queue"],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True, close_fds=True)
+
+    def drain_terminations(self, input_json):
+        '''
+        Background drainer of the termination queue: shuts down queued machines until none is ready, waiting out
+        symphony.hostfactory.termination_queue.min_interval between calls.
+        '''
+        if self.termination_queue is None:
+            logger.warning("symphony.hostfactory.termination_queue.enabled is not set, nothing to drain")
+            return None
+        self.in_drainer = True
+        calls = self.termination_queue.drain(wait=True)
+        logger.info("Drained the termination queue in %s shutdown calls", calls)
+        return calls
+
+    def _machines_to_shut_down(self, termination, requested_at=None):
+        # after a partial failure only the machines that failed are shut down again
+        machines = termination["machines"]
+        machine_ids = termination["failed"] if termination.get("failed") else machines.keys()
+        if requested_at is not None:
+            # when the shutdown of each machine was first asked for, the latest if several terminations ask for it
+            for machine_id in machine_ids:
+                requested_at[machine_id] = max(requested_at.get(machine_id, 0), termination.get("requestTime") or 0)
+        return [{"machineId": machine_id, "name": machines.get(machine_id, machine_id)} for machine_id in machine_ids]
+
+    def _record_shutdown(self, termination, failed):
+        still_failed = [machine_id for machine_id in termination.get("machines", {}) if machine_id in failed]
+        if still_failed:
+            termination["failed"] = still_failed
+            termination.pop("terminated", None)
+        else:
+            termination.pop("failed", None)
+            termination["terminated"] = True
         
     def _cleanup_expired_requests(self, requests, retirement, completed_key):
         now = calendar.timegm(self.clock())
@@ -719,9 +1163,12 @@ class CycleCloudProvider:
             message = "CycleCloud is terminating the VM(s)"
 
             try:
-                self.cluster.shutdown_nodes(input_json["machines"])
+                failed = self._shutdown_machines(input_json["machines"])
                 with self.terminate_json as terminations:
-                    terminations[request_id]["terminated"] = True
+                    self._record_shutdown(terminations[request_id], failed)
+                if failed:
+                    # retried by the next status call, for just the machines that failed
+                    request_status = RequestStates.running
             except Exception:
                 # set to running, we will retry on any status call anyways.
                 request_status = RequestStates.running
@@ -774,9 +1221,8 @@ class CycleCloudProvider:
 
         # Update request tracking
         if 'requests' in create_response:
-            for cr in create_response['requests']:
-                if cr['status'] in [ RequestStates.complete ]:
-                    self.request_tracker.request_completed(cr)
+            self.request_tracker.requests_completed([cr["requestId"] for cr in create_response['requests']
+                                                     if cr['status'] in [ RequestStates.complete ]])
 
         create_status = create_response.get("status", RequestStates.complete)
         delete_status = delete_response.get("status", RequestStates.complete)
@@ -914,14 +1360,10 @@ class CycleCloudProvider:
     def validate_template(self):
         cluster_status = self.cluster.status()
         nodearrays = cluster_status["nodearrays"]
-        pro_conf_dir = os.getenv('PRO_CONF_DIR', os.getcwd())
-        conf_path = os.path.join(pro_conf_dir, "conf", "azureccprov_templates.json")
-        with open(conf_path, 'r') as json_file:
-            templates_json = json.load(json_file)
-        if "templates" not in templates_json:
+        templates_json = self._template_index().templates
+        if templates_json is None:
             print("List templates not present in azureccprov_templates.json", file=sys.stderr)
             return False
-        templates_json = templates_json["templates"]
         if len(templates_json) == 0:
             print("Length of list templates is 0", file=sys.stderr)
             return False
@@ -958,10 +1400,11 @@ class JsonOutputHandler:
         self.written = False
         self.quiet = quiet
         
-    def handle(self, data, debug_output=True):  # pragma: no cover
+    def handle(self, data, debug_output=True, serialized=None):  # pragma: no cover
         assert not self.written 
         self.written = True
-        data_str = json.dumps(data)
+        # serialized: data already dumped to json, e.g. the prebuilt templates response
+        data_str = serialized if serialized is not None else json.dumps(data)
         if debug_output:
             logger.debug("Response: %s", data_str)
         if not self.quiet:
@@ -974,13 +1417,114 @@ class JsonOutputHandler:
         return self.handle(data, debug_output)
 
 
+class LazyCluster:
+    '''
+    Stands in for cluster.Cluster until a command first uses it. Importing cluster loads requests and scalelib,
+    which is most of the start up time, and commands like templates never talk to CycleCloud.
+    '''
+
+    def __init__(self, cluster_name, provider_config, logger):
+        self.cluster_name = cluster_name
+        self.provider_config = provider_config
+        self.logger = logger
+        self._cluster = None
+
+    def _get_cluster(self):
+        if self._cluster is None:
+            import cluster
+            self._cluster = cluster.Cluster(self.cluster_name, self.provider_config, self.logger)
+        return self._cluster
+
+    def __getattr__(self, name):
+        return getattr(self._get_cluster(), name)
+
+    def connection_stats(self):
+        if self._cluster is None:
+            return {}
+        return self._cluster.connection_stats()
+
+    def refresh(self):
+        if self._cluster is not None:
+            self._cluster.refresh()
+
+
 def true_gmt_clock():  # pragma: no cover
     import time
     return time.gmtime()
 
 
+def new_provider(provider_config, fine=False):  # pragma: no cover
+    data_dir = os.getenv('PRO_DATA_DIR', os.getcwd())
+    hostnamer = util.Hostnamer(provider_config.get("cyclecloud.hostnames.use_fqdn", True),
+                               cache_path=os.path.join(data_dir, "hostnames_cache.json"),
+                               positive_ttl=float(provider_config.get("cyclecloud.hostnames.cache_ttl", 300)),
+                               negative_ttl=float(provider_config.get("cyclecloud.hostnames.negative_cache_ttl", 60)),
+                               max_workers=int(provider_config.get("cyclecloud.hostnames.resolver_threads", 16)))
+    cluster_name = provider_config.get("cyclecloud.cluster.name")
+    store_backend = provider_config.get("symphony.hostfactory.store_backend", "json")
+    lock_timeout = float(provider_config.get("symphony.hostfactory.lock_timeout", 180))
+    
+    provider = CycleCloudProvider(config=provider_config,
+                                  cluster=LazyCluster(cluster_name, provider_config, logger),
+                                  hostnamer=hostnamer,
+                                  stdout_handler=JsonOutputHandler(quiet=False),
+                                  terminate_requests=util.new_store("terminate_requests.json", data_dir, store_backend, lock_timeout=lock_timeout),
+                                  creation_requests=util.new_store("create_requests.json", data_dir, store_backend, lock_timeout=lock_timeout),
+                                  clock=true_gmt_clock)
+    
+    provider.fine = fine
+    provider.template_cache_dir = data_dir
+    if provider_config.get("symphony.hostfactory.return_digest.enabled", False):
+        provider.return_digest = return_digest.ReturnDigest(cluster_name, data_dir,
+                                                            max_age=float(provider_config.get("symphony.hostfactory.return_digest.max_age", 600)),
+                                                            shutdown_retry=float(provider_config.get("symphony.hostfactory.return_digest.shutdown_retry", 300)),
+                                                            logger=logger)
+    if provider_config.get("symphony.hostfactory.termination_queue.enabled", False):
+        provider.termination_queue = termination_queue.TerminationQueue(
+            util.new_store("termination_queue.json", data_dir, store_backend, lock_timeout=lock_timeout), data_dir,
+            lambda machines: provider.cluster.shutdown_nodes(machines),
+            batch_size=int(provider_config.get("symphony.hostfactory.termination_queue.batch_size",
+                                               provider_config.get("cyclecloud.shutdown.batch_size", 500))),
+            min_interval=float(provider_config.get("symphony.hostfactory.termination_queue.min_interval", 0)),
+            retry_backoff=float(provider_config.get("symphony.hostfactory.termination_queue.retry_backoff", 30)),
+            logger=logger)
+    return provider
+
+
+def run_command(provider, cmd, input_json):  # pragma: no cover
+    if cmd == "validate_templates" or input_json.get("dry-run"):
+        provider.validate_template()
+        provider.dry_run = True  
+    if cmd == "generate_templates":
+        provider.generate_sample_template()     
+    
+    if cmd == "templates":
+        logger.info("Using azurecc version %s", version.get_version())
+        provider.templates()
+    elif cmd == "create_machines":
+        provider.create_machines(input_json)
+    elif cmd == "create_machines_worker":
+        provider.create_machines_worker(input_json)
+    elif cmd == "drain_terminations":
+        provider.drain_terminations(input_json)
+    elif cmd in ["create_status"]:
+        if "requests" in input_json:
+            # provider.status handles both create_status and terminate_status calls.
+            provider.status(input_json)
+        else:
+            # should be impossible
+            raise RuntimeError("Unexpected input json for cmd %s" % (input_json, cmd))
+    elif cmd == "get_return_requests":
+        provider.get_return_requests(input_json)
+    elif cmd == "terminate_machines":
+        provider.terminate_machines(input_json)
+    elif cmd == "debug_completed_nodes":
+        provider.debug_completed_nodes()
+
+
 def main(argv=sys.argv):  # pragma: no cover
     operation_id = int(time.time())
+    provider_config = None
     try:
         
         global logger
@@ -988,57 +1532,29 @@ def main(argv=sys.argv):  # pragma: no cover
         cmd, ignore, input_json_path = argv[1:]
         provider_config, logger, fine = util.provider_config_from_environment()
         
-        data_dir = os.getenv('PRO_DATA_DIR', os.getcwd())
-        conf_dir = os.getenv('PRO_CONF_DIR', os.getcwd())
-        hostnamer = util.Hostnamer(provider_config.get("cyclecloud.hostnames.use_fqdn", True))
-        cluster_name = provider_config.get("cyclecloud.cluster.name")
-        
-        provider = CycleCloudProvider(config=provider_config,
-                                      cluster=cluster.Cluster(cluster_name, provider_config, logger),
-                                      hostnamer=hostnamer,
-                                      stdout_handler=JsonOutputHandler(quiet=False),
-                                      terminate_requests=JsonStore("terminate_requests.json", data_dir),
-                                      creation_requests=JsonStore("create_requests.json", data_dir),
-                                      clock=true_gmt_clock)
+        provider = new_provider(provider_config, fine)
         
-        provider.fine = fine
-        
-        input_json = util.load_json(input_json_path)
+        if cmd == "create_machines_worker":
+            # started by an asynchronous create_machines as: create_machines_worker -r <request id>
+            input_json = {"requestId": input_json_path}
+        elif cmd == "drain_terminations":
+            # started by a producer of the termination queue as: drain_terminations -q termination_queue
+            input_json = {}
+        else:
+            input_json = util.load_json(input_json_path)
         
         
         logger.info("BEGIN %s %s - %s %s", operation_id, cmd, ignore, input_json_path)
         logger.debug("Input: %s", json.dumps(input_json))
         
-        if cmd == "validate_templates" or input_json.get("dry-run"):
-            provider.validate_template()
-            provider.dry_run = True  
-        if cmd == "generate_templates":
-            provider.generate_sample_template()     
-        
-                
-        if cmd == "templates":
-            logger.info("Using azurecc version %s", version.get_version())
-            provider.templates()
-        elif cmd == "create_machines":
-            provider.create_machines(input_json)
-        elif cmd in ["create_status"]:
-            if "requests" in input_json:
-                # provider.status handles both create_status and terminate_status calls.
-                provider.status(input_json)
-            else:
-                # should be impossible
-                raise RuntimeError("Unexpected input json for cmd %s" % (input_json, cmd))
-        elif cmd == "get_return_requests":
-            provider.get_return_requests(input_json)
-        elif cmd == "terminate_machines":
-            provider.terminate_machines(input_json)
-        elif cmd == "debug_completed_nodes":
-            provider.debug_completed_nodes()
-        
-
-        
-        # best effort cleanup.
-        provider.periodic_cleanup()
+        metrics.set_command(cmd)
+        with profiler.profile(provider_config, cmd, operation_id, logger):
+            run_command(provider, cmd, input_json)
+            
+            # best effort cleanup.
+            if cmd not in BACKGROUND_COMMANDS:
+                provider.periodic_cleanup()
+        logger.debug("CycleCloud connections: %s", provider.cluster.connection_stats())
             
     except ImportError as e:
         logger.exception(str(e))
@@ -1052,6 +1568,9 @@ def main(argv=sys.argv):  # pragma: no cover
         logger.warning("Exiting Non-zero so that symphony will retry")
         sys.exit(1) 
     finally: 
+        # failed commands, including those that sys.exit, are measured too
+        if provider_config is not None:
+            metrics.flush(provider_config, logger)
         logger.info("END %s %s - %s %s", operation_id, cmd, ignore, input_json_path)       
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+'''
+Incremental parsing of large JSON responses.
+
+The /clusters/{name}/nodes listing is an object whose "nodes" array holds one large object per node. Parsing
+it with json.loads needs the whole body as a string plus the whole tree in memory. iter_array() instead
+decodes the array items one at a time from the chunks of a streamed response, so only the current chunk and
+the current item are held, however many nodes the cluster has.
+'''
+import codecs
+import json
+
+
+class _Reader:
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        '''Appends the next chunk to the buffer. Returns False at the end of the input.'''
+        if self.eof:
+            return False
+        # drop what has been consumed, so the buffer never holds more than a chunk and an item
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        for chunk in self.chunks:
+            if not chunk:
+                continue
+            text = self.decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+            if text:
+                self.buffer += text
+                return True
+        self.buffer += self.decoder.decode(b"", final=True)
+        self.eof = True
+        return False
+
+    def peek(self):
+        '''The next non whitespace character, without consuming it, or None at the end of the input.'''
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return None
+
+    def expect(self, chars):
+        c = self.peek()
+        if c is None or c not in chars:
+            raise ValueError("Expected one of %r at offset %d but found %r" % (chars, self.pos, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        '''Decodes the next complete JSON value, reading more input until it is complete.'''
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and not self.eof and isinstance(value, (int, float)):
+                if self._fill():
+                    continue
+            self.pos = end
+            return value
+
+
+def iter_array(chunks, key):
+    '''
+    Yields the items of the array under key in the top level JSON object streamed as chunks (bytes or str).
+    Other top level values are parsed and skipped. Raises ValueError for malformed input or a missing key.
+    '''
+    reader = _Reader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        raise ValueError("No %s in response" % key)
+    while True:
+        name = reader.value()
+        reader.expect(":")
+        if name != key:
+            reader.value()
+        else:
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(",]") == "]":
+                        break
+            return
+        if reader.expect(",}") == "}":
+            raise ValueError("No %s in response" % key)
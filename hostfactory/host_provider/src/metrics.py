@@ -0,0 +1,308 @@
+'''
+Lightweight, dependency free metrics for the provider.
+
+Each invocation records lock wait/hold times and similar latencies into histograms in the process wide
+METRICS registry, and times the hot paths (REST calls, scalelib calls, store writes, hostname resolution,
+allocation phases) with span(). At the end of the invocation the spans are logged in one summary line.
+
+Nothing is written to disk unless asked for, since that is a locked read and rewrite of a shared file on every
+call. When symphony.hostfactory.metrics_file is set, everything is merged into that JSON file, in total and per
+command, so that the numbers accumulate across the many short-lived HostFactory calls. When
+symphony.hostfactory.metrics_prometheus_file is set, the per command totals are also written there in the
+Prometheus text format, for node_exporter's textfile collector; without a metrics_file the totals are kept
+next to it in <metrics_prometheus_file>.json.
+'''
+import bisect
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+
+
+# seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180, 600)
+
+
+class Histogram:
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = list(bounds)
+        # the last count is for values above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        if other.bounds != self.bounds:
+            raise ValueError("Can not merge histograms with different buckets")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        '''
+        Upper bound of the bucket that holds the q-th quantile, or max for the overflow bucket.
+        '''
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"bounds": self.bounds, "counts": self.counts, "count": self.count,
+                "sum": self.sum, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, d):
+        ret = cls(d["bounds"])
+        ret.counts = list(d["counts"])
+        ret.count = d["count"]
+        ret.sum = d["sum"]
+        ret.max = d.get("max", 0.0)
+        return ret
+
+    def __str__(self):
+        return "count=%d sum=%.3f p50=%.3f p99=%.3f max=%.3f" % (self.count, self.sum, self.quantile(0.5),
+                                                                 self.quantile(0.99), self.max)
+
+
+SPAN_PREFIX = "span."
+# observations made before set_command are filed under this command
+OTHER_COMMAND = "other"
+
+
+class Metrics:
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.command = None
+        self._lock = threading.Lock()
+
+    def observe(self, name, value):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+            self.command = None
+
+    def to_dict(self):
+        with self._lock:
+            return {"histograms": {k: v.to_dict() for k, v in self.histograms.items()},
+                    "counters": dict(self.counters)}
+
+    def merge(self, d):
+        with self._lock:
+            for name, hist in d.get("histograms", {}).items():
+                other = Histogram.from_dict(hist)
+                if name in self.histograms and self.histograms[name].bounds == other.bounds:
+                    self.histograms[name].merge(other)
+                else:
+                    self.histograms[name] = other
+            for name, value in d.get("counters", {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        with self._lock:
+            parts = ["%s(%s)" % (name, self.histograms[name]) for name in sorted(self.histograms)]
+            parts.extend(["%s=%s" % (name, self.counters[name]) for name in sorted(self.counters)])
+        return ", ".join(parts)
+
+    def span_summary(self):
+        '''
+        One line with the count and total time of every span, slowest first.
+        '''
+        with self._lock:
+            spans = [(name[len(SPAN_PREFIX):], hist) for name, hist in self.histograms.items() if name.startswith(SPAN_PREFIX)]
+        spans.sort(key=lambda x: -x[1].sum)
+        return " ".join(["%s=%dx/%.3fs" % (name, hist.count, hist.sum) for name, hist in spans])
+
+    def flush(self, path, lock_timeout=5, prometheus_path=None):
+        '''
+        Adds what this process recorded to the totals in path, in total and under its command, and resets
+        the in-memory metrics. With prometheus_path, the per command totals are also written there.
+        '''
+        from util import FileLease
+
+        if not self.histograms and not self.counters:
+            return
+        recorded = self.to_dict()
+        with FileLease(path + ".lock", timeout=lock_timeout):
+            raw = {}
+            try:
+                with open(path) as fr:
+                    raw = json.load(fr)
+            except (IOError, ValueError):
+                pass
+            totals = Metrics()
+            totals.merge(raw)
+            totals.merge(recorded)
+            by_command = {}
+            for command, d in raw.get("commands", {}).items():
+                by_command[command] = Metrics()
+                by_command[command].merge(d)
+            by_command.setdefault(self.command or OTHER_COMMAND, Metrics()).merge(recorded)
+
+            ret = totals.to_dict()
+            ret["commands"] = {command: m.to_dict() for command, m in by_command.items()}
+            _write_atomically(path, json.dumps(ret, sort_keys=True))
+            if prometheus_path:
+                _write_atomically(prometheus_path, to_prometheus(by_command))
+        self.reset()
+
+
+def _write_atomically(path, content):
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as fw:
+        fw.write(content)
+    os.replace(tmp_path, path)
+
+
+def _metric_name(name):
+    return "azurecc_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    return "{%s}" % ",".join(['%s="%s"' % (k, _label_value(v)) for k, v in labels])
+
+
+def to_prometheus(by_command):
+    '''
+    Renders {command: Metrics} in the Prometheus text exposition format. Spans become the
+    azurecc_span_seconds histogram, labeled by span, other histograms azurecc_<name>_seconds and counters
+    azurecc_<name>_total, all labeled by command.
+    '''
+    families = {}
+
+    def _family(name, kind):
+        if name not in families:
+            families[name] = (kind, [])
+        return families[name][1]
+
+    for command in sorted(by_command):
+        m = by_command[command]
+        for name in sorted(m.histograms):
+            hist = m.histograms[name]
+            if name.startswith(SPAN_PREFIX):
+                family = "azurecc_span_seconds"
+                labels = [("command", command), ("span", name[len(SPAN_PREFIX):])]
+            else:
+                family = _metric_name(name) + "_seconds"
+                labels = [("command", command)]
+            lines = _family(family, "histogram")
+            cumulative = 0
+            for bound, count in zip(hist.bounds, hist.counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (family, _format_labels(labels + [("le", repr(float(bound)))]), cumulative))
+            lines.append("%s_bucket%s %d" % (family, _format_labels(labels + [("le", "+Inf")]), hist.count))
+            lines.append("%s_sum%s %r" % (family, _format_labels(labels), float(hist.sum)))
+            lines.append("%s_count%s %d" % (family, _format_labels(labels), hist.count))
+        for name in sorted(m.counters):
+            family = _metric_name(name) + "_total"
+            _family(family, "counter").append("%s%s %r" % (family, _format_labels([("command", command)]), m.counters[name]))
+
+    out = []
+    for family in sorted(families):
+        kind, lines = families[family]
+        out.append("# TYPE %s %s" % (family, kind))
+        out.extend(lines)
+    return "\n".join(out) + "\n"
+
+
+METRICS = Metrics()
+
+
+def observe(name, value):
+    METRICS.observe(name, value)
+
+
+def increment(name, value=1):
+    METRICS.increment(name, value)
+
+
+def set_command(command):
+    METRICS.command = command
+
+
+class span(contextlib.ContextDecorator):
+    '''
+    Times a block, or every call of a decorated function, into the span.<name> histogram.
+
+        with metrics.span("cluster.get"):
+            ...
+    '''
+
+    def __init__(self, name):
+        self.name = SPAN_PREFIX + name
+        self.started = None
+
+    def _recreate_cm(self):
+        # a decorated function may run on several threads at once
+        return span(self.name[len(SPAN_PREFIX):])
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        observe(self.name, time.perf_counter() - self.started)
+
+
+def metrics_paths(provider_config):
+    '''
+    (path of the merged JSON totals, path of the Prometheus textfile), either of them None when it is not configured.
+    '''
+    path = provider_config.get("symphony.hostfactory.metrics_file") or None
+    prometheus_path = provider_config.get("symphony.hostfactory.metrics_prometheus_file") or None
+    if prometheus_path and not path:
+        path = prometheus_path + ".json"
+    return path, prometheus_path
+
+
+def flush(provider_config, logger):
+    '''
+    Best effort: logs this invocation's metrics and, when configured, merges them into the metrics files.
+    '''
+    if not METRICS.histograms and not METRICS.counters:
+        return
+    spans = METRICS.span_summary()
+    if spans:
+        logger.info("Timings for %s: %s", METRICS.command or OTHER_COMMAND, spans)
+    logger.debug("Metrics: %s", METRICS.summary())
+    path, prometheus_path = metrics_paths(provider_config)
+    if not path:
+        METRICS.reset()
+        return
+    try:
+        METRICS.flush(path, prometheus_path=prometheus_path)
+    except Exception:
+        logger.exception("Could not write metrics to %s", path)
+        METRICS.reset()
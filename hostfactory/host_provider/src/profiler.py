@@ -0,0 +1,240 @@
+'''
+Opt-in profiling of provider commands.
+
+Enabled with AZURECC_PROFILE=1 in the environment or symphony.hostfactory.profile.enabled in the provider
+config. Each profiled command (together with the periodic_cleanup that follows it) writes two files to
+symphony.hostfactory.profile.dir, by default $HF_LOGDIR/profiles:
+
+    <time>_<operation id>_<pid>_<command>.pstats     cProfile output, for pstats/snakeviz
+    <time>_<operation id>_<pid>_<command>.collapsed  sampled stacks, "frame;frame;frame count" per line, for
+                                                     flamegraph.pl or speedscope
+
+Only the newest symphony.hostfactory.profile.max_files profiles (default 200) younger than
+symphony.hostfactory.profile.max_age_days (default 7) are kept. To find the hotspots across many runs:
+
+    python profiler.py [--dir $HF_LOGDIR/profiles] [--command create_status] [--top 25]
+                       [--sort cumulative|tottime] [--collapsed merged.collapsed]
+'''
+import collections
+import contextlib
+import glob
+import os
+import re
+import sys
+import threading
+import time
+
+
+# cProfile and pstats are imported when used, profiling is off for almost every invocation
+ENV_SWITCH = "AZURECC_PROFILE"
+
+
+def _truthy(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def default_profile_dir():
+    log_dir = os.getenv("HF_LOGDIR") or os.getenv("PRO_LOG_DIR") or os.getcwd()
+    return os.path.join(log_dir, "profiles")
+
+
+def is_enabled(provider_config):
+    if os.getenv(ENV_SWITCH):
+        return _truthy(os.getenv(ENV_SWITCH))
+    return _truthy(provider_config.get("symphony.hostfactory.profile.enabled", False))
+
+
+class StackSampler:
+    '''
+    Samples the stack of one thread every interval seconds from a background thread and counts the
+    collapsed stacks, root first.
+    '''
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="azurecc-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s:%s:%d" % (os.path.basename(code.co_filename), code.co_name, code.co_firstlineno))
+                frame = frame.f_back
+            self.counts[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w") as fw:
+            for stack, count in self.counts.most_common():
+                fw.write("%s %d\n" % (stack, count))
+
+
+class Profiler:
+
+    def __init__(self, directory, command, operation_id=None, sample_interval=0.005, max_files=200,
+                 max_age_days=7, logger=None):
+        self.directory = directory
+        self.command = re.sub(r"[^A-Za-z0-9_.-]", "_", command or "unknown")
+        self.operation_id = operation_id or int(time.time())
+        self.sample_interval = sample_interval
+        self.max_files = max_files
+        self.max_age_days = max_age_days
+        self.logger = logger
+        self.profile = None
+        self.sampler = None
+        self.base_path = None
+
+    def __enter__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), self.sample_interval)
+        self.sampler.start()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *args):
+        self.profile.disable()
+        self.sampler.stop()
+        try:
+            self.write()
+        except Exception:
+            if self.logger:
+                self.logger.exception("Could not write profile for %s to %s", self.command, self.directory)
+
+    def write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.base_path = os.path.join(self.directory, "%s_%s_%d_%s" % (time.strftime("%Y%m%d%H%M%S"), self.operation_id,
+                                                                       os.getpid(), self.command))
+        self.profile.dump_stats(self.base_path + ".pstats")
+        self.sampler.write(self.base_path + ".collapsed")
+        if self.logger:
+            self.logger.info("Wrote profile %s.{pstats,collapsed}", self.base_path)
+        prune(self.directory, self.max_files, self.max_age_days)
+
+
+def profile_files(directory, command=None):
+    '''
+    The .pstats files in directory, oldest first, optionally only those of command.
+    '''
+    paths = glob.glob(os.path.join(directory, "*.pstats"))
+    if command:
+        # <time>_<operation id>_<pid>_<command>, and commands have underscores of their own
+        paths = [p for p in paths if os.path.basename(p)[:-len(".pstats")].split("_", 3)[-1] == command]
+    return sorted(paths)
+
+
+def prune(directory, max_files=200, max_age_days=7):
+    '''
+    Removes profiles beyond the newest max_files and those older than max_age_days.
+    '''
+    paths = profile_files(directory)
+    cutoff = time.time() - max_age_days * 86400 if max_age_days else None
+    to_remove = paths[:-max_files] if max_files and len(paths) > max_files else []
+    if cutoff:
+        for path in paths:
+            try:
+                if os.path.getmtime(path) < cutoff and path not in to_remove:
+                    to_remove.append(path)
+            except OSError:
+                pass
+    for path in to_remove:
+        for p in [path, path[:-len(".pstats")] + ".collapsed"]:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+    return len(to_remove)
+
+
+def profile(provider_config, command, operation_id=None, logger=None):
+    '''
+    A Profiler for command when profiling is enabled, otherwise a context manager that does nothing.
+    '''
+    if not is_enabled(provider_config):
+        return contextlib.nullcontext()
+    return Profiler(provider_config.get("symphony.hostfactory.profile.dir", default_profile_dir()),
+                    command,
+                    operation_id,
+                    sample_interval=float(provider_config.get("symphony.hostfactory.profile.sample_interval", 0.005)),
+                    max_files=int(provider_config.get("symphony.hostfactory.profile.max_files", 200)),
+                    max_age_days=float(provider_config.get("symphony.hostfactory.profile.max_age_days", 7)),
+                    logger=logger)
+
+
+def aggregate(directory, command=None, top=25, sort="cumulative", collapsed_path=None, out=None):
+    '''
+    Prints the top functions over all matching profiles and optionally merges their sampled stacks.
+    Returns the number of profiles read.
+    '''
+    import pstats
+    out = out or sys.stdout
+    paths = profile_files(directory, command)
+    if not paths:
+        print("No profiles found in %s" % directory, file=out)
+        return 0
+
+    stats = None
+    for path in paths:
+        try:
+            if stats is None:
+                stats = pstats.Stats(path, stream=out)
+            else:
+                stats.add(path)
+        except Exception as e:
+            print("Skipping %s: %s" % (path, e), file=out)
+    if stats is None:
+        return 0
+
+    print("%d profiles%s in %s" % (len(paths), " of %s" % command if command else "", directory), file=out)
+    stats.sort_stats(sort).print_stats(top)
+
+    if collapsed_path:
+        counts = collections.Counter()
+        for path in paths:
+            try:
+                with open(path[:-len(".pstats")] + ".collapsed") as fr:
+                    for line in fr:
+                        stack, _, count = line.rstrip("\n").rpartition(" ")
+                        if stack:
+                            counts[stack] += int(count)
+            except (IOError, ValueError):
+                continue
+        with open(collapsed_path, "w") as fw:
+            for stack, count in counts.most_common():
+                fw.write("%s %d\n" % (stack, count))
+        print("Wrote merged stacks to %s" % collapsed_path, file=out)
+    return len(paths)
+
+
+def main(argv=sys.argv):  # pragma: no cover
+    import argparse
+    parser = argparse.ArgumentParser(description="Aggregate the hotspots of azurecc provider profiles")
+    parser.add_argument("--dir", default=default_profile_dir())
+    parser.add_argument("--command", help="only profiles of this command, e.g. create_status")
+    parser.add_argument("--top", type=int, default=25)
+    parser.add_argument("--sort", default="cumulative", choices=["cumulative", "tottime", "ncalls"])
+    parser.add_argument("--collapsed", help="also merge the sampled stacks into this file")
+    args = parser.parse_args(argv[1:])
+    if not aggregate(args.dir, args.command, args.top, args.sort, args.collapsed):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
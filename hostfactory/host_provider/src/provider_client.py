@@ -0,0 +1,118 @@
+'''
+Thin client for the azurecc provider daemon (see provider_daemon.py).
+
+This module is invoked for every HostFactory script when the daemon socket exists, so it must only
+import the standard library. If the daemon is not accepting connections we exit with DAEMON_UNAVAILABLE
+and invoke_provider.sh falls back to running cyclecloud_provider directly.
+'''
+import json
+import os
+import socket
+import sys
+
+
+DEFAULT_SOCKET_NAME = "azurecc_provider.sock"
+
+# EX_TEMPFAIL - tells invoke_provider.sh to fall back to the one-shot provider.
+DAEMON_UNAVAILABLE = 75
+
+# The daemon runs one command at a time, so commands that can take minutes (a bootup, or the wait of
+# symphony.hostfactory.coalesce_window) run as one-shot processes instead of holding up every status call.
+# Override with a comma separated AZURECC_DAEMON_ONESHOT_COMMANDS.
+DEFAULT_ONESHOT_COMMANDS = ["create_machines"]
+
+# The daemon only runs a command for a caller with the same provider directories as its own.
+FORWARDED_ENV = ["PRO_CONF_DIR", "PRO_DATA_DIR"]
+
+
+def default_socket_path():
+    socket_path = os.getenv("AZURECC_DAEMON_SOCKET")
+    if socket_path:
+        return socket_path
+    return os.path.join(os.getenv("PRO_DATA_DIR", os.getcwd()), DEFAULT_SOCKET_NAME)
+
+
+def oneshot_commands():
+    value = os.getenv("AZURECC_DAEMON_ONESHOT_COMMANDS")
+    if value is None:
+        return list(DEFAULT_ONESHOT_COMMANDS)
+    return [cmd.strip() for cmd in value.split(",") if cmd.strip()]
+
+
+def caller_environment():
+    return {key: os.getenv(key) for key in FORWARDED_ENV}
+
+
+def absolute_argv(argv):
+    # the daemon has its own working directory, so input files are sent as absolute paths
+    argv = list(argv)
+    for i in range(len(argv) - 1):
+        if argv[i] == "-f":
+            argv[i + 1] = os.path.abspath(argv[i + 1])
+    return argv
+
+
+def send_message(sock, message):
+    sock.sendall(json.dumps(message).encode() + b"\n")
+
+
+def recv_message(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b"\n"):
+            break
+    data = b"".join(chunks)
+    if not data:
+        raise EOFError("Connection closed before a message was received")
+    return json.loads(data.decode())
+
+
+def invoke(argv, socket_path=None, connect_timeout=None, timeout=None):
+    '''
+    Runs one provider command on the daemon. Returns (exit_code, stdout), or (DAEMON_UNAVAILABLE, "")
+    if we could not connect or the command is one of the one-shot commands. Once the command has been sent we
+    only report DAEMON_UNAVAILABLE when the daemon says it did not run it.
+    '''
+    socket_path = socket_path or default_socket_path()
+    connect_timeout = connect_timeout or float(os.getenv("AZURECC_DAEMON_CONNECT_TIMEOUT", 2))
+    timeout = timeout or float(os.getenv("AZURECC_DAEMON_TIMEOUT", 600))
+
+    if not os.path.exists(socket_path):
+        return DAEMON_UNAVAILABLE, ""
+    if argv and argv[0] in oneshot_commands():
+        return DAEMON_UNAVAILABLE, ""
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(connect_timeout)
+        try:
+            sock.connect(socket_path)
+        except (OSError, socket.timeout):
+            return DAEMON_UNAVAILABLE, ""
+
+        sock.settimeout(timeout)
+        send_message(sock, {"argv": absolute_argv(argv), "env": caller_environment()})
+        response = recv_message(sock)
+        return int(response.get("exit_code", 1)), response.get("stdout", "")
+    finally:
+        sock.close()
+
+
+def main(argv=sys.argv):  # pragma: no cover
+    try:
+        exit_code, stdout = invoke(argv[1:])
+    except Exception as e:
+        print("azurecc daemon request failed: %s" % e, file=sys.stderr)
+        sys.exit(1)
+    if stdout:
+        sys.stdout.write(stdout)
+        sys.stdout.flush()
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
@@ -0,0 +1,264 @@
+'''
+Optional long-lived azurecc provider.
+
+Every HostFactory script normally starts a fresh python process that imports scalelib, parses the provider
+config and builds a CycleCloudProvider before doing any work. The daemon does all of that once and then
+serves the commands of cyclecloud_provider.main() over a local unix socket, one at a time, so that the
+behavior (and the store locking) is the same as the one-shot mode. The stores and leases are lockf locks,
+which do not exclude threads of one process, so commands are not run concurrently here. Instead commands
+that can take minutes, like create_machines, are left to one-shot processes (see
+provider_client.oneshot_commands) and do not hold up the status calls queued behind them.
+provider_client.py is the matching client; invoke_provider.sh falls back to the one-shot provider whenever
+the daemon is not running, or declines a command.
+
+    python -m provider_daemon [--socket /path/to/azurecc_provider.sock]
+'''
+import argparse
+import contextlib
+import io
+import os
+import signal
+import socket
+import sys
+import time
+
+from provider_client import (DAEMON_UNAVAILABLE, caller_environment, default_socket_path, oneshot_commands,
+                             recv_message, send_message)
+
+
+class ProviderCommandRunner:
+    '''
+    Runs main() commands against a single CycleCloudProvider. The provider is rebuilt when the provider
+    config changes on disk, and the cluster state is reloaded for every command so that each command sees
+    the current state of CycleCloud, just like a fresh process would.
+    '''
+
+    def __init__(self, pro_conf_dir=None):
+        self.pro_conf_dir = pro_conf_dir or os.getenv('PRO_CONF_DIR', os.getcwd())
+        self.provider = None
+        self.config_mtimes = None
+        self.logger = None
+
+    def _config_mtimes(self):
+        import util
+        mtimes = []
+        for path in util.provider_config_files(self.pro_conf_dir):
+            try:
+                mtimes.append(os.path.getmtime(path))
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def warm_up(self):
+        self._provider()
+        # the one-shot provider defers these until a command needs them, the daemon can load them up front.
+        import cluster  # noqa: F401
+
+    def _provider(self):
+        import cyclecloud_provider
+        import util
+
+        mtimes = self._config_mtimes()
+        if self.provider is None or mtimes != self.config_mtimes:
+            provider_config, logger, fine = util.provider_config_from_environment(self.pro_conf_dir)
+            cyclecloud_provider.logger = self.logger = logger
+            if self.provider is not None:
+                logger.info("Provider config changed, reloading")
+            self.provider = cyclecloud_provider.new_provider(provider_config, fine)
+            self.config_mtimes = mtimes
+        else:
+            # keeps the pooled http session, but reloads cluster state
+            self.provider.cluster.refresh()
+
+        self.provider.stdout_handler = cyclecloud_provider.JsonOutputHandler(quiet=False)
+        self.provider.dry_run = False
+        return self.provider
+
+    def __call__(self, argv):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            try:
+                exit_code = self._run(argv)
+            except SystemExit as se:
+                exit_code = se.code if isinstance(se.code, int) else (0 if se.code is None else 1)
+        return exit_code, stdout.getvalue()
+
+    def _run(self, argv):
+        import cyclecloud_provider
+        import metrics
+        import profiler
+        import util
+
+        # every command has the format cmd -f input.json
+        cmd, ignore, input_json_path = argv
+        operation_id = int(time.time())
+        provider = None
+        # the metrics are process wide, so nothing recorded outside of a command may be counted against this one
+        metrics.METRICS.reset()
+        metrics.set_command(cmd)
+        try:
+            provider = self._provider()
+            input_json = util.load_json(input_json_path)
+
+            self.logger.info("BEGIN %s %s - %s %s (daemon)", operation_id, cmd, ignore, input_json_path)
+            with profiler.profile(provider.config, cmd, operation_id, self.logger):
+                cyclecloud_provider.run_command(provider, cmd, input_json)
+
+                # best effort cleanup.
+                provider.periodic_cleanup()
+            self.logger.debug("CycleCloud connections: %s", provider.cluster.connection_stats())
+            return 0
+        except Exception as e:
+            logger = self.logger or util.init_logging()
+            logger.exception(str(e))
+            logger.warning("Exiting Non-zero so that symphony will retry")
+            return 1
+        finally:
+            # failed commands, including those that sys.exit, are measured too
+            if provider is not None:
+                metrics.flush(provider.config, self.logger)
+            else:
+                metrics.METRICS.reset()
+            if self.logger:
+                self.logger.info("END %s %s - %s %s (daemon)", operation_id, cmd, ignore, input_json_path)
+
+
+class ProviderDaemon:
+
+    def __init__(self, socket_path, handler, logger=None, request_timeout=60, environment=None, oneshot=None):
+        self.socket_path = socket_path
+        self.handler = handler
+        self.logger = logger
+        self.request_timeout = request_timeout
+        # the PRO_CONF_DIR and PRO_DATA_DIR the handler was built for
+        self.environment = environment if environment is not None else caller_environment()
+        self.oneshot = oneshot if oneshot is not None else oneshot_commands()
+        self.server = None
+        self.stopped = False
+
+    def bind(self):
+        if os.path.exists(self.socket_path):
+            if self._is_listening():
+                raise RuntimeError("A provider daemon is already listening on %s" % self.socket_path)
+            # left behind by a daemon that did not exit cleanly
+            os.unlink(self.socket_path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only the user running HostFactory may talk to the daemon
+        old_umask = os.umask(0o177)
+        try:
+            self.server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        self.server.listen(64)
+        # so that stop() is noticed without a new connection
+        self.server.settimeout(1.0)
+
+    def _is_listening(self):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.settimeout(1)
+            probe.connect(self.socket_path)
+            return True
+        except OSError:
+            return False
+        finally:
+            probe.close()
+
+    def serve_forever(self):
+        if not self.server:
+            self.bind()
+        try:
+            while not self.stopped:
+                try:
+                    conn, _ = self.server.accept()
+                except socket.timeout:
+                    continue
+                with conn:
+                    self.handle_connection(conn)
+        finally:
+            self.close()
+
+    def handle_connection(self, conn):
+        conn.settimeout(self.request_timeout)
+        try:
+            request = recv_message(conn)
+        except Exception:
+            self._log_exception("Could not read request from client")
+            return
+
+        declined = self._decline_reason(request)
+        if declined:
+            if self.logger:
+                self.logger.info("Not running %s in the daemon: %s", request.get("argv"), declined)
+            try:
+                send_message(conn, {"exit_code": DAEMON_UNAVAILABLE, "stdout": ""})
+            except OSError:
+                self._log_exception("Could not send response for %s" % request.get("argv"))
+            return
+
+        try:
+            exit_code, stdout = self.handler(request["argv"])
+        except Exception:
+            self._log_exception("Unhandled error running %s" % request.get("argv"))
+            exit_code, stdout = 1, ""
+
+        try:
+            send_message(conn, {"exit_code": exit_code, "stdout": stdout})
+        except OSError:
+            self._log_exception("Could not send response for %s" % request.get("argv"))
+
+    def _decline_reason(self, request):
+        # the client falls back to the one-shot provider, which runs in the caller's own environment
+        argv = request.get("argv") or []
+        if argv and argv[0] in self.oneshot:
+            return "%s runs as a one-shot command" % argv[0]
+        for key, value in (request.get("env") or {}).items():
+            expected = self.environment.get(key)
+            if value and expected:
+                same = os.path.realpath(value) == os.path.realpath(expected)
+            else:
+                same = not value and not expected
+            if not same:
+                return "%s is %s for the caller but %s for the daemon" % (key, value, expected)
+        return None
+
+    def stop(self):
+        self.stopped = True
+
+    def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def _log_exception(self, message):
+        if self.logger:
+            self.logger.exception(message)
+
+
+def main(argv=sys.argv):  # pragma: no cover
+    parser = argparse.ArgumentParser(description="Long-lived azurecc HostFactory provider")
+    parser.add_argument("--socket", default=default_socket_path())
+    args = parser.parse_args(argv[1:])
+
+    runner = ProviderCommandRunner()
+    runner.warm_up()
+    daemon = ProviderDaemon(args.socket, runner, runner.logger)
+
+    def _stop(signum, frame):
+        daemon.stop()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    runner.logger.info("Provider daemon listening on %s", args.socket)
+    daemon.serve_forever()
+    runner.logger.info("Provider daemon stopped")
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
@@ -1,6 +1,6 @@
 import os
 import calendar
-from util import JsonStore, init_logging
+from util import init_logging, new_store
 
 
 class RequestTrackingDb:
@@ -15,7 +15,9 @@ class RequestTrackingDb:
 
         default_dir = os.getenv('HF_WORKDIR', '/var/tmp')
         self.db_dir = config.get('symphony.hostfactory.db_path', default_dir)
-        self.requests_db = JsonStore('azurecc_requests.json', self.db_dir)
+        self.requests_db = new_store('azurecc_requests.json', self.db_dir,
+                                     config.get('symphony.hostfactory.store_backend', 'json'),
+                                     lock_timeout=float(config.get('symphony.hostfactory.lock_timeout', 180)))
 
 
     def reset(self):
@@ -48,7 +50,13 @@ class RequestTrackingDb:
                 pending_requests.pop(request_id)
 
     def request_completed(self, request_status):
-        request_id = request_status["requestId"]
-        request_envelope = self.get_request(request_id)
-        if request_envelope:
-            self.remove_request(request_id)   
\ No newline at end of file
+        self.requests_completed([request_status["requestId"]])
+
+    def requests_completed(self, request_ids):
+        # only take the lock and rewrite the db when one of them is still tracked
+        pending_requests = self.get_requests()
+        if not any(request_id in pending_requests for request_id in request_ids):
+            return
+        with self.requests_db as pending_requests:
+            for request_id in request_ids:
+                pending_requests.pop(request_id, None)   
\ No newline at end of file
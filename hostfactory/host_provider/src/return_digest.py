@@ -0,0 +1,85 @@
+'''
+Per node digest that get_return_requests keeps between polls.
+
+Symphony asks for return requests every few seconds and between two polls almost no node changes. With
+symphony.hostfactory.return_digest.enabled the provider stores, for every autoscaled node, the status,
+hostname and private ip it last saw, the hostname it resolved, when the status last changed and when a
+shutdown for a failed node was last accepted. On the next poll only nodes whose status, hostname or ip
+differ from their entry are classified and resolved again, and a failed node is only shut down again once
+symphony.hostfactory.return_digest.shutdown_retry seconds (default 300) passed and it is still failed.
+
+The digest is only a cache of derived values. When it is missing, unreadable, written for another cluster
+or older than symphony.hostfactory.return_digest.max_age seconds (default 600) it is ignored and every node
+is processed as before.
+'''
+import json
+import logging
+import os
+import re
+import time
+
+
+# entry layout, kept as a list so that large clusters stay small on disk
+STATUS, RAW_HOSTNAME, PRIVATE_IP, HOSTNAME, LAST_CHANGE, SHUTDOWN = range(6)
+
+
+class ReturnDigest:
+
+    VERSION = 1
+
+    def __init__(self, cluster_name, directory, max_age=600, shutdown_retry=300, clock=time.time, logger=None):
+        self.cluster_name = cluster_name
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", cluster_name or "cluster")
+        self.path = os.path.join(directory, "%s_return_digest.json" % safe_name)
+        self.max_age = float(max_age or 0)
+        self.shutdown_retry = float(shutdown_retry or 0)
+        self.clock = clock
+        self.logger = logger or logging.getLogger()
+
+    def load(self):
+        '''
+        The node entries by node id, or an empty dict when there is no usable digest.
+        '''
+        try:
+            with open(self.path) as fr:
+                digest = json.load(fr)
+        except IOError:
+            return {}
+        except ValueError:
+            self.logger.warning("Ignoring unreadable return digest %s", self.path)
+            return {}
+
+        if not isinstance(digest, dict) or digest.get("version") != self.VERSION or digest.get("cluster") != self.cluster_name:
+            return {}
+        age = self.clock() - digest.get("saved_at", 0)
+        if self.max_age and age > self.max_age:
+            self.logger.debug("Ignoring return digest %s, it is %.0fs old", self.path, age)
+            return {}
+        return digest.get("nodes") or {}
+
+    def shutdown_due(self, entry):
+        '''
+        True when the failed node of entry was never shut down, or its last shutdown was accepted shutdown_retry
+        seconds ago and it did not go away.
+        '''
+        shutdown_at = entry[SHUTDOWN]
+        if not shutdown_at:
+            return True
+        # digests written before the shutdown time was kept hold True
+        return self.clock() - float(shutdown_at) >= self.shutdown_retry
+
+    def shut_down(self, entry):
+        entry[SHUTDOWN] = self.clock()
+
+    def save(self, nodes):
+        digest = {"version": self.VERSION,
+                  "cluster": self.cluster_name,
+                  "saved_at": self.clock(),
+                  "nodes": nodes}
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as fw:
+                json.dump(digest, fw, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+        except IOError:
+            self.logger.exception("Could not write return digest %s", self.path)
@@ -0,0 +1,280 @@
+'''
+SQLite backed alternative to util.JsonStore.
+
+It has the same API: `with store as data:` locks the store and yields a dict that is saved when the block
+exits, and read() returns a copy without locking. Each top level key is a row, so saving only writes the
+rows that changed, and in WAL mode readers never wait for a writer. Select it with
+symphony.hostfactory.store_backend = "sqlite". An existing JSON store of the same name is imported the
+first time the store is opened and renamed to <name>.json.migrated.
+
+Inside a `with` block rows are fetched when a key is first used, and all rows only when the block iterates
+over the store, so a transaction that touches a few requests reads and writes only those. read() still loads
+every row, since it returns a snapshot.
+
+Every thread gets its own connection and its own `with` block state, so threads that share a store wait for
+each other's transactions like processes do. Rows are always stored as compact JSON, there is no formatted
+option. Connections use synchronous=NORMAL, which in WAL mode survives a crash of the process but can lose the
+last commits on power loss or an OS crash.
+'''
+import collections
+import collections.abc
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+from util import init_logging, load_json
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    request_time REAL,
+    last_update_time REAL,
+    completed INTEGER,
+    terminated INTEGER
+);
+CREATE INDEX IF NOT EXISTS entries_request_time ON entries(request_time);
+CREATE INDEX IF NOT EXISTS entries_last_update_time ON entries(last_update_time);
+CREATE INDEX IF NOT EXISTS entries_completed ON entries(completed);
+CREATE INDEX IF NOT EXISTS entries_terminated ON entries(terminated);
+'''
+
+
+def _dumps(value):
+    # same serialization as JsonStore, so unchanged entries compare equal
+    return json.dumps(value, sort_keys=True)
+
+
+def _loads(data):
+    return json.loads(data, object_pairs_hook=collections.OrderedDict)
+
+
+def _flag(value, key):
+    if not hasattr(value, "get") or value.get(key) is None:
+        return None
+    return 1 if value.get(key) else 0
+
+
+def _number(value, key):
+    if not hasattr(value, "get"):
+        return None
+    try:
+        return float(value.get(key))
+    except (TypeError, ValueError):
+        return None
+
+
+class _Entries(collections.abc.MutableMapping):
+    '''
+    The rows of a store inside one `with` block. A row is fetched and parsed when its key is first used, and
+    all rows when the block iterates. originals holds the stored JSON of the rows that were fetched and removed
+    the keys that were deleted, for SqliteStore.__exit__ to save only what changed.
+    '''
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._values = collections.OrderedDict()
+        self._missing = set()
+        self._all = False
+        self.originals = {}
+        self.removed = set()
+
+    def _fetch(self, key):
+        if key in self._values:
+            return True
+        if self._all or key in self._missing or key in self.removed:
+            return False
+        row = self._conn.execute("SELECT data FROM entries WHERE id = ?", (key,)).fetchone()
+        if row is None:
+            self._missing.add(key)
+            return False
+        self._values[key] = _loads(row[0])
+        self.originals[key] = row[0]
+        return True
+
+    def _load_all(self):
+        if self._all:
+            return
+        values = collections.OrderedDict()
+        for key, raw in self._conn.execute("SELECT id, data FROM entries ORDER BY id"):
+            if key in self.removed:
+                continue
+            if key in self._values:
+                values[key] = self._values[key]
+            else:
+                values[key] = _loads(raw)
+                self.originals[key] = raw
+        # keys added in this block
+        for key, value in self._values.items():
+            values.setdefault(key, value)
+        self._values = values
+        self._all = True
+
+    def changed(self):
+        return [(key, value) for key, value in self._values.items() if self.originals.get(key) != _dumps(value)]
+
+    def __getitem__(self, key):
+        if not self._fetch(key):
+            raise KeyError(key)
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        self._missing.discard(key)
+        self.removed.discard(key)
+
+    def __delitem__(self, key):
+        if not self._fetch(key):
+            raise KeyError(key)
+        del self._values[key]
+        self.removed.add(key)
+
+    def __contains__(self, key):
+        return self._fetch(key)
+
+    def __iter__(self):
+        self._load_all()
+        return iter(list(self._values))
+
+    def __len__(self):
+        self._load_all()
+        return len(self._values)
+
+    def clear(self):
+        self._load_all()
+        self.removed.update(self._values)
+        self._values.clear()
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class SqliteStore:
+
+    def __init__(self, name, directory, lock_timeout=180):
+        base_name = name[:-len(".json")] if name.endswith(".json") else name
+        self.json_path = os.path.join(directory, name)
+        self.path = os.path.join(directory, base_name + ".db")
+        self.lock_timeout = lock_timeout
+        self.metrics_name = "store." + name
+        self.logger = init_logging()
+        # the connection and the state of the open with block, per thread
+        self._local = threading.local()
+
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self._migrate()
+
+    @property
+    def _state(self):
+        state = self._local
+        if not hasattr(state, "conn"):
+            # isolation_level=None: we issue BEGIN/COMMIT ourselves
+            state.conn = sqlite3.connect(self.path, timeout=self.lock_timeout, isolation_level=None)
+            state.conn.execute("PRAGMA synchronous=NORMAL")
+            state.depth = 0
+            state.data = None
+            state.locked_at = None
+        return state
+
+    @property
+    def conn(self):
+        return self._state.conn
+
+    @property
+    def data(self):
+        return self._state.data
+
+    def _migrate(self):
+        if not os.path.exists(self.json_path):
+            return
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            # another process may have migrated it while we waited for the lock
+            if not os.path.exists(self.json_path):
+                self.conn.execute("COMMIT")
+                return
+            try:
+                data = load_json(self.json_path)
+            except Exception:
+                self.logger.exception("Could not migrate %s to %s", self.json_path, self.path)
+                self.conn.execute("ROLLBACK")
+                return
+            # the json file only exists if it was written after the last migration, so it wins.
+            self.conn.execute("DELETE FROM entries")
+            self._upsert(data.items())
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        os.replace(self.json_path, self.json_path + ".migrated")
+        self.logger.info("Migrated %d entries from %s to %s", len(data), self.json_path, self.path)
+
+    def _upsert(self, items):
+        self.conn.executemany("INSERT OR REPLACE INTO entries (id, data, request_time, last_update_time, completed, terminated) "
+                              "VALUES (?, ?, ?, ?, ?, ?)",
+                              [(key, _dumps(value), _number(value, "requestTime"), _number(value, "lastUpdateTime"),
+                                _flag(value, "completed"), _flag(value, "terminated"))
+                               for key, value in items])
+
+    def _load(self):
+        data = collections.OrderedDict()
+        for key, raw in self.conn.execute("SELECT id, data FROM entries ORDER BY id"):
+            data[key] = _loads(raw)
+        return data
+
+    def clear(self):
+        with self:
+            self.data.clear()
+
+    def read(self):
+        return self._load()
+
+    def write(self, data):
+        with self:
+            self.data.clear()
+            self.data.update(data)
+
+    def __enter__(self):
+        state = self._state
+        state.depth += 1
+        if state.depth > 1:
+            return state.data
+        started = time.time()
+        try:
+            # takes the write lock up front, like JsonStore's lock, so the read-modify-write is atomic
+            state.conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as e:
+            state.depth -= 1
+            raise RuntimeError("Could not get lock %s: %s" % (self.path, e))
+        state.locked_at = time.time()
+        metrics.observe(self.metrics_name + ".lock_wait", state.locked_at - started)
+        state.data = _Entries(state.conn)
+        return state.data
+
+    def __exit__(self, *args):
+        state = self._state
+        state.depth -= 1
+        if state.depth > 0:
+            return
+        try:
+            with metrics.span(self.metrics_name + ".write"):
+                changed = state.data.changed()
+                removed = [(key,) for key in state.data.removed]
+                if changed:
+                    self._upsert(changed)
+                if removed:
+                    state.conn.executemany("DELETE FROM entries WHERE id = ?", removed)
+                state.conn.execute("COMMIT")
+        except BaseException:
+            state.conn.execute("ROLLBACK")
+            raise
+        finally:
+            state.data = None
+            metrics.observe(self.metrics_name + ".lock_hold", time.time() - state.locked_at)
@@ -0,0 +1,124 @@
+'''
+Compiled form of azureccprov_templates.json.
+
+templates, create_machines and validate_templates all need the template file. TemplateIndex parses it once
+per file version, keeps the serialized templates response ready to print and a templateId -> vmTypes
+lookup. Indexes are cached in-process (for the daemon) and, when a cache directory is given, written to
+disk as json (the serialized response and the vmTypes lookup) so that a fresh process can skip parsing and
+serializing the file. Both caches are keyed by the mtime and size of the template file. The disk cache is
+plain data on purpose: loading it never runs code, even if someone else can write to the cache directory.
+'''
+import json
+import logging
+import os
+
+
+TEMPLATES_RESPONSE_MESSAGE = "Get available templates success."
+CACHE_NAME = "azureccprov_templates.index.json"
+# bump when the cached layout changes
+CACHE_VERSION = 1
+
+
+def templates_path(pro_conf_dir=None):
+    pro_conf_dir = pro_conf_dir or os.getenv('PRO_CONF_DIR', os.getcwd())
+    return os.path.join(pro_conf_dir, "conf", "azureccprov_templates.json")
+
+
+class TemplateIndex:
+
+    def __init__(self, templates_json, path=None, signature=None):
+        self.path = path
+        self.signature = signature
+        self._response = dict(templates_json)
+        self._response["message"] = TEMPLATES_RESPONSE_MESSAGE
+        self.serialized_response = json.dumps(self._response)
+
+        self.vm_types_by_id = {}
+        for template in templates_json.get("templates") or []:
+            # like a linear scan for the template, a duplicate templateId means the last one wins
+            self.vm_types_by_id[template["templateId"]] = template.get("vmTypes", {})
+
+    @classmethod
+    def from_cache(cls, cached, path, signature):
+        index = cls.__new__(cls)
+        index.path = path
+        index.signature = signature
+        # parsed again only if something asks for the templates themselves
+        index._response = None
+        index.serialized_response = cached["serializedResponse"]
+        index.vm_types_by_id = cached["vmTypes"]
+        return index
+
+    def to_cache(self):
+        return {"version": CACHE_VERSION, "path": self.path, "signature": list(self.signature),
+                "serializedResponse": self.serialized_response, "vmTypes": self.vm_types_by_id}
+
+    @property
+    def response(self):
+        if self._response is None:
+            self._response = json.loads(self.serialized_response)
+        return self._response
+
+    @property
+    def templates(self):
+        # None when the file has no templates list, which validate_template reports
+        return self.response.get("templates")
+
+    def vm_types(self, template_id):
+        return self.vm_types_by_id.get(template_id, {})
+
+
+_INDEXES = {}
+
+
+def _signature(path):
+    st = os.stat(path)
+    return (CACHE_VERSION, st.st_mtime_ns, st.st_size)
+
+
+def load(path, cache_dir=None, logger=None):
+    '''
+    Returns the TemplateIndex for the current contents of path. Raises the same errors as reading and
+    parsing the file would.
+    '''
+    try:
+        signature = _signature(path)
+    except OSError:
+        # can't tell when it changes, so parse it without caching (and fail the same way open would)
+        with open(path, 'r') as json_file:
+            return TemplateIndex(json.load(json_file), path)
+
+    index = _INDEXES.get(path)
+    if index is not None and index.signature == signature:
+        return index
+
+    cache_path = os.path.join(cache_dir, CACHE_NAME) if cache_dir else None
+    index = None
+    if cache_path:
+        try:
+            with open(cache_path, "r") as fr:
+                cached = json.load(fr)
+            if (cached.get("version") == CACHE_VERSION and cached.get("path") == path
+                    and tuple(cached.get("signature") or ()) == signature):
+                index = TemplateIndex.from_cache(cached, path, signature)
+        except Exception:
+            pass
+
+    if index is None:
+        with open(path, 'r') as json_file:
+            index = TemplateIndex(json.load(json_file), path, signature)
+        if cache_path:
+            _write_cache(cache_path, index, logger)
+
+    _INDEXES[path] = index
+    return index
+
+
+def _write_cache(cache_path, index, logger=None):
+    tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+    try:
+        with open(tmp_path, "w") as fw:
+            json.dump(index.to_cache(), fw)
+        os.replace(tmp_path, cache_path)
+    except Exception:
+        (logger or logging.getLogger()).warning("Could not write template index %s", cache_path)
@@ -0,0 +1,166 @@
+'''
+Durable queue of machines to shut down, shared by every provider process.
+
+With symphony.hostfactory.termination_queue.enabled, terminate_machines, the termination status and retry calls,
+get_return_requests and the create status shut down of failed nodes all enqueue machine ids here instead of
+calling CycleCloud themselves. A machine id is queued once while it waits, however many callers ask for it. Once
+its shutdown was accepted it is kept as done for a while, and asking for it again queues it again.
+
+One drainer at a time, inline in the producing call or in a detached drain_terminations process, takes the
+queued ids in batches of at most batch_size, waits min_interval seconds between calls, and records per id
+whether CycleCloud accepted the shutdown. Ids that failed are retried after retry_backoff seconds.
+
+Store layout, one top level key per machine so that the sqlite backend only rewrites the rows that changed:
+    {machine_id: {"name", "enqueuedAt", "attempts", "lastError", "nextAttempt", "completedAt"},
+     "__drainer__": {"lastCall": time of the last shutdown call}}
+A machine is queued while its completedAt is None.
+'''
+import logging
+import os
+import time
+
+import metrics
+import util
+
+
+DRAINER_KEY = "__drainer__"
+
+
+class TerminationQueue:
+
+    def __init__(self, store, directory, shutdown, batch_size=500, min_interval=0, retry_backoff=30,
+                 done_ttl=3600, clock=time.time, sleep=time.sleep, logger=None):
+        self.store = store
+        self.lock_path = os.path.join(directory, "termination_queue_drainer.lock")
+        # shutdown(machines) -> object with a failed dict of machine id -> error, see Cluster.shutdown_nodes
+        self.shutdown = shutdown
+        self.batch_size = max(1, int(batch_size))
+        self.min_interval = float(min_interval or 0)
+        self.retry_backoff = float(retry_backoff or 0)
+        self.done_ttl = float(done_ttl)
+        self.clock = clock
+        self.sleep = sleep
+        self.logger = logger or logging.getLogger()
+
+    def enqueue(self, machines, requested_at=None):
+        '''
+        Queues the machines that are not queued already, including done ones, e.g. a node that was started again
+        or is still failed after its shutdown. Returns how many were added.
+
+        requested_at maps machine ids to when their shutdown was first asked for, when this is a retry of that
+        request. A done machine whose shutdown was accepted since then is not queued again.
+        '''
+        now = self.clock()
+        requested_at = requested_at or {}
+        added = 0
+        with self.store as queue:
+            self._prune_done(queue, now)
+            for machine in machines:
+                machine_id = machine["machineId"]
+                entry = queue.get(machine_id)
+                if entry is not None and entry.get("completedAt") is None:
+                    continue
+                if entry is not None and machine_id in requested_at and entry["completedAt"] >= requested_at[machine_id]:
+                    continue
+                queue[machine_id] = {"name": machine.get("name", machine_id), "enqueuedAt": now, "attempts": 0,
+                                     "lastError": None, "nextAttempt": now, "completedAt": None}
+                added += 1
+        if added:
+            metrics.increment("termination_queue.enqueued", added)
+        return added
+
+    def pending(self, machine_ids):
+        '''
+        The ids that are still queued, with their last error, or "queued" when they were not attempted yet.
+        '''
+        queue = self.store.read()
+        pending = {}
+        for machine_id in machine_ids:
+            entry = queue.get(machine_id)
+            if entry and entry.get("completedAt") is None:
+                pending[machine_id] = entry.get("lastError") or "queued"
+        return pending
+
+    def drain(self, wait=False):
+        '''
+        Shuts down queued machines in batches until none is ready. Without wait the drain stops at the first
+        batch that min_interval does not allow yet, instead of sleeping, so that a HostFactory call is not held up.
+        Returns the number of shutdown calls made, or None when another process is already draining.
+        '''
+        try:
+            lease = util.FileLease(self.lock_path, timeout=0.001, metrics_name="termination_queue.drainer")
+            lease.__enter__()
+        except util.LockTimeout:
+            self.logger.debug("Another process is draining the termination queue")
+            return None
+
+        calls = 0
+        # each id is tried once per drain, so that ids that keep failing can not keep the drainer busy
+        attempted = set()
+        try:
+            while True:
+                batch = self._next_batch(wait, attempted)
+                if not batch:
+                    return calls
+                calls += 1
+                attempted.update(machine["machineId"] for machine in batch)
+                self._shutdown_batch(batch)
+        finally:
+            lease.__exit__(None, None, None)
+
+    def _next_batch(self, wait, attempted):
+        while True:
+            now = self.clock()
+            with self.store as queue:
+                ready = [(entry["nextAttempt"], machine_id) for machine_id, entry in queue.items()
+                         if machine_id != DRAINER_KEY and entry.get("completedAt") is None
+                         and entry["nextAttempt"] <= now and machine_id not in attempted]
+                if not ready:
+                    return []
+                drainer = queue.get(DRAINER_KEY) or {}
+                remaining = drainer.get("lastCall", 0) + self.min_interval - now
+                if remaining <= 0:
+                    queue[DRAINER_KEY] = {"lastCall": now}
+                    ready.sort(key=lambda r: r[0])
+                    return [{"machineId": machine_id, "name": queue[machine_id]["name"]}
+                            for _, machine_id in ready[:self.batch_size]]
+            if not wait:
+                self.logger.debug("Termination queue rate limited for another %.1fs", remaining)
+                return []
+            self.sleep(remaining)
+
+    def _shutdown_batch(self, batch):
+        try:
+            with metrics.span("termination_queue.shutdown"):
+                result = self.shutdown(batch)
+            failed = getattr(result, "failed", None)
+            failed = failed if isinstance(failed, dict) else {}
+        except Exception as e:
+            self.logger.exception("Could not shut down %d queued machines", len(batch))
+            failed = {machine["machineId"]: str(e) or type(e).__name__ for machine in batch}
+
+        now = self.clock()
+        with self.store as queue:
+            for machine in batch:
+                machine_id = machine["machineId"]
+                entry = queue.get(machine_id)
+                if entry is None:
+                    continue
+                entry["attempts"] += 1
+                if machine_id in failed:
+                    entry["lastError"] = failed[machine_id]
+                    entry["nextAttempt"] = now + self.retry_backoff
+                else:
+                    entry["lastError"] = None
+                    entry["completedAt"] = now
+        if failed:
+            metrics.increment("termination_queue.failed", len(failed))
+            self.logger.warning("%d of %d queued machines could not be shut down, retrying in %.0fs",
+                                len(failed), len(batch), self.retry_backoff)
+
+    def _prune_done(self, queue, now):
+        # done machines are kept for done_ttl, so that callers can still see that their shutdown was accepted
+        for machine_id in [machine_id for machine_id, entry in queue.items()
+                           if machine_id != DRAINER_KEY and entry.get("completedAt") is not None
+                           and now - entry["completedAt"] > self.done_ttl]:
+            queue.pop(machine_id)
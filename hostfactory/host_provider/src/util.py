@@ -7,12 +7,18 @@ from logging.handlers import RotatingFileHandler
 from concurrent_log_handler import ConcurrentRotatingFileHandler
 import os
 import shutil
-import subprocess
+import signal
+import socket
 import sys
+import threading
 import traceback
 import time
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from builtins import str
 
+import metrics
+
 import os
 
 
@@ -24,6 +30,10 @@ class ConfigError(Exception):
     pass
 
 
+class LockTimeout(RuntimeError):
+    pass
+
+
 _logging_init = False
 
 class CustomFormatter(logging.Formatter):
@@ -109,9 +119,63 @@ def init_logging(loglevel=logging.INFO, logfile=None):
     return logger
 
 
+def lock_file(fp, path, timeout, metrics_name=None, logger=None):
+    '''
+    Takes an exclusive lock on the open file fp, waking up as soon as the current holder releases it, and
+    raises LockTimeout after timeout seconds. In the main thread this is a blocking lockf interrupted by
+    SIGALRM; other threads can not use signals, and a caller may have its own ITIMER_REAL armed that setitimer
+    would replace, so those poll with a short backoff instead.
+    '''
+    if os.name == 'nt':
+        (logger or logging.getLogger()).warning("Skip locking on windows.  TODO: replace fcntl for windows")
+        return
+    import fcntl
+    try:
+        fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return
+    except IOError:
+        pass
+
+    if metrics_name:
+        metrics.increment(metrics_name + ".lock_contended")
+    started = time.time()
+    try:
+        if (threading.current_thread() is threading.main_thread() and hasattr(signal, "setitimer")
+                and not signal.getitimer(signal.ITIMER_REAL)[0]):
+            def _expired(signum, frame):
+                raise LockTimeout("Could not get lock %s within %s seconds" % (path, timeout))
+            previous_handler = signal.signal(signal.SIGALRM, _expired)
+            signal.setitimer(signal.ITIMER_REAL, max(timeout, 0.001))
+            try:
+                fcntl.lockf(fp, fcntl.LOCK_EX)
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                # None when the handler was not installed from python
+                signal.signal(signal.SIGALRM, signal.SIG_DFL if previous_handler is None else previous_handler)
+        else:
+            interval = 0.01
+            while True:
+                try:
+                    fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError:
+                    remaining = timeout - (time.time() - started)
+                    if remaining <= 0:
+                        raise LockTimeout("Could not get lock %s within %s seconds" % (path, timeout))
+                    time.sleep(min(interval, remaining))
+                    interval = min(interval * 2, 0.25)
+    except LockTimeout:
+        if metrics_name:
+            metrics.increment(metrics_name + ".lock_timeouts")
+        raise
+    if logger:
+        waited = time.time() - started
+        logger.log(logging.INFO if waited >= 1 else logging.DEBUG, "Waited %.3fs for lock %s", waited, path)
+
+
 class JsonStore:
     
-    def __init__(self, name, directory, formatted=False):
+    def __init__(self, name, directory, formatted=False, lock_timeout=180):
         assert name not in ['hosts.json', 'requests.json'], "Illegal json name."
         self.path = os.path.join(directory, name)
         self.lockpath = self.path + ".lock"
@@ -120,9 +184,12 @@ class JsonStore:
                 pass
         
         self.formatted = formatted
+        self.lock_timeout = lock_timeout
         self.data = None
         self.lockfp = None
         self.lock_count = 0
+        self.locked_at = None
+        self.metrics_name = "store." + name
         self.logger = init_logging()
 
     def clear(self):
@@ -134,21 +201,24 @@ class JsonStore:
         self.lock_count += 1
         if self.lock_count > 1:
             return True
-        iter = 0
-        while iter < 18:
-            iter += 1
-            try:
-                self.lockfp = open(self.lockpath, 'w')
-                if os.name == 'nt':
-                    self.logger.warning("Skip locking on windows.  TODO: replace fcntl for windows")
-                else:
-                    import fcntl
-                    fcntl.lockf(self.lockfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                return True
-            except IOError:
+        started = time.time()
+        self.lockfp = None
+        try:
+            self.lockfp = open(self.lockpath, 'w')
+            lock_file(self.lockfp, self.lockpath, self.lock_timeout, self.metrics_name, self.logger)
+        except (IOError, LockTimeout) as e:
+            if isinstance(e, LockTimeout):
+                self.logger.error(str(e))
+            else:
                 self.logger.exception("Could not acquire lock - %s" % self.lockpath)
-                time.sleep(10)
-        return False
+            if self.lockfp:
+                self.lockfp.close()
+                self.lockfp = None
+            self.lock_count -= 1
+            return False
+        self.locked_at = time.time()
+        metrics.observe(self.metrics_name + ".lock_wait", self.locked_at - started)
+        return True
             
     def _unlock(self):
         self.lock_count -= 1
@@ -159,6 +229,9 @@ class JsonStore:
             self.lockfp.close()
         except IOError:
             self.logger.exception("Error closing lock - %s" % self.lockpath)
+        if self.locked_at is not None:
+            metrics.observe(self.metrics_name + ".lock_hold", time.time() - self.locked_at)
+            self.locked_at = None
             
     def read(self):
         return self._read(do_lock=True)
@@ -187,10 +260,11 @@ class JsonStore:
         self._unlock()
     
     def _write(self, data):
-        with open(self.path + ".tmp", "w") as fw:
-            indent = 2 if self.formatted else None
-            json.dump(data, fw, indent=indent, sort_keys=True)
-        shutil.move(self.path + ".tmp", self.path)
+        with metrics.span(self.metrics_name + ".write"):
+            with open(self.path + ".tmp", "w") as fw:
+                indent = 2 if self.formatted else None
+                json.dump(data, fw, indent=indent, sort_keys=True)
+            shutil.move(self.path + ".tmp", self.path)
                   
     def __enter__(self):
         if not self._lock():
@@ -200,7 +274,70 @@ class JsonStore:
     def __exit__(self, *args):
         self._write(self.data)
         self._unlock()
-        
+
+
+class FileLease:
+    '''
+    Exclusive inter-process lock on a lock file for the duration of a with block, see lock_file(). Wait and
+    hold times are recorded under metrics_name.
+    '''
+
+    def __init__(self, path, timeout=300, metrics_name=None):
+        self.path = path
+        self.timeout = timeout
+        self.metrics_name = metrics_name
+        self.lockfp = None
+        self.acquired_at = None
+        self.logger = init_logging()
+
+    def __enter__(self):
+        started = time.time()
+        self.lockfp = open(self.path, "a")
+        try:
+            lock_file(self.lockfp, self.path, self.timeout, self.metrics_name, self.logger)
+        except BaseException:
+            self.lockfp.close()
+            self.lockfp = None
+            raise
+
+        self.acquired_at = time.time()
+        if self.metrics_name:
+            metrics.observe(self.metrics_name + ".lock_wait", self.acquired_at - started)
+        return self
+
+    def __exit__(self, *args):
+        try:
+            self.lockfp.close()
+        except IOError:
+            self.logger.exception("Error closing lock - %s" % self.path)
+        self.lockfp = None
+        if self.metrics_name:
+            metrics.observe(self.metrics_name + ".lock_hold", time.time() - self.acquired_at)
+
+
+def allocation_lease(directory, template_id, timeout=300):
+    '''
+    Serializes allocation (cluster.add_nodes) for one template between provider processes.
+    '''
+    safe_id = "".join([c if c.isalnum() or c in "-_." else "_" for c in template_id])
+    return FileLease(os.path.join(directory, "allocation_%s.lock" % safe_id), timeout, metrics_name="allocation_lease")
+
+
+STORE_BACKENDS = ["json", "sqlite"]
+
+
+def new_store(name, directory, backend="json", formatted=False, lock_timeout=180):
+    '''
+    JsonStore, or its SQLite counterpart when backend is "sqlite" (symphony.hostfactory.store_backend).
+    formatted only applies to the json backend.
+    '''
+    if backend == "sqlite":
+        from sqlite_store import SqliteStore
+        return SqliteStore(name, directory, lock_timeout=lock_timeout)
+    if backend != "json":
+        raise ConfigError("Unknown symphony.hostfactory.store_backend %s - expected one of %s" % (backend, STORE_BACKENDS))
+    return JsonStore(name, directory, formatted=formatted, lock_timeout=lock_timeout)
+
 
 def failureresponse(response):
     '''
@@ -245,49 +382,149 @@ def failureresponse(response):
     return decorator
 
 
+JETPACK_CONFIG = "/opt/cycle/jetpack/config/node.json"
+
+
+def load_jetpack_config(path=JETPACK_CONFIG, snapshot_path=None):
+    '''
+    Loads jetpack's node.json. With a snapshot_path, the config is also written there as compact json, keyed
+    by the mtime and size of node.json, and later processes load the snapshot instead of node.json. The
+    snapshot is plain json so that loading it never runs code, whoever can write to the data directory.
+    '''
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {}
+
+    signature = (st.st_mtime_ns, st.st_size)
+    if snapshot_path:
+        try:
+            with open(snapshot_path) as fr:
+                snapshot = json.load(fr)
+            if tuple(snapshot.get("signature") or ()) == signature:
+                return snapshot["config"]
+        except Exception:
+            pass
+
+    try:
+        with open(path) as json_file:
+            jetpack_config = json.load(json_file)
+    except FileNotFoundError:
+        return {}
+
+    if snapshot_path:
+        tmp_path = "%s.%d.tmp" % (snapshot_path, os.getpid())
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as fw:
+                json.dump({"signature": list(signature), "config": jetpack_config}, fw, separators=(",", ":"))
+            os.replace(tmp_path, snapshot_path)
+        except Exception:
+            logging.getLogger("cyclecloud").warning("Could not write jetpack config snapshot %s", snapshot_path)
+    return jetpack_config
+
+
+# results of ProviderConfig._walk for keys that are not in the index
+_FALLBACK = "fallback"
+_INVALID = "invalid"
+_MISSING = object()
+
+
 class ProviderConfig:
     
-    def __init__(self, config, jetpack_config=None):
+    def __init__(self, config, jetpack_config=None, jetpack_snapshot_path=None):
+        self._index = None
         self.config = config
         self.logger = init_logging()
         if jetpack_config is None:
-            try:
-                with open("/opt/cycle/jetpack/config/node.json") as json_file:
-                    jetpack_config = json.load(json_file)
-            except (FileNotFoundError) as ex:
-                jetpack_config = {}
+            jetpack_config = load_jetpack_config(snapshot_path=jetpack_snapshot_path)
         self.jetpack_config = jetpack_config
-        
-    def get(self, key, default_value=None):
-        if not key:
-            return self.config
-        
+
+    @property
+    def config(self):
+        return self._config
+
+    @config.setter
+    def config(self, value):
+        self._config = value
+        self.invalidate()
+
+    @property
+    def jetpack_config(self):
+        return self._jetpack_config
+
+    @jetpack_config.setter
+    def jetpack_config(self, value):
+        self._jetpack_config = value
+        self.invalidate()
+
+    def invalidate(self):
+        '''
+        Drops the lookup index. set() does this, anything that modifies the config dicts in place must call it.
+        '''
+        self._index = None
+        self._misses = {}
+
+    def _build_index(self):
+        # every dotted key that resolves to a value, with the user config overriding jetpack at the top level
+        index = {}
+
+        def _add(prefix, d):
+            for k, v in d.items():
+                if v is None or not isinstance(k, str) or "." in k:
+                    # None is treated as missing, and a key with a dot can't be reached by a dotted lookup
+                    continue
+                path = prefix + k
+                index[path] = v
+                if hasattr(v, "keys"):
+                    _add(path + ".", v)
+
+        _add("", {**self.jetpack_config, **self.config})
+        self._index = MappingProxyType(index)
+        return self._index
+
+    def _walk(self, key):
+        '''
+        Classifies a key that is not in the index the same way a lookup walk over the merged config would.
+        '''
         keys = key.split(".")
         top_value = {**self.jetpack_config, **self.config}
         for n in range(len(keys)):
             if top_value is None:
                 break
-            
+
             if not hasattr(top_value, "keys"):
-                self.logger.warning("Invalid format, as a child key was specified for %s when its type is %s ", key, type(top_value))
-                return {}
-                
-            value = top_value.get(keys[n])
-            
-            if n == len(keys) - 1 and value is not None:
-                return value
-            
-            top_value = value
-            
-        if top_value is None:
-            try:
-                return self.jetpack_config.get(key, default_value)
-            except ConfigError as e:
-                if key in str(e):
-                    return default_value
-                raise
-        
-        return top_value
+                return _INVALID
+
+            top_value = top_value.get(keys[n])
+        return _FALLBACK
+
+    def get(self, key, default_value=None):
+        if not key:
+            return self.config
+
+        index = self._index
+        if index is None:
+            index = self._build_index()
+
+        value = index.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        miss = self._misses.get(key)
+        if miss is None:
+            miss = self._misses[key] = self._walk(key)
+
+        if miss == _INVALID:
+            self.logger.warning("Invalid format, as a child key was specified for %s when its parent is not a dictionary", key)
+            return {}
+
+        try:
+            return self.jetpack_config.get(key, default_value)
+        except ConfigError as e:
+            if key in str(e):
+                return default_value
+            raise
     
     def set(self, key, value):
         keys = key.split(".")
@@ -299,12 +536,13 @@ class ProviderConfig:
             top_value = tmp_value
             
         top_value[keys[-1]] = value
+        self.invalidate()
 
     def __str__(self) -> str:
         return json.dumps(self.config)
 
 
-def provider_config_from_environment(pro_conf_dir=os.getenv('PRO_CONF_DIR', os.getcwd())):    
+def provider_config_files(pro_conf_dir):
     config_file = os.path.join(pro_conf_dir, "conf", "azureccprov_config.json")
     if os.name == 'nt':
         # TODO: Why does the path matter?   Can we use one or the other for both OSs?
@@ -313,6 +551,11 @@ def provider_config_from_environment(pro_conf_dir=os.getenv('PRO_CONF_DIR', os.g
 
     hf_conf_dir = os.getenv('HF_CONFDIR', os.path.join(pro_conf_dir, "..", "..", ".."))
     hf_config_file = os.path.join(hf_conf_dir, "hostfactoryconf.json")
+    return config_file, hf_config_file
+
+
+def provider_config_from_environment(pro_conf_dir=os.getenv('PRO_CONF_DIR', os.getcwd())):    
+    config_file, hf_config_file = provider_config_files(pro_conf_dir)
     
     delayed_log_statements = []
     
@@ -355,28 +598,138 @@ def provider_config_from_environment(pro_conf_dir=os.getenv('PRO_CONF_DIR', os.g
     
     for level, message in delayed_log_statements:
         logger.log(level, message)    
-    return ProviderConfig(config), logger, fine
+
+    jetpack_snapshot_path = None
+    if ProviderConfig(config, jetpack_config={}).get("symphony.hostfactory.jetpack_config_snapshot", False):
+        jetpack_snapshot_path = os.path.join(os.getenv('PRO_DATA_DIR', os.getcwd()), "jetpack_config.snapshot.json")
+    return ProviderConfig(config, jetpack_snapshot_path=jetpack_snapshot_path), logger, fine
 
 
 class Hostnamer:
+    '''
+    Resolves node ips to hostnames with in-process lookups (the same NSS lookup `getent hosts` does)
+    instead of forking getent for every node. Results are kept in a persistent cache, positive results
+    for positive_ttl seconds and failed lookups for negative_ttl seconds, so that repeated status and
+    return request polls do not resolve the same nodes again. Azure hands the ip of a deleted node to the
+    next one, so an entry is also dropped as soon as the ip is looked up for another node id.
+    '''
     
-    def __init__(self, use_fqdn=True):
+    def __init__(self, use_fqdn=True, cache_path=None, positive_ttl=300, negative_ttl=60, max_workers=16, clock=time.time):
         self.use_fqdn = use_fqdn
+        self.cache_path = cache_path
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_workers = max(1, max_workers)
+        self.clock = clock
+        self._cache = None
+        self._cache_lock = threading.Lock()
+        self._dirty = False
+    
+    def _lookup(self, private_ip_address):
+        canonical, aliases, _ = socket.gethostbyaddr(private_ip_address)
+        # equivalent to the tokens after the ip in `getent hosts <ip>`
+        return [canonical] + list(aliases)
     
-    def hostname(self, private_ip_address):
-        stdout = subprocess.check_output(["getent", "hosts", private_ip_address]).decode()
-        toks = [x.strip() for x in stdout.split()]
+    def _choose(self, toks):
         if self.use_fqdn:
-            if len(toks) >= 2:
-                return toks[1]
             return toks[0]
-        else:
-            return toks[-1]
+        return toks[-1]
+    
+    def _load_cache(self):
+        if self._cache is not None:
+            return self._cache
+        cache = {}
+        if self.cache_path and os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path) as fr:
+                    cache = json.load(fr)
+            except (IOError, ValueError):
+                logging.getLogger("cyclecloud").warning("Ignoring unreadable hostname cache %s", self.cache_path)
+        self._cache = cache
+        return cache
+    
+    def _cached(self, private_ip_address, node_id=None):
+        '''Returns (found, hostname). hostname is None for a cached failure.'''
+        with self._cache_lock:
+            entry = self._load_cache().get(private_ip_address)
+        if not entry or entry[1] <= self.clock():
+            return False, None
+        cached_node_id = entry[2] if len(entry) > 2 else None
+        if node_id and cached_node_id and node_id != cached_node_id:
+            # the ip now belongs to another node
+            return False, None
+        return True, self._choose(entry[0]) if entry[0] else None
+    
+    def _resolve(self, private_ip_address, node_id=None):
+        try:
+            with metrics.span("hostname.lookup"):
+                toks = self._lookup(private_ip_address)
+            hostname = self._choose(toks)
+            entry = [toks, self.clock() + self.positive_ttl, node_id]
+        except (socket.herror, socket.gaierror, OSError):
+            hostname = None
+            entry = [None, self.clock() + self.negative_ttl, node_id]
+        with self._cache_lock:
+            self._load_cache()[private_ip_address] = entry
+            self._dirty = True
+        return hostname
+    
+    def hostname(self, private_ip_address, node_id=None):
+        found, hostname = self._cached(private_ip_address, node_id)
+        if not found:
+            hostname = self._resolve(private_ip_address, node_id)
+            self.save()
+        if hostname is None:
+            raise RuntimeError("Could not resolve hostname for %s" % private_ip_address)
+        return hostname
+    
+    def resolve_many(self, private_ip_addresses, node_ids=None):
+        '''
+        Returns {ip: hostname or None}, resolving uncached ips in parallel. node_ids maps the ips to the ids of
+        the nodes they belong to.
+        '''
+        node_ids = node_ids or {}
+        ret = {}
+        to_resolve = []
+        for ip in set(private_ip_addresses):
+            if not ip:
+                continue
+            found, hostname = self._cached(ip, node_ids.get(ip))
+            if found:
+                ret[ip] = hostname
+            else:
+                to_resolve.append(ip)
+        
+        if to_resolve:
+            with metrics.span("hostname.resolve_many"):
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, len(to_resolve))) as executor:
+                    for ip, hostname in zip(to_resolve, executor.map(self._resolve, to_resolve,
+                                                                     [node_ids.get(ip) for ip in to_resolve])):
+                        ret[ip] = hostname
+            self.save()
+        return ret
+    
+    def save(self):
+        # status calls resolve hostnames on several threads, and the tmp file is only unique per process, so
+        # the file is written under the cache lock. That also keeps _resolve from changing the cache mid dump.
+        with self._cache_lock:
+            if not self.cache_path or not self._dirty:
+                return
+            now = self.clock()
+            cache = {ip: entry for ip, entry in self._cache.items() if entry[1] > now}
+            self._cache = cache
+            self._dirty = False
+        
+            tmp_path = "%s.%d.tmp" % (self.cache_path, os.getpid())
+            try:
+                with open(tmp_path, "w") as fw:
+                    json.dump(cache, fw)
+                os.replace(tmp_path, self.cache_path)
+            except IOError:
+                logging.getLogger("cyclecloud").exception("Could not write hostname cache %s", self.cache_path)
         
     def private_ip_address(self, hostname):
-        stdout = subprocess.check_output(["getent", "hosts", hostname]).decode()
-        toks = [x.strip() for x in stdout.split()]
-        return toks[0]
+        return socket.gethostbyname(hostname)
     
         
 def load_json(path):
@@ -0,0 +1,113 @@
+'''
+Micro-benchmark for the VM distribution functions of the weighted and decay allocation strategies, against
+their original one-pass-at-a-time loops.
+
+    PYTHONPATH=test:src python test/allocation_strategy_bench.py [--vm-types 1,10,100,500] [--slots 1,1000,100000,1000000]
+'''
+import argparse
+import logging
+import random
+import sys
+import time
+from math import floor
+
+import allocation_strategy
+
+
+def legacy_calculate_vm_dist_weighted(vm_types, requested_slot_count, percentage_weights=[.7, .2, .05, .05]):
+    '''
+    calculate_vm_dist_weighted before the full pass shortcut, used as the reference implementation.
+    '''
+    percentage_weights = allocation_strategy.normalize_list(percentage_weights)
+
+    vm_dist = {vm: 0 for vm in vm_types.keys()}
+    slots_per_vm_type = [floor(requested_slot_count * p) for p in percentage_weights]
+    if len(slots_per_vm_type) < len(vm_types):
+        for i in range(len(vm_types) - len(slots_per_vm_type)):
+            slots_per_vm_type.append(0)
+
+    remaining_slots = requested_slot_count
+    for n, p in enumerate(vm_types.items()):
+        vm, weight = p
+        if slots_per_vm_type[n] < 1:
+            continue
+        if weight <= 0:
+            continue
+        slot_count = max(weight, allocation_strategy.round_down_to_nearest_multiple(slots_per_vm_type[n], weight))
+        remaining_slots -= slot_count
+        vm_dist[vm] = slot_count
+        if remaining_slots <= 0:
+            break
+
+    while remaining_slots > 0:
+        for n, p in enumerate(vm_types.items()):
+            vm, weight = p
+            remaining_slots -= weight
+            vm_dist[vm] += weight
+            if remaining_slots <= 0:
+                break
+    return vm_dist
+
+
+def legacy_calculate_vm_dist_decay(vm_types, total_slot_count):
+    '''
+    calculate_vm_dist_decay before the full pass shortcut, used as the reference implementation.
+    '''
+    num_skus = len(vm_types)
+    vm_dist = {sku: 0 for sku in vm_types.keys()}
+
+    remaining = total_slot_count
+    max_core_count = max(vm_types.values())
+    weighted_increment_per_sku = [num_skus / (1 + idx) for idx in range(num_skus)]
+    while remaining > 0:
+        for idx, p in enumerate(vm_types.items()):
+            sku, symphony_slot_weight = p
+            unrounded_increment = min(remaining, max_core_count * weighted_increment_per_sku[idx])
+            increment = allocation_strategy.round_down_to_nearest_multiple(unrounded_increment, symphony_slot_weight)
+            if increment == 0 and remaining <= symphony_slot_weight:
+                increment += symphony_slot_weight
+            remaining -= int(increment)
+            vm_dist[sku] += int(increment)
+            if remaining <= 0:
+                break
+    return vm_dist
+
+
+def random_vm_types(rnd, count, max_weight=64):
+    return {"Standard_VM%d" % i: rnd.choice([1, 2, 4, 8, 16, 32, 48, 64, rnd.randint(1, max_weight)]) for i in range(count)}
+
+
+def _time(func, *args):
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="Benchmark the weighted and decay VM distributions")
+    parser.add_argument("--vm-types", default="1,10,100,500")
+    parser.add_argument("--slots", default="1,1000,100000,1000000")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv[1:])
+
+    logger = logging.getLogger("allocation_strategy_bench")
+    logger.setLevel(logging.WARNING)
+    rnd = random.Random(args.seed)
+    print("%-9s %9s %12s %12s %12s %12s" % ("vm types", "slots", "weighted", "legacy", "decay", "legacy"))
+    for vm_type_count in [int(x) for x in args.vm_types.split(",")]:
+        vm_types = random_vm_types(rnd, vm_type_count)
+        # a small weight on a common sku is the slow case for the weighted fill
+        vm_types[next(iter(vm_types))] = 1
+        for slots in [int(x) for x in args.slots.split(",")]:
+            weighted = _time(allocation_strategy.calculate_vm_dist_weighted, vm_types, slots, [.7, .2, .05, .05], logger)
+            legacy_weighted = _time(legacy_calculate_vm_dist_weighted, vm_types, slots)
+            decay = _time(allocation_strategy.calculate_vm_dist_decay, vm_types, slots, logger)
+            legacy_decay = _time(legacy_calculate_vm_dist_decay, vm_types, slots)
+            assert allocation_strategy.calculate_vm_dist_weighted(vm_types, slots, logger=logger) == legacy_calculate_vm_dist_weighted(vm_types, slots)
+            assert allocation_strategy.calculate_vm_dist_decay(vm_types, slots, logger=logger) == legacy_calculate_vm_dist_decay(vm_types, slots)
+            print("%-9d %9d %10.3fms %10.3fms %10.3fms %10.3fms" % (vm_type_count, slots, weighted * 1000, legacy_weighted * 1000,
+                                                                  decay * 1000, legacy_decay * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
+import random
 import unittest
 import allocation_strategy
+import allocation_strategy_bench
 import logging
 
 class MockAllocateResult:
@@ -334,6 +336,39 @@ class TestAllocationStrategy(unittest.TestCase):
         vm_dist = allocation_strategy.calculate_vm_dist_decay(vm_size, 1000, logger=logger)
         self.assertEqual(vm_dist, {'A': 576, 'B': 160, 'C': 96, 'D': 64, 'E': 56, 'F': 48})
         
+    def test_CalculateDistMatchesLegacy(self):
+        # the full pass shortcuts must give exactly the distributions of the original loops
+        logger = logging.getLogger("test")
+        rnd = random.Random(17)
+        for _ in range(300):
+            vm_types = allocation_strategy_bench.random_vm_types(rnd, rnd.choice([1, 2, 3, 4, 6, 10, 50]), max_weight=rnd.choice([4, 64, 512]))
+            slots = rnd.choice([rnd.randint(1, 64), rnd.randint(1, 5000), rnd.randint(1, 100000)])
+            weights = rnd.choice([[.7, .2, .05, .05], [1], [.5, .5], [.1] * 12])
+            self.assertEqual(allocation_strategy_bench.legacy_calculate_vm_dist_weighted(vm_types, slots, weights),
+                             allocation_strategy.calculate_vm_dist_weighted(vm_types, slots, weights, logger=logger),
+                             (vm_types, slots, weights))
+            self.assertEqual(allocation_strategy_bench.legacy_calculate_vm_dist_decay(vm_types, slots),
+                             allocation_strategy.calculate_vm_dist_decay(vm_types, slots, logger=logger),
+                             (vm_types, slots))
+
+        # non integer weights still take the original loops
+        vm_types = {"A": 1.5, "B": 4}
+        self.assertEqual(allocation_strategy_bench.legacy_calculate_vm_dist_weighted(vm_types, 1001),
+                         allocation_strategy.calculate_vm_dist_weighted(vm_types, 1001, logger=logger))
+        self.assertEqual(allocation_strategy_bench.legacy_calculate_vm_dist_decay(vm_types, 1001),
+                         allocation_strategy.calculate_vm_dist_decay(vm_types, 1001, logger=logger))
+
+    def test_SplitNodesBySlots(self):
+        nodes = [MockNode("n%d" % i, w) for i, w in enumerate([1, 4, 8, 1, 4, 2])]
+        split = allocation_strategy.split_nodes_by_slots(nodes, {"a": 10, "b": 5, "c": 5})
+        self.assertEqual({"a": [8, 2], "b": [4, 1], "c": [4, 1]},
+                         {k: [n.resources["weight"] for n in v] for k, v in split.items()})
+
+        # fewer slots than requested are shared in the same proportion
+        split = allocation_strategy.split_nodes_by_slots(set_node_list("n", 4), {"a": 6, "b": 2})
+        self.assertEqual({"a": 3, "b": 1}, {k: len(v) for k, v in split.items()})
+        self.assertEqual({"a": []}, allocation_strategy.split_nodes_by_slots([], {"a": 3}))
+
     def test_FilterAvailableVmTypes(self):
         # Test 1: Capacity failure filtering
         # Bucket A has no capacity failure - should be included
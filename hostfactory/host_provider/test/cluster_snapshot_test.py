@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from cluster_snapshot import ClusterSnapshot, NodeRecord
+
+
+class MockClock:
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestClusterSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_disabled_by_default(self):
+        snapshot = ClusterSnapshot("c1", self.tmpdir)
+        self.assertFalse(snapshot.enabled)
+        snapshot.put("status", {"a": 1}, time.time())
+        self.assertIsNone(snapshot.get("status"))
+        self.assertFalse(os.path.exists(snapshot.path))
+
+    def test_ttl(self):
+        clock = MockClock(time.time())
+        snapshot = ClusterSnapshot("c1", self.tmpdir, ttl=10, clock=clock)
+        snapshot.put("status", {"a": 1}, clock())
+        self.assertEqual({"a": 1}, snapshot.get("status"))
+
+        # shared with other processes
+        other = ClusterSnapshot("c1", self.tmpdir, ttl=10, clock=clock)
+        self.assertEqual({"a": 1}, other.get("status"))
+        self.assertIsNone(ClusterSnapshot("c2", self.tmpdir, ttl=10, clock=clock).get("status"))
+
+        clock.now += 11
+        self.assertIsNone(snapshot.get("status"))
+        self.assertIsNone(other.get("status"))
+
+    def test_get_or_fetch(self):
+        snapshot = ClusterSnapshot("c1", self.tmpdir, ttl=60)
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return {"nodes": []}
+        self.assertEqual({"nodes": []}, snapshot.get_or_fetch("all_nodes", fetch))
+        self.assertEqual({"nodes": []}, snapshot.get_or_fetch("all_nodes", fetch))
+        self.assertEqual(1, len(calls))
+
+    def test_invalidate(self):
+        snapshot = ClusterSnapshot("c1", self.tmpdir, ttl=60)
+        fetched_at = time.time() - 5
+        snapshot.put("status", {"a": 1}, fetched_at)
+        self.assertEqual({"a": 1}, snapshot.get("status"))
+
+        # another process shuts down nodes
+        ClusterSnapshot("c1", self.tmpdir, ttl=60).invalidate()
+        self.assertIsNone(snapshot.get("status"))
+
+        # a response fetched before the invalidation is never written back
+        snapshot.put("status", {"a": 2}, fetched_at)
+        self.assertIsNone(snapshot.get("status"))
+
+        snapshot.put("status", {"a": 3}, time.time() + 1)
+        self.assertEqual({"a": 3}, snapshot.get("status"))
+
+    def test_node_record(self):
+        record = NodeRecord("nid-1", "execute-1", "Ready", "Started", "host1", "10.0.0.1", "i-1")
+        copy = NodeRecord.from_dict(record.to_dict())
+        self.assertEqual("nid-1", copy.delayed_node_id.node_id)
+        self.assertEqual(record.to_dict(), copy.to_dict())
+        self.assertEqual(record.to_dict(), NodeRecord.from_node(record).to_dict())
+
+
+if __name__ == "__main__":
+    unittest.main()
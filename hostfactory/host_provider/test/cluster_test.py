@@ -1,6 +1,9 @@
+import json
 import unittest
 import cluster
 import logging
+import time
+import util
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
@@ -72,5 +75,298 @@ class TestCluster(unittest.TestCase):
     #     run_test(101, 101, True)  
 
 
+class MockResponse:
+
+    def __init__(self, status_code, content=b"{}", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class TestClusterHttp(unittest.TestCase):
+
+    def _new_cluster(self):
+        config = {"cyclecloud": {"config": {"web_server": "https://cc", "username": "u", "password": "p"}}}
+        c = cluster.Cluster("c1", util.ProviderConfig(config, {}), logging.getLogger())
+        c._http_session = MagicMock()
+        return c
+
+    @patch("time.sleep")
+    def test_retry_throttled_get(self, sleep):
+        c = self._new_cluster()
+        c._http_session.request.side_effect = [MockResponse(429, headers={"Retry-After": "2"}),
+                                               MockResponse(503),
+                                               MockResponse(200, b'{"nodes": []}')]
+        self.assertEqual({"nodes": []}, c.get("/clusters/c1/nodes"))
+        self.assertEqual(3, c._http_session.request.call_count)
+        self.assertEqual(2, sleep.call_args_list[0][0][0])
+        self.assertEqual(2, c.connection_stats()["retries"])
+        # real connect and read timeouts are passed on every call
+        self.assertEqual((10.0, 60.0), c._http_session.request.call_args[1]["timeout"])
+
+    @patch("time.sleep")
+    def test_retries_exhausted(self, sleep):
+        c = self._new_cluster()
+        c.provider_config.set("cyclecloud.http.retries", 1)
+        c._http_session.request.return_value = MockResponse(500, b"busy")
+        self.assertRaises(ValueError, c.get, "/clusters/c1/status")
+        self.assertEqual(2, c._http_session.request.call_count)
+
+    @patch("time.sleep")
+    def test_post_not_retried_on_server_error(self, sleep):
+        c = self._new_cluster()
+        c._http_session.request.return_value = MockResponse(500, b"error")
+        self.assertRaises(ValueError, c.post, "/clusters/c1/nodes/terminate", json={"ids": ["a"]})
+        self.assertEqual(1, c._http_session.request.call_count)
+
+        c._http_session.request.reset_mock()
+        c._http_session.request.side_effect = [MockResponse(429), MockResponse(200, b"{}")]
+        self.assertEqual("{}", c.post("/clusters/c1/nodes/terminate", json={"ids": ["a"]}))
+        self.assertEqual(2, c._http_session.request.call_count)
+
+    def test_all_nodes_streaming(self):
+        c = self._new_cluster()
+        c.provider_config.set("cyclecloud.nodes.streaming", True)
+        nodes = [{"Name": "execute-1", "NodeId": "n1", "Hostname": "ip-10-0-0-1", "PrivateIp": "10.0.0.1", "Status": "Ready",
+                  "TargetState": "Started", "Configuration": {"autoscaling": {"enabled": True}, "big": "x" * 1000}},
+                 {"Name": "execute-2", "NodeId": "n2", "Status": "Failed", "StatusMessage": "boom",
+                  "Configuration": {"cyclecloud": {}}, "Instance": {"InstanceId": "i-2"}}]
+        response = MockResponse(200, json.dumps({"nodes": nodes, "operation": {"id": "x"}}).encode())
+        c._http_session.request.return_value = response
+
+        all_nodes = c.all_nodes()
+        self.assertEqual([{"Name": "execute-1", "NodeId": "n1", "Hostname": "ip-10-0-0-1", "PrivateIp": "10.0.0.1",
+                           "Status": "Ready", "TargetState": "Started", "Configuration": {"autoscaling": {"enabled": True}}},
+                          {"Name": "execute-2", "NodeId": "n2", "Status": "Failed", "StatusMessage": "boom",
+                           "Configuration": {"autoscaling": {"enabled": False}}}],
+                         all_nodes["nodes"])
+        self.assertTrue(c._http_session.request.call_args[1]["stream"])
+        self.assertTrue(response.closed)
+
+        c._http_session.request.return_value = MockResponse(500, b"busy")
+        c.provider_config.set("cyclecloud.http.retries", 0)
+        self.assertRaises(ValueError, c.all_nodes)
+
+    def test_backoff_jitter(self):
+        c = self._new_cluster()
+        for attempt in range(10):
+            delay = c._backoff(attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(30, 2 ** attempt))
+
+
+class MockNode:
+
+    def __init__(self, node_id):
+        self.delayed_node_id = MagicMock(node_id=node_id)
+        self.name = node_id
+
+
+class TestClusterNodes(unittest.TestCase):
+
+    def test_nodes_by_request_ids(self):
+        c = cluster.Cluster("c1", util.ProviderConfig({}, {}), logging.getLogger())
+        listing = [MockNode("n1"), MockNode("n2"), MockNode("n3")]
+        operations = {"r3-create": [MockNode("n4")]}
+
+        def get_nodes_by_request_id(req_id):
+            if req_id not in operations:
+                raise RuntimeError("No operation found for request id %s" % req_id)
+            return operations[req_id]
+
+        c.node_mgr = MagicMock()
+        c.node_mgr.get_nodes.return_value = listing
+        c.node_mgr.get_nodes_by_request_id.side_effect = get_nodes_by_request_id
+
+        found = c.nodes_by_request_ids(["r1", "r2", "r3", "r4"], {"r1": ["n1", "n3"], "r2": ["n2", "gone"]})
+        self.assertEqual(["n1", "n3"], [n.name for n in found["r1"]])
+        # nodes that no longer exist are dropped, as they would be by the operation lookup
+        self.assertEqual(["n2"], [n.name for n in found["r2"]])
+        self.assertEqual(["n4"], [n.name for n in found["r3"]])
+        self.assertIsNone(found["r4"])
+        # one listing for the known requests, -start and -create lookups only for the unknown ones
+        self.assertEqual(1, c.node_mgr.get_nodes.call_count)
+        self.assertEqual(["r3-start", "r3-create", "r4-start", "r4-create"],
+                         [x[0][0] for x in c.node_mgr.get_nodes_by_request_id.call_args_list])
+
+        self.assertEqual(["n4"], [n.name for n in c.nodes(["r3"])["r3"]])
+        self.assertRaisesRegex(RuntimeError, "Could not find request id r4", c.nodes, ["r4"])
+
+    def test_nodes_by_request_ids_concurrent(self):
+        c = cluster.Cluster("c1", util.ProviderConfig({"symphony": {"hostfactory": {"status_workers": 4}}}, {}), logging.getLogger())
+        request_ids = ["r%d" % i for i in range(20)]
+        failing = []
+        node_mgrs = []
+        in_use = set()
+        shared = []
+
+        def get_nodes_by_request_id(req_id):
+            if failing:
+                raise RuntimeError("Http Status 500")
+            # later requests answer first
+            time.sleep(0.001 * (20 - int(req_id[1:].split("-")[0])))
+            if req_id.endswith("-start") or req_id == "r7-create":
+                raise RuntimeError("No operation found for request id %s" % req_id)
+            return [MockNode(req_id)]
+
+        def new_node_manager():
+            node_mgr = MagicMock()
+
+            def tracked(req_id):
+                # a NodeManager is never used by two threads at the same time
+                shared.append(node_mgr in in_use)
+                in_use.add(node_mgr)
+                try:
+                    return get_nodes_by_request_id(req_id)
+                finally:
+                    in_use.discard(node_mgr)
+
+            node_mgr.get_nodes_by_request_id.side_effect = tracked
+            node_mgrs.append(node_mgr)
+            return node_mgr
+
+        c._new_node_manager = new_node_manager
+        c.node_mgr = new_node_manager()
+        found = c.nodes_by_request_ids(request_ids)
+        self.assertEqual(request_ids, list(found))
+        self.assertIsNone(found["r7"])
+        self.assertEqual(["r3-create"], [n.name for n in found["r3"]])
+        self.assertFalse(any(shared))
+        self.assertLessEqual(len(node_mgrs), 4)
+
+        failing.append(True)
+        self.assertRaisesRegex(RuntimeError, "500", c.nodes_by_request_ids, request_ids)
+
+
+class TestChunkedBootup(unittest.TestCase):
+
+    def _cluster(self):
+        from synthetic_cluster import SyntheticCluster
+        provider_config = util.ProviderConfig({"cyclecloud": {"bootup": {"chunk_size": 10, "max_workers": 3}}}, {})
+        return SyntheticCluster(provider_config, node_count=0, padding=False, logger=logging.getLogger())
+
+    def _add_nodes(self, c, recorded):
+        return c.add_nodes("req1", "execute", 45, True, {"Standard_F2s_v2": 1},
+                           autoscaling_strategy="price", record_chunks=recorded.extend)
+
+    def test_chunks(self):
+        c = self._cluster()
+        recorded = []
+        result = self._add_nodes(c, recorded)
+        self.assertTrue(result)
+        self.assertTrue(result.complete)
+        self.assertEqual("success", result.status)
+        self.assertEqual(["req1-c0", "req1-c1", "req1-c2", "req1-c3", "req1-c4"], recorded)
+        self.assertEqual(recorded, result.sub_request_ids)
+        self.assertEqual(45, len(result.nodes))
+        self.assertEqual(5, c.rest_calls["POST /clusters/{cluster}/nodes/create"])
+        self.assertEqual([10, 10, 10, 10, 5], [len(c.operations["req1-c%d-create" % n]) for n in range(5)])
+
+        # the chunks are found under the one request id
+        found = c.nodes_by_request_ids(["req1"], chunk_ids_by_request_id={"req1": recorded})
+        self.assertEqual(sorted(n.delayed_node_id.node_id for n in result.nodes),
+                         sorted(n.delayed_node_id.node_id for n in found["req1"]))
+        # (SyntheticCluster keeps its model in a nodes attribute)
+        self.assertEqual(45, len(cluster.Cluster.nodes(c, ["req1"], {"req1": recorded})["req1"]))
+        self.assertIsNone(c.nodes_by_request_ids(["req1"])["req1"])
+
+    def test_failed_chunk(self):
+        c = self._cluster()
+
+        def flaky(node_mgr):
+            bootup = node_mgr.bootup
+
+            def flaky_bootup(nodes=None, request_id_start=None, request_id_create=None):
+                if request_id_create == "req1-c1-create":
+                    raise RuntimeError("timed out")
+                return bootup(nodes, request_id_start, request_id_create)
+
+            node_mgr.bootup = flaky_bootup
+            return node_mgr
+
+        new_node_manager = c._new_node_manager
+        c._new_node_manager = lambda: flaky(new_node_manager())
+        flaky(c.synthetic_node_mgr)
+        result = self._add_nodes(c, [])
+        self.assertTrue(result)
+        self.assertFalse(result.complete)
+        self.assertEqual("partial", result.status)
+        self.assertIn("req1-c1", result.message)
+        self.assertEqual(35, len(result.nodes))
+
+    def test_chunks_boot_concurrently(self):
+        c = self._cluster()
+        running = []
+        overlapped = []
+        shared = []
+
+        def tracked(node_mgr):
+            bootup = node_mgr.bootup
+
+            def tracked_bootup(nodes=None, request_id_start=None, request_id_create=None):
+                overlapped.append(bool(running))
+                # each chunk worker boots through its own NodeManager
+                shared.append(any(r is node_mgr for r in running))
+                running.append(node_mgr)
+                try:
+                    time.sleep(0.05)
+                    return bootup(nodes, request_id_start, request_id_create)
+                finally:
+                    running.remove(node_mgr)
+
+            node_mgr.bootup = tracked_bootup
+            return node_mgr
+
+        new_node_manager = c._new_node_manager
+        c._new_node_manager = lambda: tracked(new_node_manager())
+        tracked(c.synthetic_node_mgr)
+        result = self._add_nodes(c, [])
+        self.assertEqual("success", result.status)
+        self.assertEqual(45, len(result.nodes))
+        self.assertTrue(any(overlapped))
+        self.assertFalse(any(shared))
+        # max_workers is 3: the provider's node manager and two more
+        self.assertEqual(3, c.rest_calls["GET /clusters/{cluster}/nodes"])
+
+
+class TestShutdownNodes(unittest.TestCase):
+
+    def test_batches(self):
+        from synthetic_cluster import SyntheticCluster
+        provider_config = util.ProviderConfig({"cyclecloud": {"shutdown": {"batch_size": 4}}}, {})
+        c = SyntheticCluster(provider_config, node_count=10, padding=False, logger=logging.getLogger())
+        node_ids = list(c.nodes)
+        post = c.post
+
+        def flaky_post(url, json=None, **kwargs):
+            if node_ids[5] in json["ids"]:
+                raise ValueError("Service Unavailable")
+            if node_ids[9] in json["ids"]:
+                return '{"nodes": [{"id": "%s", "status": "Error", "error": "Busy"}, {"id": "gone", "status": "Error", "error": "Node not found"}]}' % node_ids[9]
+            return post(url, json=json, **kwargs)
+
+        c.post = flaky_post
+        result = c.shutdown_nodes([{"machineId": i, "name": i} for i in node_ids + [node_ids[0], "gone"]])
+        self.assertFalse(result)
+        # the batch that raised fails all of its ids, an error fails only its own id, and unknown ids are done
+        self.assertEqual(node_ids[4:8] + [node_ids[9]], list(result.failed))
+        self.assertEqual("Busy", result.failed[node_ids[9]])
+        self.assertEqual(node_ids[:4] + [node_ids[8], "gone"], result.succeeded)
+        self.assertEqual(1, c.rest_calls["POST /clusters/{cluster}/nodes/shutdown"])
+        self.assertEqual("Terminating", c.nodes[node_ids[0]].state)
+        self.assertNotEqual("Terminating", c.nodes[node_ids[5]].state)
+
+        c.post = MagicMock(side_effect=ValueError("down"))
+        self.assertEqual({node_ids[0]: "down"}, c.shutdown_nodes([{"machineId": node_ids[0], "name": "a"}]).failed)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
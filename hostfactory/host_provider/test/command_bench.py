@@ -0,0 +1,309 @@
+'''
+End to end benchmark of the provider commands against a synthetic cluster.
+
+For every combination of cluster size (--nodes) and number of open creation requests (--requests) a fresh
+process builds a SyntheticCluster (see synthetic_cluster.py), opens the requests with create_machines, moves
+their nodes along (80% Ready, 15% Preparing, 5% Failed) and then runs, in order:
+
+    create_machines      once per open request, reported as the median and the total
+    status (create)      one call for all open requests
+    get_return_requests  with every Ready host known to symphony
+    terminate_machines   for a tenth of the request nodes
+    status (delete)      for that termination request
+    periodic_cleanup
+
+Per command it records wall time, CPU time, the REST calls CycleCloud would have served and the bytes
+written to the request stores, plus the peak RSS of the scenario. Half of the cluster belongs to the open
+requests, the rest are unrelated Ready nodes.
+
+    PYTHONPATH=test:src python test/command_bench.py [--nodes 100 1000 10000 50000] [--requests 1 50 500]
+                                                     [--store-backend json] [--save out.json]
+                                                     [--baseline out.json] [--threshold 0.2]
+
+With --baseline, results are compared to an earlier --save and the exit code is 1 when any wall time
+regressed by more than --threshold (a fraction) or any REST call count or store byte count grew.
+'''
+import argparse
+import calendar
+import json
+import logging
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+TEST_DIR = os.path.abspath(os.path.dirname(__file__))
+SRC_DIR = os.path.abspath(os.path.join(TEST_DIR, "..", "src"))
+
+DEFAULT_NODES = [100, 1000, 10000, 50000]
+DEFAULT_REQUESTS = [1, 50, 500]
+
+TEMPLATES = {"templates": [{"templateId": "execute", "maxNumber": 100000,
+                            "attributes": {"type": ["String", "X86_64"], "ncpus": ["Numeric", "1"],
+                                           "nram": ["Numeric", "4096"], "ncores": ["Numeric", "1"]},
+                            "vmTypes": {"Standard_F2s_v2": 1, "Standard_F4s_v2": 2, "Standard_F8s_v2": 4}}]}
+
+
+class BenchHostnamer:
+
+    def hostname(self, private_ip_address, node_id=None):
+        return "ip-" + private_ip_address.replace(".", "-")
+
+
+def new_counting_store(name, directory, backend):
+    '''
+    util.new_store, with the store counting the bytes it writes in bytes_written.
+    '''
+    import sqlite_store
+    import util
+
+    store = util.new_store(name, directory, backend)
+    store_class = type(store)
+
+    class CountingStore(store_class):
+        bytes_written = 0
+
+        def _write(self, data):
+            store_class._write(self, data)
+            self.bytes_written += os.path.getsize(self.path)
+
+        def _upsert(self, items):
+            items = list(items)
+            store_class._upsert(self, items)
+            self.bytes_written += sum([len(key) + len(sqlite_store._dumps(value)) for key, value in items])
+
+    store.__class__ = CountingStore
+    return store
+
+
+class Scenario:
+
+    def __init__(self, node_count, request_count, workdir, store_backend="json"):
+        self.node_count = node_count
+        self.request_count = request_count
+        self.workdir = workdir
+
+        os.makedirs(os.path.join(workdir, "conf"), exist_ok=True)
+        with open(os.path.join(workdir, "conf", "azureccprov_templates.json"), "w") as fw:
+            json.dump(TEMPLATES, fw)
+        for var in ["PRO_CONF_DIR", "PRO_DATA_DIR", "HF_WORKDIR", "PRO_LOG_DIR", "HF_LOGDIR"]:
+            os.environ[var] = workdir
+
+        import cyclecloud_provider
+        import util
+        from synthetic_cluster import SyntheticCluster
+
+        # the log file is part of what a command costs, the debug output on stderr is not
+        for handler in util.init_logging().handlers:
+            if type(handler) is logging.StreamHandler:
+                handler.setLevel(logging.WARNING)
+
+        self.provider_config = util.ProviderConfig({"cyclecloud": {"cluster": {"name": "synthetic"}},
+                                                    "symphony": {"hostfactory": {"db_path": workdir,
+                                                                                 "store_backend": store_backend}}},
+                                                   {})
+        request_node_count = node_count // 2
+        self.cluster = SyntheticCluster(self.provider_config, node_count - request_node_count, data_dir=workdir)
+        # slots per request; nodes of weight > 1 make the request node count somewhat smaller
+        self.slots_per_request = max(1, request_node_count // request_count)
+
+        self.stores = [new_counting_store(name, workdir, store_backend) for name in ["terminate_requests.json", "create_requests.json"]]
+        self.provider = cyclecloud_provider.CycleCloudProvider(config=self.provider_config,
+                                                               cluster=self.cluster,
+                                                               hostnamer=BenchHostnamer(),
+                                                               stdout_handler=cyclecloud_provider.JsonOutputHandler(quiet=True),
+                                                               terminate_requests=self.stores[0],
+                                                               creation_requests=self.stores[1],
+                                                               clock=time.gmtime)
+        self.provider.request_tracker.requests_db = new_counting_store("azurecc_requests.json", workdir, store_backend)
+        self.stores.append(self.provider.request_tracker.requests_db)
+        self.provider.template_cache_dir = workdir
+        self.JsonOutputHandler = cyclecloud_provider.JsonOutputHandler
+
+    def _bytes_written(self):
+        return sum([s.bytes_written for s in self.stores])
+
+    def measure(self, func, *args):
+        '''
+        Runs one command the way a fresh provider process would and returns (result, measurements).
+        '''
+        self.provider.stdout_handler = self.JsonOutputHandler(quiet=True)
+        self.cluster.refresh()
+        rest_before = dict(self.cluster.rest_calls)
+        bytes_before = self._bytes_written()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        result = func(*args)
+        measured = {"wall_ms": (time.perf_counter() - wall) * 1000,
+                    "cpu_ms": (time.process_time() - cpu) * 1000,
+                    "rest_calls": sum(self.cluster.rest_calls.values()) - sum(rest_before.values()),
+                    "rest_calls_by_endpoint": {k: v - rest_before.get(k, 0) for k, v in self.cluster.rest_calls.items()
+                                               if v - rest_before.get(k, 0)},
+                    "store_bytes_written": self._bytes_written() - bytes_before}
+        return result, measured
+
+    def run(self):
+        results = {}
+
+        creates = []
+        request_ids = []
+        for _ in range(self.request_count):
+            response, measured = self.measure(self.provider.create_machines,
+                                              {"template": {"templateId": "execute", "machineCount": self.slots_per_request},
+                                               "rc_account": "default", "user_data": {}})
+            request_ids.append(response["requestId"])
+            creates.append(measured)
+        results["create_machines"] = _combine(creates)
+
+        request_nodes = [n for n in self.cluster.nodes.values() if n.request_id in set(request_ids)]
+        self.cluster.advance(request_nodes)
+
+        _, results["status_create"] = self.measure(self.provider.status,
+                                                   {"requests": [{"requestId": r} for r in request_ids]})
+
+        known_hosts = [{"name": n.hostname, "machineId": n.delayed_node_id.node_id}
+                       for n in self.cluster.nodes.values() if n.state == "Ready"]
+        _, results["get_return_requests"] = self.measure(self.provider.get_return_requests,
+                                                          {"machines": known_hosts, "requests": []})
+
+        ready_request_nodes = [n for n in request_nodes if n.state == "Ready"]
+        to_terminate = ready_request_nodes[:max(1, len(request_nodes) // 10)]
+        response, results["terminate_machines"] = self.measure(self.provider.terminate_machines,
+                                                               {"machines": [{"name": n.hostname, "machineId": n.delayed_node_id.node_id}
+                                                                             for n in to_terminate]})
+
+        _, results["status_delete"] = self.measure(self.provider.status, {"requests": [{"requestId": response["requestId"]}]})
+
+        # let the requests age past their ttl so that cleanup has expired requests to handle
+        self.provider.clock = lambda: time.gmtime(calendar.timegm(time.gmtime()) + self.provider.creation_request_ttl + 1)
+        _, results["periodic_cleanup"] = self.measure(self.provider.periodic_cleanup)
+
+        return {"nodes": len(self.cluster.nodes),
+                "request_nodes": len(request_nodes),
+                "requests": self.request_count,
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "commands": results}
+
+
+def _combine(samples):
+    ret = {"calls": len(samples),
+           "wall_ms": statistics.median([s["wall_ms"] for s in samples]),
+           "cpu_ms": statistics.median([s["cpu_ms"] for s in samples]),
+           "total_wall_ms": sum([s["wall_ms"] for s in samples]),
+           "total_cpu_ms": sum([s["cpu_ms"] for s in samples]),
+           "rest_calls": sum([s["rest_calls"] for s in samples]),
+           "rest_calls_by_endpoint": {},
+           "store_bytes_written": sum([s["store_bytes_written"] for s in samples])}
+    for s in samples:
+        for k, v in s["rest_calls_by_endpoint"].items():
+            ret["rest_calls_by_endpoint"][k] = ret["rest_calls_by_endpoint"].get(k, 0) + v
+    return ret
+
+
+def run_scenario(node_count, request_count, store_backend):
+    '''
+    Runs one scenario in a child process, so that peak RSS and module state belong to that scenario only.
+    '''
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([TEST_DIR, SRC_DIR] + [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p])
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-scenario", str(node_count), str(request_count),
+                           "--store-backend", store_backend], stdout=subprocess.PIPE, env=env)
+    if proc.returncode != 0:
+        raise RuntimeError("Scenario nodes=%s requests=%s failed with exit code %s" % (node_count, request_count, proc.returncode))
+    return json.loads(proc.stdout.decode().strip().splitlines()[-1])
+
+
+def _key(node_count, request_count):
+    return "nodes=%d,requests=%d" % (node_count, request_count)
+
+
+def compare(results, baseline, threshold):
+    '''
+    Returns a list of regressions against the baseline.
+    '''
+    regressions = []
+    for key, scenario in results.items():
+        if key not in baseline:
+            continue
+        for cmd, r in scenario["commands"].items():
+            b = baseline[key]["commands"].get(cmd)
+            if not b:
+                continue
+            if b["wall_ms"] and r["wall_ms"] > b["wall_ms"] * (1 + threshold):
+                regressions.append("%s %s wall_ms %.1f -> %.1f" % (key, cmd, b["wall_ms"], r["wall_ms"]))
+            for metric in ["rest_calls", "store_bytes_written"]:
+                if r[metric] > b[metric]:
+                    regressions.append("%s %s %s %d -> %d" % (key, cmd, metric, b[metric], r[metric]))
+    return regressions
+
+
+def _delta(value, base):
+    if not base:
+        return ""
+    return " (%+.0f%%)" % (100.0 * (value - base) / base)
+
+
+def report(results, baseline=None):
+    for key, scenario in results.items():
+        print("%s: %d nodes, %d in requests, peak rss %.1f MB%s" % (key, scenario["nodes"], scenario["request_nodes"],
+                                                                  scenario["peak_rss_kb"] / 1024.0,
+                                                                  _delta(scenario["peak_rss_kb"], (baseline or {}).get(key, {}).get("peak_rss_kb"))))
+        print("    %-20s %16s %16s %10s %14s" % ("command", "wall ms", "cpu ms", "rest", "store bytes"))
+        for cmd, r in scenario["commands"].items():
+            b = (baseline or {}).get(key, {}).get("commands", {}).get(cmd, {})
+            print("    %-20s %16s %16s %10s %14s" % (cmd,
+                                                    "%.1f%s" % (r["wall_ms"], _delta(r["wall_ms"], b.get("wall_ms"))),
+                                                    "%.1f%s" % (r["cpu_ms"], _delta(r["cpu_ms"], b.get("cpu_ms"))),
+                                                    r["rest_calls"], r["store_bytes_written"]))
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="End to end provider command benchmark against a synthetic cluster")
+    parser.add_argument("--nodes", type=int, nargs="+", default=DEFAULT_NODES)
+    parser.add_argument("--requests", type=int, nargs="+", default=DEFAULT_REQUESTS)
+    parser.add_argument("--store-backend", default="json")
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare against results written earlier with --save")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed wall time regression, as a fraction")
+    parser.add_argument("--run-scenario", type=int, nargs=2, metavar=("NODES", "REQUESTS"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+
+    if args.run_scenario:
+        workdir = tempfile.mkdtemp(prefix="command_bench_")
+        try:
+            result = Scenario(args.run_scenario[0], args.run_scenario[1], workdir, args.store_backend).run()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(json.dumps(result))
+        return 0
+
+    results = {}
+    for node_count in args.nodes:
+        for request_count in args.requests:
+            results[_key(node_count, request_count)] = run_scenario(node_count, request_count, args.store_backend)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fr:
+            baseline = json.load(fr)
+    report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as fw:
+            json.dump(results, fw, indent=2)
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print("REGRESSION: %s" % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
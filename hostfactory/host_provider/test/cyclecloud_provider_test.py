@@ -32,7 +32,7 @@ class MockClock:
     
 class MockHostnamer:
     
-    def hostname(self, private_ip_address):
+    def hostname(self, private_ip_address, node_id=None):
         return "ip-" + private_ip_address.replace(".", "-")
     
 
@@ -119,6 +119,9 @@ class MockCluster:
             ret[node["RequestId"]]["nodes"].append(node)
         return ret
             
+    def nodes_by_request_ids(self, request_ids, node_ids_by_request_id=None, chunk_ids_by_request_id=None):
+        return self.nodes(request_ids)
+
     def inodes(self, **attrs):
         '''
         Just yield each node that matches the attrs specified. If the value is a 
@@ -171,6 +174,17 @@ class RequestsStoreInMem:
     def __exit__(self, *args):
         pass
     
+class CountingStoreInMem(RequestsStoreInMem):
+
+    def __init__(self, requests=None):
+        RequestsStoreInMem.__init__(self, requests)
+        self.transactions = 0
+
+    def __enter__(self):
+        self.transactions += 1
+        return RequestsStoreInMem.__enter__(self)
+
+
 class NodeBucket:
     def __init__(self, nodearray, available, vm_size, id, resources, vcpu_count, max_count, software_configuration):
         self.nodearray = nodearray
@@ -854,5 +868,388 @@ class TestHostFactory(unittest.TestCase):
         sys.stdout = saved_stdout
                  
 
+def _merged(defaults, overrides):
+    merged = deepcopy(defaults)
+    for key, value in (overrides or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merged(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class SyntheticProviderTest(unittest.TestCase):
+    '''
+    Runs a CycleCloudProvider against a SyntheticCluster, with the request tracking db in a temporary directory.
+    Subclasses set config to the provider config their tests share.
+    '''
+    config = {}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _provider(self, config=None, node_count=0, clock=None, creation_requests=None, **cluster_kwargs):
+        '''
+        config is merged over the class config. Returns the provider and its SyntheticCluster.
+        '''
+        from synthetic_cluster import SyntheticCluster
+        config = _merged(_merged({"symphony": {"hostfactory": {"db_path": self.tmpdir}}}, self.config), config)
+        provider_config = util.ProviderConfig(config, {})
+        cluster_kwargs.setdefault("padding", False)
+        cluster = SyntheticCluster(provider_config, node_count=node_count, data_dir=self.tmpdir, **cluster_kwargs)
+        provider = cyclecloud_provider.CycleCloudProvider(provider_config, cluster, MockHostnamer(),
+                                                          cyclecloud_provider.quiet_output(),
+                                                          terminate_requests=RequestsStoreInMem(),
+                                                          creation_requests=creation_requests or RequestsStoreInMem(),
+                                                          clock=clock or MockClock((1970, 1, 1, 0, 0, 0)))
+        provider._template_index = MagicMock()
+        provider._template_index.return_value.vm_types.return_value = {"Standard_F2s_v2": 1}
+        provider.launch_create_worker = MagicMock()
+        return provider, cluster
+
+    def _create(self, provider, template_id, count):
+        # an output handler can only be written once
+        provider.stdout_handler = cyclecloud_provider.quiet_output()
+        return provider.create_machines({"template": {"templateId": template_id, "machineCount": count}, "user_data": {}})
+
+    def _status(self, provider, *request_ids):
+        return provider._create_status({"requests": [{"requestId": r} for r in request_ids]},
+                                       cyclecloud_provider.quiet_output())["requests"]
+
+
+class TestCreateStatus(SyntheticProviderTest):
+
+    def _create_status(self, status_workers, request_count=12):
+        provider, cluster = self._provider({"symphony": {"terminate_failed_nodes": True,
+                                                         "hostfactory": {"status_workers": status_workers}}},
+                                           creation_requests=CountingStoreInMem(), padding=True, seed=1)
+        creation_requests = provider.creation_json
+        request_ids = ["req-%d" % i for i in range(request_count)]
+        for request_id in request_ids:
+            nodes = [cluster.new_node("execute", "Standard_F2s_v2", 2, state="Acquiring", request_id=request_id) for _ in range(5)]
+            for node in nodes:
+                cluster.add_node(node)
+            cluster.operations[request_id + "-create"] = nodes
+            cluster.advance(nodes, ready=0.6, preparing=0.2, failed=0.2)
+        cluster.shutdown_nodes = MagicMock()
+
+        provider.request_tracker.reset()
+        response = provider._create_status({"requests": [{"requestId": r} for r in request_ids]})
+        for request in response["requests"]:
+            for machine in request["machines"]:
+                machine.pop("launchtime")
+        # one locked update of the store for all of the requests
+        self.assertEqual(1, creation_requests.transactions)
+        return response, creation_requests.requests, cluster.shutdown_nodes
+
+    def test_concurrent_matches_sequential(self):
+        sequential, sequential_store, sequential_shutdown = self._create_status(1)
+        concurrent, concurrent_store, concurrent_shutdown = self._create_status(4)
+        self.assertEqual(sequential, concurrent)
+        self.assertEqual(sequential_store, concurrent_store)
+        self.assertEqual(["req-%d" % i for i in range(12)], [r["requestId"] for r in concurrent["requests"]])
+        self.assertIn(RequestStates.running, [r["status"] for r in concurrent["requests"]])
+
+        # failed nodes are shut down together, once every request has been evaluated
+        self.assertEqual(1, concurrent_shutdown.call_count)
+        self.assertEqual(sequential_shutdown.call_args, concurrent_shutdown.call_args)
+        self.assertTrue(concurrent_shutdown.call_args[0][0])
+
+    def test_failed_evaluation(self):
+        provider, cluster = self._provider({"symphony": {"hostfactory": {"status_workers": 4}}})
+        request_ids = ["req-%d" % i for i in range(6)]
+        for request_id in request_ids:
+            nodes = [cluster.new_node("execute", "Standard_F2s_v2", 2, request_id=request_id) for _ in range(2)]
+            for node in nodes:
+                cluster.add_node(node)
+            cluster.operations[request_id + "-create"] = nodes
+        evaluate = provider._evaluate_create_request
+
+        def broken_evaluate(request_id, *args):
+            if request_id == "req-3":
+                raise RuntimeError("broken")
+            return evaluate(request_id, *args)
+
+        provider._evaluate_create_request = broken_evaluate
+        response = self._status(provider, *request_ids)
+        # only the request that failed is reported as running, and its state is left for the next call
+        self.assertEqual(request_ids, [r["requestId"] for r in response])
+        self.assertEqual([RequestStates.complete] * 3 + [RequestStates.running] + [RequestStates.complete] * 2,
+                         [r["status"] for r in response])
+        stored = provider.creation_json.read()
+        self.assertNotIn("req-3", stored)
+        self.assertTrue(stored["req-4"]["completed"])
+
+
+class TestChunkedCreate(SyntheticProviderTest):
+    config = {"cyclecloud": {"bootup": {"chunk_size": 8}}}
+
+    def test_chunked_create_and_status(self):
+        from synthetic_cluster import SyntheticNodeManager
+        provider, cluster = self._provider()
+        bootup = SyntheticNodeManager.bootup
+
+        def flaky_bootup(node_mgr, nodes=None, request_id_start=None, request_id_create=None):
+            booted = bootup(node_mgr, nodes, request_id_start, request_id_create)
+            if request_id_create.endswith("-c1-create"):
+                # the nodes were created, but the response never arrived
+                raise RuntimeError("timed out")
+            return booted
+
+        # the chunks are booted by several node managers at once
+        with patch.object(SyntheticNodeManager, "bootup", flaky_bootup):
+            response = self._create(provider, "execute", 20)
+        self.assertEqual(RequestStates.running, response["status"])
+        request_id = response["requestId"]
+        stored = provider.creation_json.read()[request_id]
+        self.assertEqual([request_id + "-c0", request_id + "-c1", request_id + "-c2"], stored["chunks"])
+        # not every chunk answered, so the node ids are looked up by chunk
+        self.assertIsNone(stored["allNodes"])
+
+        status = self._status(provider, request_id)
+        self.assertEqual([request_id], [r["requestId"] for r in status])
+        self.assertEqual(RequestStates.running, status[0]["status"])
+        # all three chunks were found, including the one whose bootup did not answer
+        self.assertEqual(20, len(provider.creation_json.read()[request_id]["allNodes"]))
+
+    def test_every_chunk_failed(self):
+        from synthetic_cluster import SyntheticNodeManager
+        provider, cluster = self._provider()
+
+        def broken_bootup(node_mgr, nodes=None, request_id_start=None, request_id_create=None):
+            raise RuntimeError("timed out")
+
+        with patch.object(SyntheticNodeManager, "bootup", broken_bootup):
+            response = self._create(provider, "execute", 20)
+        self.assertEqual(RequestStates.complete_with_error, response["status"])
+        self.assertIn("No nodes were created", response["message"])
+
+
+class TestAsyncCreate(SyntheticProviderTest):
+    config = {"symphony": {"hostfactory": {"async_create": {"enabled": True}}}}
+
+    def test_async_create(self):
+        clock = MockClock((1970, 1, 1, 0, 0, 0))
+        provider, cluster = self._provider(clock=clock)
+        response = self._create(provider, "execute", 4)
+        request_id = response["requestId"]
+        self.assertEqual(RequestStates.running, response["status"])
+        provider.launch_create_worker.assert_called_once_with(request_id)
+        # nothing was allocated or booted yet
+        self.assertEqual(0, cluster.rest_calls["POST /clusters/{cluster}/nodes/create"])
+        self.assertEqual(RequestStates.running, self._status(provider, request_id)[0]["status"])
+        self.assertEqual(0, cluster.rest_calls["GET /operations?request_id"])
+
+        worker_response = provider.create_machines_worker({"requestId": request_id})
+        self.assertEqual(RequestStates.running, worker_response["status"])
+        self.assertEqual(1, cluster.rest_calls["POST /clusters/{cluster}/nodes/create"])
+        stored = provider.creation_json.read()[request_id]
+        self.assertNotIn("pending", stored)
+        self.assertEqual(4, len(stored["allNodes"]))
+
+        # a second worker for the same request does nothing
+        provider.create_machines_worker({"requestId": request_id})
+        self.assertEqual(1, cluster.rest_calls["POST /clusters/{cluster}/nodes/create"])
+
+        cluster.advance(cluster.request_nodes(request_id), ready=1)
+        self.assertEqual(RequestStates.complete, self._status(provider, request_id)[0]["status"])
+
+    def test_async_create_error(self):
+        provider, cluster = self._provider()
+        provider._template_index.return_value.vm_types.return_value = {"Standard_Missing": 1}
+        request_id = self._create(provider, "missing", 4)["requestId"]
+        self.assertEqual(RequestStates.complete_with_error, provider.create_machines_worker({"requestId": request_id})["status"])
+        status = self._status(provider, request_id)[0]
+        self.assertEqual(RequestStates.complete_with_error, status["status"])
+        self.assertIn("No nodes were created", status["message"])
+
+    def test_worker_never_finished(self):
+        clock = MockClock((1970, 1, 1, 0, 0, 0))
+        provider, cluster = self._provider(clock=clock)
+        provider.launch_create_worker.side_effect = OSError("fork failed")
+        # without a worker the nodes are created right away
+        response = self._create(provider, "execute", 2)
+        self.assertEqual(RequestStates.running, response["status"])
+        self.assertEqual(2, len(provider.creation_json.read()[response["requestId"]]["allNodes"]))
+
+        provider.launch_create_worker.side_effect = None
+        request_id = self._create(provider, "execute", 2)["requestId"]
+        self.assertEqual(RequestStates.running, self._status(provider, request_id)[0]["status"])
+        # a worker that claimed the request but did not finish within async_create.timeout most likely died,
+        # and the request is looked up in CycleCloud like any other
+        with provider.creation_json as requests_store:
+            requests_store[request_id]["pending"]["startedTime"] = 30
+        clock.now = (1970, 1, 1, 0, 16, 0)
+        self._status(provider, request_id)
+        self.assertEqual(2, cluster.rest_calls["GET /operations?request_id"])
+
+    def test_worker_never_claimed(self):
+        clock = MockClock((1970, 1, 1, 0, 0, 0))
+        provider, cluster = self._provider(clock=clock)
+        request_id = self._create(provider, "execute", 2)["requestId"]
+        self.assertEqual(1, provider.launch_create_worker.call_count)
+
+        # after async_create.claim_timeout another worker is started
+        clock.now = (1970, 1, 1, 0, 1, 1)
+        self.assertEqual(RequestStates.running, self._status(provider, request_id)[0]["status"])
+        provider.launch_create_worker.assert_called_with(request_id)
+        self.assertEqual(2, provider.launch_create_worker.call_count)
+        self.assertEqual(RequestStates.running, self._status(provider, request_id)[0]["status"])
+        self.assertEqual(2, provider.launch_create_worker.call_count)
+
+        # and if that one does not claim it either, the request fails
+        clock.now = (1970, 1, 1, 0, 2, 2)
+        status = self._status(provider, request_id)[0]
+        self.assertEqual(RequestStates.complete_with_error, status["status"])
+        self.assertIn("No create worker", status["message"])
+        self.assertEqual(0, cluster.rest_calls["GET /operations?request_id"])
+        # a late worker finds nothing to do
+        provider.create_machines_worker({"requestId": request_id})
+        self.assertEqual(0, cluster.rest_calls["POST /clusters/{cluster}/nodes/create"])
+
+
+class TestCoalescedCreate(SyntheticProviderTest):
+    config = {"symphony": {"hostfactory": {"coalesce_window": 0.01, "async_create": {"enabled": True}}}}
+
+    def test_coalesced(self):
+        provider, cluster = self._provider()
+        request_ids = [self._create(provider, "execute", count)["requestId"] for count in [2, 4, 2]]
+        other_id = self._create(provider, "other", 1)["requestId"]
+
+        response = provider.create_machines_worker({"requestId": request_ids[1]})
+        self.assertEqual(RequestStates.running, response["status"])
+        # one bootup for all three requests for the template, split by their counts
+        self.assertEqual(1, cluster.rest_calls["POST /clusters/{cluster}/nodes/create"])
+        stored = provider.creation_json.read()
+        self.assertEqual([2, 4, 2], [len(stored[r]["allNodes"]) for r in request_ids])
+        self.assertEqual(8, len(set(n for r in request_ids for n in stored[r]["allNodes"])))
+        self.assertTrue(all("pending" not in stored[r] for r in request_ids))
+        # the other template is left for its own worker
+        self.assertIn("pending", stored[other_id])
+        self.assertEqual(3, len(provider.request_tracker.get_requests()))
+
+        # the workers of the coalesced requests have nothing left to do
+        for request_id in [request_ids[0], request_ids[2]]:
+            provider.create_machines_worker({"requestId": request_id})
+        self.assertEqual(1, cluster.rest_calls["POST /clusters/{cluster}/nodes/create"])
+
+        cluster.advance(cluster.request_nodes(request_ids[1]), ready=1)
+        status = self._status(provider, *request_ids)
+        self.assertEqual([RequestStates.complete] * 3, [r["status"] for r in status])
+        self.assertEqual([2, 4, 2], [len(r["machines"]) for r in status])
+
+    def test_coalesced_error(self):
+        provider, cluster = self._provider()
+        provider._template_index.return_value.vm_types.return_value = {"Standard_Missing": 1}
+        request_ids = [self._create(provider, "missing", 2)["requestId"] for _ in range(2)]
+        provider.create_machines_worker({"requestId": request_ids[0]})
+        stored = provider.creation_json.read()
+        self.assertTrue(all(stored[r]["completed"] and "No nodes" in stored[r]["error"] for r in request_ids))
+
+    def test_split_at_status(self):
+        provider, cluster = self._provider()
+        bootup = cluster.synthetic_node_mgr.bootup
+
+        def lost_bootup(nodes=None, request_id_start=None, request_id_create=None):
+            bootup(nodes, request_id_start, request_id_create)
+            # the nodes were created, but the response never arrived
+            raise RuntimeError("timed out")
+
+        cluster.synthetic_node_mgr.bootup = lost_bootup
+        request_ids = [self._create(provider, "execute", count)["requestId"] for count in [2, 4, 2]]
+        response = provider.create_machines_worker({"requestId": request_ids[0]})
+        self.assertEqual(RequestStates.running, response["status"])
+        stored = provider.creation_json.read()
+        self.assertTrue(all(stored[r]["allNodes"] is None for r in request_ids))
+        cluster.advance(cluster.request_nodes(request_ids[0]), ready=1)
+
+        # a status call for one member splits the nodes of the whole allocation, and records every share
+        status = self._status(provider, request_ids[1])
+        self.assertEqual(4, len(status[0]["machines"]))
+        stored = provider.creation_json.read()
+        self.assertEqual([2, 4, 2], [len(stored[r]["allNodes"]) for r in request_ids])
+        self.assertEqual(8, len(set(n for r in request_ids for n in stored[r]["allNodes"])))
+
+        status = self._status(provider, *request_ids)
+        self.assertEqual([2, 4, 2], [len(r["machines"]) for r in status])
+
+    def test_empty_share(self):
+        provider, cluster = self._provider()
+        # two nodes of two slots each for three requests of one slot
+        provider._template_index.return_value.vm_types.return_value = {"Standard_F2s_v2": 2}
+        request_ids = [self._create(provider, "execute", 1)["requestId"] for _ in range(3)]
+        provider.create_machines_worker({"requestId": request_ids[0]})
+        stored = provider.creation_json.read()
+        self.assertEqual([1, 1, 0], [len(stored[r]["allNodes"]) for r in request_ids])
+        self.assertIn("No nodes were created", stored[request_ids[2]]["error"])
+
+        status = self._status(provider, *request_ids)
+        self.assertEqual(RequestStates.complete_with_error, status[2]["status"])
+
+    def test_sync(self):
+        provider, cluster = self._provider({"symphony": {"hostfactory": {"async_create": {"enabled": False}}}})
+        request_id = self._create(provider, "execute", 3)["requestId"]
+        provider.launch_create_worker.assert_not_called()
+        self.assertEqual(1, cluster.rest_calls["POST /clusters/{cluster}/nodes/create"])
+        stored = provider.creation_json.read()[request_id]
+        self.assertNotIn("pending", stored)
+        self.assertEqual(3, len(stored["allNodes"]))
+
+    def test_sync_unclaimed(self):
+        clock = MockClock((1970, 1, 1, 0, 0, 0))
+        provider, cluster = self._provider({"symphony": {"hostfactory": {"async_create": {"enabled": False}}}}, clock=clock)
+        # left pending by a create_machines call that died before it claimed the request
+        request_id = "req-died"
+        with provider.creation_json as requests_store:
+            requests_store[request_id] = {"requestTime": 0, "completedNodes": [], "allNodes": None, "completed": False,
+                                          "pending": {"template": {"templateId": "execute", "machineCount": 2}}}
+
+        clock.now = (1970, 1, 1, 0, 1, 1)
+        status = self._status(provider, request_id)[0]
+        # no worker is started when asynchronous creates are disabled, the request fails instead
+        provider.launch_create_worker.assert_not_called()
+        self.assertEqual(RequestStates.complete_with_error, status["status"])
+        self.assertIn("did not finish", status["message"])
+        self.assertNotIn("pending", provider.creation_json.read()[request_id])
+
+
+class TestPartialShutdown(SyntheticProviderTest):
+
+    def test_retry_failed_ids_only(self):
+        provider, cluster = self._provider(node_count=3)
+        node_ids = list(cluster.nodes)
+        posted = []
+        post = cluster.post
+
+        def busy_post(url, json=None, **kwargs):
+            posted.append(list(json["ids"]))
+            if node_ids[1] in json["ids"]:
+                return '{"nodes": [{"id": "%s", "status": "Error", "error": "Busy"}]}' % node_ids[1]
+            return post(url, json=json, **kwargs)
+
+        cluster.post = busy_post
+        response = provider.terminate_machines({"machines": [{"name": "h%d" % i, "machineId": m} for i, m in enumerate(node_ids)]})
+        self.assertEqual(RequestStates.running, response["status"])
+        termination = provider.terminate_json.read()[response["requestId"]]
+        self.assertEqual([node_ids[1]], termination["failed"])
+        self.assertFalse(termination.get("terminated"))
+
+        status = provider._terminate_status({"requests": [{"requestId": response["requestId"]}]})
+        self.assertEqual([node_ids[1]], posted[-1])
+        self.assertEqual(RequestStates.running, status["requests"][0]["status"])
+        self.assertEqual([MachineStates.deleted, MachineStates.deleting, MachineStates.deleted],
+                         [m["status"] for m in status["requests"][0]["machines"]])
+
+        cluster.post = post
+        status = provider._terminate_status({"requests": [{"requestId": response["requestId"]}]})
+        self.assertEqual(RequestStates.complete, status["requests"][0]["status"])
+        self.assertTrue(provider.terminate_json.read()[response["requestId"]]["terminated"])
+        self.assertNotIn("failed", provider.terminate_json.read()[response["requestId"]])
+        self.assertEqual("Terminating", cluster.nodes[node_ids[1]].state)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,417 @@
+'''
+Local stand-in for the CycleCloud REST API, for load and latency testing without a live CycleCloud.
+
+FakeCycleCloud serves, over real HTTP, the endpoints the provider and scalelib use:
+
+    GET  /clusters/{cluster}/status[?nodes=true]
+    GET  /clusters/{cluster}/nodes[?operation={id}]
+    POST /clusters/{cluster}/nodes/create          {"requestId", "sets": [{"nodearray", "count", "definition": {"machineType"}}]}
+    POST /clusters/{cluster}/nodes/{start,shutdown,deallocate,terminate,remove}   {"requestId", "ids" | "names"}
+    GET  /operations/?request_id={id}
+    GET  /operations/{id}
+
+Nodes go through Acquiring -> Preparing -> Ready, or end in Failed, on a simulated clock. Every request can be
+slowed down (latency + jitter) or throttled with a 429 and a Retry-After, and creates that exceed a bucket's
+capacity only add what fits and record a capacity failure on the bucket.
+
+    server = FakeCycleCloud(nodearrays={"execute": {"Standard_F2s_v2": 2}}, latency=0.05, throttle_rate=0.01)
+    with server:
+        provider_config.set("cyclecloud.config.web_server", server.url)
+        ...
+
+or from the command line, to point a provider at it:
+
+    python test/fake_cyclecloud.py --port 9443 --cluster symphony --nodes 1000 --latency 0.05 --throttle-rate 0.01
+'''
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+DEFAULT_NODEARRAYS = {"execute": {"Standard_F2s_v2": 2, "Standard_F4s_v2": 4, "Standard_F8s_v2": 8},
+                      "lp_execute": {"Standard_D2_v3": 2, "Standard_D4_v3": 4}}
+
+
+class FakeNode:
+
+    def __init__(self, index, nodearray, vm_size, vcpu_count, created_at, request_id=None, operation_id=None):
+        self.node_id = "nid-%s" % uuid.UUID(int=index)
+        self.index = index
+        self.name = "%s-%d" % (nodearray, index)
+        self.nodearray = nodearray
+        self.vm_size = vm_size
+        self.vcpu_count = vcpu_count
+        self.request_id = request_id
+        self.operation_id = operation_id
+        self.created_at = created_at
+        self.target_state = "Started"
+        self.stopped_at = None
+        # decided up front, so that a node fails the same way no matter when it is looked at
+        self.failed = False
+        self.status_message = None
+
+    @property
+    def private_ip(self):
+        return "10.%d.%d.%d" % (self.index // 65536 % 256, self.index // 256 % 256, self.index % 256)
+
+    def state(self, now, lifecycle):
+        if self.stopped_at is not None:
+            return "Terminated" if now - self.stopped_at >= lifecycle["terminate"] else "Terminating"
+        age = now - self.created_at
+        if age < lifecycle["acquire"]:
+            return "Acquiring"
+        if age < lifecycle["acquire"] + lifecycle["prepare"]:
+            return "Preparing"
+        return "Failed" if self.failed else "Ready"
+
+    def to_json(self, now, lifecycle):
+        state = self.state(now, lifecycle)
+        ret = {"Name": self.name,
+               "NodeId": self.node_id,
+               "Template": self.nodearray,
+               "MachineType": self.vm_size,
+               "Status": state,
+               "TargetState": self.target_state,
+               "Configuration": {"autoscaling": {"enabled": True}},
+               "CoreCount": self.vcpu_count}
+        if state != "Acquiring":
+            ret["InstanceId"] = "i-%08d" % self.index
+            ret["PrivateIp"] = self.private_ip
+            ret["Hostname"] = "ip-%s" % self.private_ip.replace(".", "-")
+        if state == "Failed":
+            ret["StatusMessage"] = self.status_message
+        if self.request_id:
+            ret["RequestId"] = self.request_id
+        return ret
+
+
+class FakeBucket:
+
+    def __init__(self, nodearray, vm_size, vcpu_count, max_count):
+        self.nodearray = nodearray
+        self.vm_size = vm_size
+        self.vcpu_count = vcpu_count
+        self.max_count = max_count
+        self.last_capacity_failure = None
+
+    def to_json(self, active_count):
+        available = max(0, self.max_count - active_count)
+        ret = {"bucketId": "%s-%s" % (self.nodearray, self.vm_size),
+               "definition": {"machineType": self.vm_size},
+               "maxCount": self.max_count,
+               "activeCount": active_count,
+               "availableCount": available,
+               "maxCoreCount": self.max_count * self.vcpu_count,
+               "activeCoreCount": active_count * self.vcpu_count,
+               "availableCoreCount": available * self.vcpu_count,
+               "virtualMachine": {"vcpuCount": self.vcpu_count, "pcpuCount": self.vcpu_count,
+                                  "memory": self.vcpu_count * 4.0, "gpuCount": 0, "infiniband": False}}
+        if self.last_capacity_failure is not None:
+            ret["lastCapacityFailure"] = self.last_capacity_failure
+        return ret
+
+
+class FakeCycleCloud:
+    '''
+    nodearrays: {nodearray: {vm_size: vcpu_count}}
+    node_count: Ready nodes that exist before any request, spread over the buckets
+    max_count: capacity of each bucket, creates beyond it are capacity failures
+    acquire_seconds/prepare_seconds/terminate_seconds: node life cycle, on clock
+    failure_rate: fraction of created nodes that end up Failed instead of Ready
+    latency/jitter: seconds added to every response
+    throttle_rate: fraction of requests refused with a 429 and Retry-After: retry_after
+    clock: time source for the node life cycle, e.g. to move nodes along in tests without sleeping
+    '''
+
+    def __init__(self, cluster_name="symphony", nodearrays=None, node_count=0, max_count=1000, acquire_seconds=30,
+                 prepare_seconds=60, terminate_seconds=30, failure_rate=0.0, latency=0.0, jitter=0.0,
+                 throttle_rate=0.0, retry_after=1, seed=None, clock=time.time, host="127.0.0.1", port=0):
+        self.cluster_name = cluster_name
+        self.lifecycle = {"acquire": acquire_seconds, "prepare": prepare_seconds, "terminate": terminate_seconds}
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.lock = threading.RLock()
+        # endpoint -> count, where endpoint is "METHOD /path" with the cluster name and ids replaced
+        self.calls = {}
+        self.throttled = 0
+
+        self.buckets = {}
+        for nodearray, vm_types in (nodearrays or DEFAULT_NODEARRAYS).items():
+            for vm_size, vcpu_count in vm_types.items():
+                self.buckets[(nodearray, vm_size)] = FakeBucket(nodearray, vm_size, vcpu_count, max_count)
+
+        self.nodes = {}
+        self.operations = {}
+        self._next_index = 1
+        now = self.clock()
+        buckets = list(self.buckets.values())
+        for i in range(node_count):
+            bucket = buckets[i % len(buckets)]
+            # old enough to be Ready already
+            self._add_node(bucket, now - acquire_seconds - prepare_seconds)
+
+        self.httpd = ThreadingHTTPServer((host, port), _handler_class(self))
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread:
+            self.thread.join(5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _add_node(self, bucket, created_at, request_id=None, operation_id=None):
+        node = FakeNode(self._next_index, bucket.nodearray, bucket.vm_size, bucket.vcpu_count, created_at,
+                        request_id, operation_id)
+        self._next_index += 1
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            node.failed = True
+            node.status_message = "Simulated provisioning failure"
+        self.nodes[node.node_id] = node
+        return node
+
+    def _active_count(self, bucket):
+        return len([n for n in self.nodes.values()
+                    if n.nodearray == bucket.nodearray and n.vm_size == bucket.vm_size and n.stopped_at is None])
+
+    def _new_operation(self, action, request_id, nodes):
+        operation_id = str(uuid.uuid4())
+        self.operations[operation_id] = {"operationId": operation_id, "action": action, "requestId": request_id,
+                                         "startTime": self.clock(), "nodeIds": [n.node_id for n in nodes]}
+        return operation_id
+
+    # endpoints: each returns (status_code, json body)
+
+    def status(self, query):
+        now = self.clock()
+        nodearrays = {}
+        for bucket in self.buckets.values():
+            if bucket.nodearray not in nodearrays:
+                nodearrays[bucket.nodearray] = {"name": bucket.nodearray, "buckets": [],
+                                                "nodearray": {"Configuration": {"autoscaling": {"enabled": True}},
+                                                              "Interruptible": bucket.nodearray.startswith("lp_")}}
+            nodearrays[bucket.nodearray]["buckets"].append(bucket.to_json(self._active_count(bucket)))
+        ret = {"state": "Started", "nodearrays": list(nodearrays.values()),
+               "maxCount": sum([b.max_count for b in self.buckets.values()]),
+               "maxCoreCount": sum([b.max_count * b.vcpu_count for b in self.buckets.values()])}
+        if query.get("nodes") == "true":
+            ret["nodes"] = [n.to_json(now, self.lifecycle) for n in self.nodes.values()]
+        return 200, ret
+
+    def list_nodes(self, query):
+        now = self.clock()
+        operation_id = query.get("operation")
+        if operation_id:
+            operation = self.operations.get(operation_id)
+            if not operation:
+                return 404, {"message": "No operation found with id %s" % operation_id}
+            nodes = [self.nodes[i] for i in operation["nodeIds"] if i in self.nodes]
+            return 200, {"operation": operation, "nodes": [n.to_json(now, self.lifecycle) for n in nodes]}
+        return 200, {"nodes": [n.to_json(now, self.lifecycle) for n in self.nodes.values()]}
+
+    def create(self, body):
+        request_id = body.get("requestId")
+        now = self.clock()
+        created = []
+        added_by_set = []
+        for node_set in body.get("sets", []):
+            bucket = self.buckets.get((node_set.get("nodearray"), (node_set.get("definition") or {}).get("machineType")))
+            if bucket is None:
+                return 400, {"message": "Unknown nodearray/machineType %s" % node_set}
+            count = int(node_set.get("count", 0))
+            available = max(0, bucket.max_count - self._active_count(bucket))
+            if count > available:
+                bucket.last_capacity_failure = now
+            added = [self._add_node(bucket, now, request_id) for _ in range(min(count, available))]
+            created.extend(added)
+            added_by_set.append({"added": len(added),
+                                 "message": "" if len(added) == count else "Only %d of %d nodes fit in %s" % (len(added), count, bucket.vm_size)})
+        operation_id = self._new_operation("create", request_id, created)
+        for node in created:
+            node.operation_id = operation_id
+        return 200, {"operationId": operation_id, "sets": added_by_set}
+
+    def _select(self, body):
+        if "ids" in body:
+            wanted = set(body["ids"])
+            return [n for n in self.nodes.values() if n.node_id in wanted], wanted
+        wanted = set(body.get("names", []))
+        return [n for n in self.nodes.values() if n.name in wanted], wanted
+
+    def node_action(self, action, body):
+        now = self.clock()
+        nodes, wanted = self._select(body)
+        found = set()
+        results = []
+        for node in nodes:
+            found.update([node.node_id, node.name])
+            if action == "start":
+                node.stopped_at = None
+                node.target_state = "Started"
+                node.created_at = now
+            elif action == "remove":
+                self.nodes.pop(node.node_id, None)
+            else:
+                node.target_state = "Deallocated" if action == "deallocate" else "Terminated"
+                if node.stopped_at is None:
+                    node.stopped_at = now
+            results.append({"id": node.node_id, "name": node.name, "status": "OK"})
+        for missing in wanted - found:
+            results.append({"id": missing, "status": "Error", "error": "Node not found"})
+        operation_id = self._new_operation(action, body.get("requestId"), nodes)
+        return 200, {"operationId": operation_id, "nodes": results}
+
+    def operations_by_request_id(self, query):
+        request_id = query.get("request_id")
+        matches = [op for op in self.operations.values() if op["requestId"] == request_id]
+        if not matches:
+            return 404, {"message": "No operation found for request id %s" % request_id}
+        return 200, matches
+
+    def operation(self, operation_id):
+        if operation_id not in self.operations:
+            return 404, {"message": "No operation found with id %s" % operation_id}
+        return 200, self.operations[operation_id]
+
+    def dispatch(self, method, path, query, body):
+        '''
+        Returns (endpoint, status_code, json body) for one request.
+        '''
+        m = re.match(r"^/clusters/([^/]+)(/.*)?$", path)
+        if m:
+            if m.group(1) != self.cluster_name:
+                return "%s /clusters/{cluster}%s" % (method, m.group(2) or ""), 404, {"message": "No cluster %s" % m.group(1)}
+            sub_path = m.group(2) or ""
+            endpoint = "%s /clusters/{cluster}%s" % (method, sub_path)
+            if method == "GET" and sub_path == "/status":
+                return (endpoint,) + self.status(query)
+            if method == "GET" and sub_path == "/nodes":
+                return (endpoint,) + self.list_nodes(query)
+            if method == "POST" and sub_path == "/nodes/create":
+                return (endpoint,) + self.create(body)
+            action = re.match(r"^/nodes/(start|shutdown|deallocate|terminate|remove)$", sub_path)
+            if method == "POST" and action:
+                return (endpoint,) + self.node_action(action.group(1), body)
+            return endpoint, 404, {"message": "Not found"}
+
+        if method == "GET" and path.rstrip("/") == "/operations":
+            return ("GET /operations",) + self.operations_by_request_id(query)
+        m = re.match(r"^/operations/([^/]+)$", path)
+        if method == "GET" and m:
+            return ("GET /operations/{id}",) + self.operation(m.group(1))
+        return "%s %s" % (method, path), 404, {"message": "Not found"}
+
+    def handle(self, method, url, raw_body):
+        '''
+        Returns (status_code, headers, json body), applying latency and throttling.
+        '''
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        parsed = urlparse(url)
+        query = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+        with self.lock:
+            if self.throttle_rate and self.random.random() < self.throttle_rate:
+                self.throttled += 1
+                return 429, {"Retry-After": str(self.retry_after)}, {"message": "Too many requests"}
+            try:
+                body = json.loads(raw_body) if raw_body else {}
+            except ValueError:
+                return 400, {}, {"message": "Invalid json"}
+            endpoint, status_code, ret = self.dispatch(method, parsed.path, query, body)
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        return status_code, {}, ret
+
+
+def _handler_class(server):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _respond(self, method):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw_body = self.rfile.read(length) if length else b""
+            status_code, headers, body = server.handle(method, self.path, raw_body)
+            content = json.dumps(body).encode()
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            self._respond("GET")
+
+        def do_POST(self):
+            self._respond("POST")
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="Local stand-in for the CycleCloud REST API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9443)
+    parser.add_argument("--cluster", default="symphony")
+    parser.add_argument("--nodes", type=int, default=0, help="Ready nodes to start with")
+    parser.add_argument("--max-count", type=int, default=1000, help="capacity of each bucket")
+    parser.add_argument("--acquire-seconds", type=float, default=30)
+    parser.add_argument("--prepare-seconds", type=float, default=60)
+    parser.add_argument("--terminate-seconds", type=float, default=30)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args(argv[1:])
+
+    server = FakeCycleCloud(cluster_name=args.cluster, node_count=args.nodes, max_count=args.max_count,
+                            acquire_seconds=args.acquire_seconds, prepare_seconds=args.prepare_seconds,
+                            terminate_seconds=args.terminate_seconds, failure_rate=args.failure_rate,
+                            latency=args.latency, jitter=args.jitter, throttle_rate=args.throttle_rate,
+                            retry_after=args.retry_after, host=args.host, port=args.port)
+    print("Serving cluster %s at %s" % (args.cluster, server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import json
+import shutil
+import tempfile
+import time
+import unittest
+
+import cluster
+import util
+from fake_cyclecloud import FakeCycleCloud
+
+
+class MockClock:
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestFakeCycleCloud(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _start(self, **kwargs):
+        server = FakeCycleCloud(cluster_name="symphony", **kwargs).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def _cluster(self, server, retries=0):
+        provider_config = util.ProviderConfig({"cyclecloud": {"config": {"web_server": server.url, "username": "u", "password": "p"},
+                                                              "http": {"retries": retries, "backoff": 0.01}}}, {})
+        return cluster.Cluster("symphony", provider_config, data_dir=self.tmpdir)
+
+    def _create(self, c, request_id, count, nodearray="execute", vm_size="Standard_F2s_v2"):
+        return json.loads(c.post("/clusters/symphony/nodes/create",
+                                 json={"requestId": request_id,
+                                       "sets": [{"nodearray": nodearray, "count": count, "definition": {"machineType": vm_size}}]}))
+
+    def test_lifecycle(self):
+        clock = MockClock()
+        server = self._start(acquire_seconds=10, prepare_seconds=20, failure_rate=0.5, seed=1, clock=clock)
+        c = self._cluster(server)
+
+        created = self._create(c, "req-1-create", 20)
+        self.assertEqual(20, created["sets"][0]["added"])
+
+        def states():
+            nodes = c.nodes_by_operation_id(created["operationId"])["nodes"]
+            self.assertEqual(20, len(nodes))
+            return [n["Status"] for n in nodes], nodes
+
+        self.assertEqual(["Acquiring"] * 20, states()[0])
+        self.assertNotIn("PrivateIp", states()[1][0])
+
+        clock.now += 10
+        self.assertEqual(["Preparing"] * 20, states()[0])
+        self.assertTrue(states()[1][0]["Hostname"])
+
+        clock.now += 20
+        final, nodes = states()
+        self.assertEqual(set(["Ready", "Failed"]), set(final))
+        for node in nodes:
+            if node["Status"] == "Failed":
+                self.assertTrue(node["StatusMessage"])
+
+        operations = c.get("/operations/", request_id="req-1-create")
+        self.assertEqual([created["operationId"]], [op["operationId"] for op in operations])
+        with self.assertRaises(ValueError) as cm:
+            c.get("/operations/", request_id="req-2-create")
+        self.assertIn("No operation found for request id", str(cm.exception))
+
+    def test_terminate(self):
+        clock = MockClock()
+        server = self._start(node_count=4, terminate_seconds=5, clock=clock)
+        c = self._cluster(server)
+
+        nodes = c.all_nodes()["nodes"]
+        self.assertEqual(["Ready"] * 4, [n["Status"] for n in nodes])
+
+        response = c.terminate([{"machineId": nodes[0]["NodeId"]}, {"machineId": "nid-missing"}])
+        self.assertEqual(["OK", "Error"], [n["status"] for n in response["nodes"]])
+
+        by_id = {n["NodeId"]: n for n in c.all_nodes()["nodes"]}
+        self.assertEqual("Terminating", by_id[nodes[0]["NodeId"]]["Status"])
+        self.assertEqual("Terminated", by_id[nodes[0]["NodeId"]]["TargetState"])
+        clock.now += 5
+        self.assertEqual("Terminated", c.all_nodes()["nodes"][0]["Status"])
+
+    def test_capacity(self):
+        server = self._start(nodearrays={"execute": {"Standard_F2s_v2": 2}}, max_count=3)
+        c = self._cluster(server)
+
+        created = self._create(c, "req-1-create", 5)
+        self.assertEqual(3, created["sets"][0]["added"])
+        self.assertTrue(created["sets"][0]["message"])
+
+        bucket = c.status()["nodearrays"][0]["buckets"][0]
+        self.assertEqual(0, bucket["availableCount"])
+        self.assertEqual(3, bucket["activeCount"])
+        self.assertIn("lastCapacityFailure", bucket)
+
+        with self.assertRaises(ValueError):
+            self._create(c, "req-2-create", 1, vm_size="Standard_F64s_v2")
+
+    def test_throttling(self):
+        server = self._start(node_count=2, throttle_rate=1.0)
+        with self.assertRaises(ValueError):
+            self._cluster(server).all_nodes()
+        self.assertEqual(1, server.throttled)
+        self.assertEqual({}, server.calls)
+
+        # Cluster retries 429s, honoring Retry-After
+        server = self._start(node_count=2, throttle_rate=0.5, retry_after=0, seed=3)
+        c = self._cluster(server, retries=20)
+        for _ in range(5):
+            self.assertEqual(2, len(c.all_nodes()["nodes"]))
+        self.assertEqual(5, server.calls["GET /clusters/{cluster}/nodes"])
+        self.assertGreater(server.throttled, 0)
+
+    def test_latency(self):
+        server = self._start(latency=0.05)
+        c = self._cluster(server)
+        started = time.time()
+        c.status()
+        self.assertGreaterEqual(time.time() - started, 0.05)
+
+
+if __name__ == "__main__":
+    unittest.main()
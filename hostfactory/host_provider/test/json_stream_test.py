@@ -0,0 +1,47 @@
+import json
+import random
+import unittest
+
+import json_stream
+
+
+def chunked(data, sizes):
+    i = 0
+    for size in sizes:
+        if i >= len(data):
+            break
+        yield data[i:i + size]
+        i += size
+    if i < len(data):
+        yield data[i:]
+
+
+class TestJsonStream(unittest.TestCase):
+
+    def test_matches_json_loads(self):
+        rand = random.Random(7)
+        nodes = [{"Name": "execute-%d" % i, "NodeId": "n%d" % i, "CoreCount": i * 1.5, "Count": 10 ** i,
+                  "Status": rand.choice(["Ready", "Failed", None]), "Flags": [True, False, None],
+                  "Message": "café ☃ \"quoted\" ,]}", "Configuration": {"autoscaling": {"enabled": i % 2 == 0}}}
+                 for i in range(30)]
+        for doc in [{"nodes": nodes}, {"operation": {"nodes": [1, 2]}, "count": 12345, "nodes": nodes, "after": "x"},
+                    {"nodes": []}]:
+            data = json.dumps(doc, indent=rand.choice([None, 2])).encode()
+            for _ in range(20):
+                sizes = [rand.randint(1, 64) for _ in range(len(data))]
+                self.assertEqual(doc["nodes"], list(json_stream.iter_array(chunked(data, sizes), "nodes")))
+            # one byte at a time splits every number and multi byte character
+            self.assertEqual(doc["nodes"], list(json_stream.iter_array(chunked(data, [1] * len(data)), "nodes")))
+            self.assertEqual(doc["nodes"], list(json_stream.iter_array([data.decode()], "nodes")))
+
+    def test_numbers_split_across_chunks(self):
+        self.assertEqual([12345, 1.5e10], list(json_stream.iter_array([b'{"a": [12', b'345, 1.5', b'e10]}'], "a")))
+
+    def test_malformed(self):
+        for data in [b'', b'[]', b'{}', b'{"other": []}', b'{"nodes": [1, 2', b'{"nodes": [1 2]}', b'{"nodes": {}}']:
+            with self.assertRaises(ValueError, msg=data):
+                list(json_stream.iter_array([data], "nodes"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import metrics
+import util
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_histogram(self):
+        hist = metrics.Histogram([1, 10, 100])
+        for value in [0.5, 0.5, 5, 50, 500]:
+            hist.observe(value)
+        self.assertEqual([2, 1, 1, 1], hist.counts)
+        self.assertEqual(5, hist.count)
+        self.assertEqual(556, hist.sum)
+        self.assertEqual(1, hist.quantile(0.4))
+        self.assertEqual(500, hist.quantile(1.0))
+
+        copy = metrics.Histogram.from_dict(hist.to_dict())
+        copy.merge(hist)
+        self.assertEqual([4, 2, 2, 2], copy.counts)
+        self.assertRaises(ValueError, copy.merge, metrics.Histogram([1, 2]))
+
+    def test_flush(self):
+        path = os.path.join(self.tmpdir, "azurecc_metrics.json")
+        m = metrics.Metrics()
+        m.observe("store.create_requests.json.lock_wait", 0.002)
+        m.increment("creates")
+        m.flush(path)
+        self.assertEqual({}, m.histograms)
+
+        # a second invocation adds to the totals
+        m.observe("store.create_requests.json.lock_wait", 20)
+        m.increment("creates", 2)
+        m.flush(path)
+
+        with open(path) as fr:
+            totals = json.load(fr)
+        self.assertEqual({"creates": 3}, totals["counters"])
+        hist = metrics.Histogram.from_dict(totals["histograms"]["store.create_requests.json.lock_wait"])
+        self.assertEqual(2, hist.count)
+        self.assertEqual(20, hist.max)
+
+    def test_span(self):
+        metrics.METRICS.reset()
+        self.addCleanup(metrics.METRICS.reset)
+
+        with metrics.span("cluster.get"):
+            pass
+
+        @metrics.span("scalelib.bootup")
+        def bootup():
+            return "booted"
+
+        self.assertEqual("booted", bootup())
+        self.assertEqual("booted", bootup())
+        self.assertEqual(1, metrics.METRICS.histograms["span.cluster.get"].count)
+        self.assertEqual(2, metrics.METRICS.histograms["span.scalelib.bootup"].count)
+        summary = metrics.METRICS.span_summary()
+        self.assertIn("cluster.get=1x/", summary)
+        self.assertIn("scalelib.bootup=2x/", summary)
+
+    def test_flush_by_command(self):
+        path = os.path.join(self.tmpdir, "azurecc_metrics.json")
+        prometheus_path = os.path.join(self.tmpdir, "azurecc.prom")
+        m = metrics.Metrics()
+        m.command = "create_status"
+        m.observe("span.cluster.get", 0.02)
+        m.observe("store.create_requests.json.lock_wait", 0.002)
+        m.increment("store.create_requests.json.lock_contended")
+        m.flush(path, prometheus_path=prometheus_path)
+        self.assertIsNone(m.command)
+
+        m.command = "templates"
+        m.observe("span.cluster.get", 2)
+        m.flush(path, prometheus_path=prometheus_path)
+
+        with open(path) as fr:
+            totals = json.load(fr)
+        self.assertEqual(2, totals["histograms"]["span.cluster.get"]["count"])
+        self.assertEqual(["create_status", "templates"], sorted(totals["commands"]))
+        self.assertEqual(1, totals["commands"]["templates"]["histograms"]["span.cluster.get"]["count"])
+
+        with open(prometheus_path) as fr:
+            lines = fr.read().splitlines()
+        self.assertIn("# TYPE azurecc_span_seconds histogram", lines)
+        self.assertIn('azurecc_span_seconds_bucket{command="create_status",span="cluster.get",le="0.05"} 1', lines)
+        self.assertIn('azurecc_span_seconds_bucket{command="templates",span="cluster.get",le="1.0"} 0', lines)
+        self.assertIn('azurecc_span_seconds_bucket{command="templates",span="cluster.get",le="+Inf"} 1', lines)
+        self.assertIn('azurecc_span_seconds_count{command="templates",span="cluster.get"} 1', lines)
+        self.assertIn("# TYPE azurecc_store_create_requests_json_lock_wait_seconds histogram", lines)
+        self.assertIn('azurecc_store_create_requests_json_lock_contended_total{command="create_status"} 1', lines)
+        # one TYPE line per family
+        self.assertEqual(1, len([line for line in lines if line.startswith("# TYPE azurecc_span_seconds ")]))
+
+    def test_flush_is_opt_in(self):
+        self.addCleanup(metrics.METRICS.reset)
+        logger = logging.getLogger()
+        with patch.dict(os.environ, {"PRO_DATA_DIR": self.tmpdir}):
+            # by default the spans are only logged
+            metrics.observe("span.cluster.get", 0.02)
+            metrics.flush(util.ProviderConfig({}, {}), logger)
+            self.assertEqual([], os.listdir(self.tmpdir))
+            self.assertEqual({}, metrics.METRICS.histograms)
+
+            # a Prometheus file alone keeps its totals next to it
+            prometheus_path = os.path.join(self.tmpdir, "azurecc.prom")
+            config = util.ProviderConfig({"symphony": {"hostfactory": {"metrics_prometheus_file": prometheus_path}}}, {})
+            for _ in range(2):
+                metrics.observe("span.cluster.get", 0.02)
+                metrics.flush(config, logger)
+            self.assertEqual(["azurecc.prom", "azurecc.prom.json"], sorted(p for p in os.listdir(self.tmpdir)
+                                                                          if not p.endswith(".lock")))
+            with open(prometheus_path) as fr:
+                self.assertIn('azurecc_span_seconds_count{command="other",span="cluster.get"} 2', fr.read().splitlines())
+
+
+if __name__ == "__main__":
+    unittest.main()
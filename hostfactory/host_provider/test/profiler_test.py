@@ -0,0 +1,92 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import profiler
+import util
+
+
+def busy_loop(seconds):
+    deadline = time.time() + seconds
+    total = 0
+    while time.time() < deadline:
+        total += sum(range(1000))
+    return total
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_is_enabled(self):
+        config = util.ProviderConfig({}, {})
+        with patch.dict(os.environ, {}, clear=False):
+            os.environ.pop(profiler.ENV_SWITCH, None)
+            self.assertFalse(profiler.is_enabled(config))
+            self.assertIsInstance(profiler.profile(config, "templates"), type(profiler.contextlib.nullcontext()))
+            config.set("symphony.hostfactory.profile.enabled", True)
+            self.assertTrue(profiler.is_enabled(config))
+            # the environment wins over the config
+            os.environ[profiler.ENV_SWITCH] = "0"
+            self.assertFalse(profiler.is_enabled(config))
+            os.environ[profiler.ENV_SWITCH] = "1"
+            self.assertTrue(profiler.is_enabled(util.ProviderConfig({}, {})))
+
+    def test_profile(self):
+        config = util.ProviderConfig({"symphony": {"hostfactory": {"profile": {"enabled": True, "dir": self.tmpdir,
+                                                                               "sample_interval": 0.001}}}}, {})
+        with profiler.profile(config, "create_status", 1234) as p:
+            busy_loop(0.2)
+
+        self.assertTrue(os.path.exists(p.base_path + ".pstats"))
+        self.assertIn("_1234_", p.base_path)
+        with open(p.base_path + ".collapsed") as fr:
+            lines = fr.readlines()
+        self.assertTrue(lines)
+        self.assertTrue(any("profiler_test.py:busy_loop" in line for line in lines))
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertGreater(int(count), 0)
+
+        self.assertEqual([p.base_path + ".pstats"], profiler.profile_files(self.tmpdir, "create_status"))
+        self.assertEqual([], profiler.profile_files(self.tmpdir, "status"))
+
+        out = io.StringIO()
+        merged = os.path.join(self.tmpdir, "merged.txt")
+        self.assertEqual(1, profiler.aggregate(self.tmpdir, "create_status", top=5, collapsed_path=merged, out=out))
+        self.assertIn("busy_loop", out.getvalue())
+        with open(merged) as fr:
+            self.assertIn("busy_loop", fr.read())
+
+        self.assertEqual(0, profiler.aggregate(os.path.join(self.tmpdir, "missing"), out=io.StringIO()))
+
+    def test_prune(self):
+        paths = []
+        for i in range(5):
+            base = os.path.join(self.tmpdir, "2024010100000%d_1_1_templates" % i)
+            for ext in [".pstats", ".collapsed"]:
+                with open(base + ext, "w"):
+                    pass
+            paths.append(base)
+        # the oldest is also past max age
+        os.utime(paths[0] + ".pstats", (time.time() - 8 * 86400, time.time() - 8 * 86400))
+
+        self.assertEqual(2, profiler.prune(self.tmpdir, max_files=3, max_age_days=7))
+        self.assertEqual([p + ".pstats" for p in paths[2:]], profiler.profile_files(self.tmpdir))
+        self.assertFalse(os.path.exists(paths[1] + ".collapsed"))
+
+        os.utime(paths[2] + ".pstats", (time.time() - 8 * 86400, time.time() - 8 * 86400))
+        self.assertEqual(1, profiler.prune(self.tmpdir, max_files=3, max_age_days=7))
+        self.assertEqual(0, profiler.prune(self.tmpdir, max_files=0, max_age_days=0))
+
+
+if __name__ == "__main__":
+    unittest.main()
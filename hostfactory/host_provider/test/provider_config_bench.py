@@ -0,0 +1,84 @@
+'''
+Micro-benchmark for ProviderConfig.get: the indexed lookup against the original merge-and-walk lookup.
+
+    PYTHONPATH=test:src python test/provider_config_bench.py [iterations]
+'''
+import sys
+import timeit
+
+import util
+
+
+def legacy_get(provider_config, key, default_value=None):
+    '''
+    ProviderConfig.get before the lookup index, used as the reference implementation.
+    '''
+    if not key:
+        return provider_config.config
+
+    keys = key.split(".")
+    top_value = {**provider_config.jetpack_config, **provider_config.config}
+    for n in range(len(keys)):
+        if top_value is None:
+            break
+
+        if not hasattr(top_value, "keys"):
+            return {}
+
+        value = top_value.get(keys[n])
+
+        if n == len(keys) - 1 and value is not None:
+            return value
+
+        top_value = value
+
+    if top_value is None:
+        try:
+            return provider_config.jetpack_config.get(key, default_value)
+        except util.ConfigError as e:
+            if key in str(e):
+                return default_value
+            raise
+
+    return top_value
+
+
+def sample_config():
+    config = {"cyclecloud": {"cluster": {"name": "symphony"},
+                             "config": {"username": "admin", "password": "secret", "web_server": "https://cc:443"},
+                             "http": {"retries": 3}},
+              "symphony": {"terminate_failed_nodes": False, "autoscaling": {"strategy": "price", "ncpus": 1}},
+              "templates": {"execute%d" % i: {"attributes": {"custom": ["String", "v%d" % i]}} for i in range(50)}}
+    jetpack = {"cyclecloud": {"node": {"name": "scheduler", "id": "abc"}, "cluster": {"id": "cid"}},
+               "symphony": {"version": "7.3.2"},
+               "cyclecloud.config.web_server": "https://fallback:443"}
+    return config, jetpack
+
+
+KEYS = ["symphony.terminate_failed_nodes",
+        "cyclecloud.cluster.name",
+        "cyclecloud.config.web_server",
+        "cyclecloud.http.retries",
+        "cyclecloud.node.name",
+        "templates.execute42.attributes.custom",
+        "symphony.missing.key"]
+
+
+def main(argv=sys.argv):
+    iterations = int(argv[1]) if len(argv) > 1 else 100000
+    config, jetpack = sample_config()
+    pc = util.ProviderConfig(config, jetpack)
+
+    for key in KEYS:
+        assert pc.get(key, "default") == legacy_get(pc, key, "default"), key
+
+    legacy = timeit.timeit(lambda: [legacy_get(pc, key, "default") for key in KEYS], number=iterations)
+    indexed = timeit.timeit(lambda: [pc.get(key, "default") for key in KEYS], number=iterations)
+    lookups = iterations * len(KEYS)
+    print("legacy:  %.3f us/lookup" % (legacy / lookups * 1e6))
+    print("indexed: %.3f us/lookup" % (indexed / lookups * 1e6))
+    print("speedup: %.1fx" % (legacy / indexed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+import metrics
+import provider_client
+import util
+from provider_daemon import ProviderCommandRunner, ProviderDaemon
+
+
+class TestProviderDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, "azurecc_provider.sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _start(self, handler, **kwargs):
+        kwargs.setdefault("environment", provider_client.caller_environment())
+        daemon = ProviderDaemon(self.socket_path, handler, **kwargs)
+        daemon.bind()
+        thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+        thread.start()
+
+        def _stop():
+            daemon.stop()
+            thread.join(5)
+        self.addCleanup(_stop)
+        return daemon
+
+    def test_round_trip(self):
+        calls = []
+
+        def handler(argv):
+            calls.append(argv)
+            return 0, '{"status": "complete"}\n'
+
+        self._start(handler)
+        exit_code, stdout = provider_client.invoke(["create_status", "-f", "input.json"], self.socket_path)
+        self.assertEqual(0, exit_code)
+        self.assertEqual('{"status": "complete"}\n', stdout)
+        # the input file is sent as an absolute path, the daemon has its own working directory
+        self.assertEqual([["create_status", "-f", os.path.abspath("input.json")]], calls)
+
+        # the daemon serves more than one command
+        provider_client.invoke(["templates", "-f", "input.json"], self.socket_path)
+        self.assertEqual(2, len(calls))
+
+    def test_exit_codes(self):
+        self._start(lambda argv: (1, ""))
+        self.assertEqual((1, ""), provider_client.invoke(["templates", "-f", "input.json"], self.socket_path))
+
+    def test_handler_error(self):
+        def handler(argv):
+            raise RuntimeError("boom")
+        self._start(handler)
+        self.assertEqual((1, ""), provider_client.invoke(["templates", "-f", "input.json"], self.socket_path))
+
+    def test_unavailable(self):
+        # no socket at all
+        self.assertEqual((provider_client.DAEMON_UNAVAILABLE, ""),
+                         provider_client.invoke(["templates", "-f", "input.json"], self.socket_path))
+
+        # stale socket left behind by a dead daemon
+        daemon = ProviderDaemon(self.socket_path, None)
+        daemon.bind()
+        daemon.server.close()
+        self.assertTrue(os.path.exists(self.socket_path))
+        self.assertEqual((provider_client.DAEMON_UNAVAILABLE, ""),
+                         provider_client.invoke(["templates", "-f", "input.json"], self.socket_path))
+
+        # and a new daemon can take over the stale socket
+        self._start(lambda argv: (0, "ok"))
+        self.assertEqual((0, "ok"), provider_client.invoke(["templates", "-f", "input.json"], self.socket_path))
+
+    def test_declined(self):
+        calls = []
+
+        def handler(argv):
+            calls.append(argv)
+            return 0, "ok"
+
+        self._start(handler, oneshot=["create_machines"])
+        # long running commands are left to the one-shot provider, so they never hold up the daemon
+        self.assertEqual((provider_client.DAEMON_UNAVAILABLE, ""),
+                         provider_client.invoke(["create_machines", "-f", "input.json"], self.socket_path))
+        with patch.dict(os.environ, {"AZURECC_DAEMON_ONESHOT_COMMANDS": ""}):
+            self.assertEqual((provider_client.DAEMON_UNAVAILABLE, ""),
+                             provider_client.invoke(["create_machines", "-f", "input.json"], self.socket_path))
+        self.assertEqual([], calls)
+
+        # a caller with other provider directories than the daemon's
+        with patch.dict(os.environ, {"PRO_DATA_DIR": os.path.join(self.tmpdir, "elsewhere")}):
+            self.assertEqual((provider_client.DAEMON_UNAVAILABLE, ""),
+                             provider_client.invoke(["templates", "-f", "input.json"], self.socket_path))
+        self.assertEqual([], calls)
+        self.assertEqual((0, "ok"), provider_client.invoke(["templates", "-f", "input.json"], self.socket_path))
+
+
+class TestProviderCommandRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, True)
+        self.addCleanup(metrics.METRICS.reset)
+
+    def test_failed_command_metrics(self):
+        metrics_path = os.path.join(self.tmpdir, "azurecc_metrics.json")
+        input_json_path = os.path.join(self.tmpdir, "input.json")
+        with open(input_json_path, "w") as fw:
+            json.dump({}, fw)
+
+        provider = MagicMock()
+        provider.config = util.ProviderConfig({"symphony": {"hostfactory": {"metrics_file": metrics_path}}}, {})
+        runner = ProviderCommandRunner(self.tmpdir)
+        runner.logger = logging.getLogger()
+        runner._provider = lambda: provider
+
+        def run_command(provider, cmd, input_json):
+            with metrics.span(cmd):
+                pass
+            if cmd == "terminate_machines":
+                sys.exit(1)
+
+        with patch("cyclecloud_provider.run_command", run_command):
+            self.assertEqual(1, runner(["terminate_machines", "-f", input_json_path])[0])
+            # left over from outside of any command
+            metrics.observe("span.leftover", 1)
+            self.assertEqual(0, runner(["templates", "-f", input_json_path])[0])
+
+        with open(metrics_path) as fr:
+            commands = json.load(fr)["commands"]
+        # the failed command was flushed under its own name, and nothing of it was counted against the next one
+        self.assertEqual(["span.terminate_machines"], list(commands["terminate_machines"]["histograms"]))
+        self.assertEqual(["span.templates"], list(commands["templates"]["histograms"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,5 @@
 import unittest
+from unittest.mock import patch
 
 from symphony import RequestStates, MachineStates, MachineResults
 from request_tracking_db import RequestTrackingDb
@@ -40,5 +41,21 @@ class TestHostFactory(unittest.TestCase):
         db.remove_request(request_id)
         self.assertFalse(db.get_requests())
 
+    def test_requests_completed(self):
+        db = RequestTrackingDb({}, "test_cluster", MockClock((1970, 1, 1, 0, 0, 0)))
+        db.reset()
+        for request_id in ["r1", "r2", "r3"]:
+            db.add_request({'count': 1, 'requestId': request_id, 'definition': {'machineType': "A8"}})
+
+        db.requests_completed(["r1", "r3", "unknown"])
+        self.assertEqual(["r2"], list(db.get_requests()))
+
+        db.request_completed({"requestId": "r2"})
+        self.assertFalse(db.get_requests())
+
+        # nothing tracked, so the db is not locked and rewritten
+        with patch.object(type(db.requests_db), "__enter__", side_effect=AssertionError("locked")):
+            db.requests_completed(["r1"])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,168 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import cyclecloud_provider
+import util
+from return_digest import ReturnDigest
+
+
+class MockClock:
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class CountingHostnamer:
+
+    def __init__(self):
+        self.resolved = []
+
+    def hostname(self, private_ip_address, node_id=None):
+        self.resolved.append(private_ip_address)
+        return "ip-" + private_ip_address.replace(".", "-")
+
+
+class NodesCluster:
+
+    cluster_name = "c1"
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.shut_down = []
+
+    def all_nodes(self):
+        return {"nodes": self.nodes}
+
+    def shutdown_nodes(self, machines):
+        self.shut_down.append([m["machineId"] for m in machines])
+
+
+class InMemStore(dict):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def _node(index, status="Ready", hostname=None):
+    node = {"Name": "execute-%d" % index, "NodeId": "nid-%d" % index, "Status": status,
+            "PrivateIp": "10.0.0.%d" % index, "Configuration": {"autoscaling": {"enabled": True}}}
+    if hostname:
+        node["Hostname"] = hostname
+    return node
+
+
+class TestReturnDigest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_load_save(self):
+        clock = MockClock(1000)
+        digest = ReturnDigest("c1", self.tmpdir, max_age=60, clock=clock)
+        self.assertEqual({}, digest.load())
+
+        digest.save({"nid-1": ["Ready", None, "10.0.0.1", "ip-10-0-0-1", 900, None]})
+        self.assertEqual(["Ready", None, "10.0.0.1", "ip-10-0-0-1", 900, None], digest.load()["nid-1"])
+        self.assertEqual({}, ReturnDigest("c2", self.tmpdir, clock=clock).load())
+
+        # stale
+        clock.now += 61
+        self.assertEqual({}, digest.load())
+
+        with open(digest.path, "w") as fw:
+            fw.write("{not json")
+        self.assertEqual({}, digest.load())
+
+    def _provider(self, cluster, clock):
+        provider = cyclecloud_provider.CycleCloudProvider(util.ProviderConfig({}, {}), cluster, CountingHostnamer(),
+                                                          cyclecloud_provider.JsonOutputHandler(quiet=True),
+                                                          terminate_requests=InMemStore(),
+                                                          creation_requests=InMemStore(),
+                                                          clock=lambda: (1970, 1, 1, 0, 0, 0))
+        provider.request_tracker.reset()
+        provider.return_digest = ReturnDigest("c1", self.tmpdir, clock=clock)
+        return provider
+
+    def _return_requests(self, cluster, clock, machines):
+        provider = self._provider(cluster, clock)
+        response = provider.get_return_requests({"machines": [{"name": m} for m in machines]})
+        return provider, sorted(r["machine"] for r in response["requests"])
+
+    def test_incremental(self):
+        clock = MockClock(1000)
+        cluster = NodesCluster([_node(1), _node(2), _node(3, hostname="named-3"), _node(4, status="Failed")])
+        symphony = ["ip-10-0-0-1", "ip-10-0-0-2", "named-3", "ip-10-0-0-4", "gone-5"]
+
+        provider, returned = self._return_requests(cluster, clock, symphony)
+        self.assertEqual(["gone-5", "ip-10-0-0-4"], returned)
+        self.assertEqual(["10.0.0.1", "10.0.0.2", "10.0.0.4"], provider.hostnamer.resolved)
+        self.assertEqual([["nid-4"]], cluster.shut_down)
+
+        # nothing changed: nothing is resolved again and the failed node is not shut down twice,
+        # but it is still reported until it is gone
+        provider, returned = self._return_requests(cluster, clock, symphony)
+        self.assertEqual(["gone-5", "ip-10-0-0-4"], returned)
+        self.assertEqual([], provider.hostnamer.resolved)
+        self.assertEqual([["nid-4"]], cluster.shut_down)
+
+        # one node fails, one is removed and symphony dropped the terminated one
+        cluster.nodes[1]["Status"] = "Failed"
+        cluster.nodes.pop(0)
+        provider, returned = self._return_requests(cluster, clock, symphony[:-1])
+        self.assertEqual(["ip-10-0-0-1", "ip-10-0-0-2", "ip-10-0-0-4"], returned)
+        self.assertEqual(["10.0.0.2"], provider.hostnamer.resolved)
+        self.assertEqual([["nid-4"], ["nid-2"]], cluster.shut_down)
+        with open(provider.return_digest.path) as fr:
+            self.assertEqual(["nid-2", "nid-3", "nid-4"], sorted(json.load(fr)["nodes"]))
+
+    def test_shutdown_retried_while_failed(self):
+        clock = MockClock(1000)
+        cluster = NodesCluster([_node(1, status="Failed")])
+        self._return_requests(cluster, clock, [])
+        self._return_requests(cluster, clock, [])
+        self.assertEqual([["nid-1"]], cluster.shut_down)
+
+        # a node that stays failed is shut down again after shutdown_retry
+        clock.now += 300
+        self._return_requests(cluster, clock, [])
+        self.assertEqual([["nid-1"], ["nid-1"]], cluster.shut_down)
+        self._return_requests(cluster, clock, [])
+        self.assertEqual(2, len(cluster.shut_down))
+
+        # digests written before the shutdown time was kept
+        digest = ReturnDigest("c1", self.tmpdir, clock=clock)
+        self.assertTrue(digest.shutdown_due(["Failed", None, "10.0.0.1", "ip-10-0-0-1", 900, True]))
+        self.assertFalse(digest.shutdown_due(["Failed", None, "10.0.0.1", "ip-10-0-0-1", 900, clock.now - 10]))
+
+    def test_missing_or_stale_digest(self):
+        clock = MockClock(1000)
+        cluster = NodesCluster([_node(1), _node(2, status="Failed")])
+        provider, returned = self._return_requests(cluster, clock, ["ip-10-0-0-1"])
+        self.assertEqual(["ip-10-0-0-2"], returned)
+
+        os.remove(provider.return_digest.path)
+        provider, returned = self._return_requests(cluster, clock, ["ip-10-0-0-1"])
+        self.assertEqual(["ip-10-0-0-2"], returned)
+        self.assertEqual(["10.0.0.1", "10.0.0.2"], provider.hostnamer.resolved)
+        self.assertEqual([["nid-2"], ["nid-2"]], cluster.shut_down)
+
+        clock.now += 601
+        provider, returned = self._return_requests(cluster, clock, ["ip-10-0-0-1"])
+        self.assertEqual(["10.0.0.1", "10.0.0.2"], provider.hostnamer.resolved)
+        self.assertEqual(3, len(cluster.shut_down))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from sqlite_store import SqliteStore
+from util import ConfigError, JsonStore, new_store
+
+
+class TestSqliteStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_basic(self):
+        store = SqliteStore("create_requests.json", self.tmpdir)
+        self.assertEqual({}, store.read())
+
+        with store as data:
+            data["req-1"] = {"requestTime": 100, "completed": False, "allNodes": ["a", "b"]}
+            data["req-2"] = {"requestTime": 200}
+
+        # visible to other connections
+        other = SqliteStore("create_requests.json", self.tmpdir)
+        self.assertEqual({"requestTime": 100, "completed": False, "allNodes": ["a", "b"]}, other.read()["req-1"])
+
+        with other as data:
+            data["req-1"]["completed"] = True
+            data.pop("req-2")
+
+        self.assertEqual(["req-1"], list(store.read().keys()))
+        self.assertTrue(store.read()["req-1"]["completed"])
+
+        store.clear()
+        self.assertEqual({}, other.read())
+
+        store.write({"x": {"id": "x"}})
+        self.assertEqual({"x": {"id": "x"}}, other.read())
+
+    def test_nested(self):
+        store = SqliteStore("terminate_requests.json", self.tmpdir)
+        with store as outer:
+            outer["a"] = {"terminated": False}
+            with store as inner:
+                self.assertIs(outer, inner)
+                inner["b"] = {"terminated": True}
+        self.assertEqual({"a": {"terminated": False}, "b": {"terminated": True}}, store.read())
+
+    def test_threads(self):
+        store = SqliteStore("create_requests.json", self.tmpdir, lock_timeout=30)
+        store.write({"counter": {"count": 0}})
+
+        def _increment():
+            for _ in range(25):
+                with store as data:
+                    count = data["counter"]["count"]
+                    time.sleep(0.001)
+                    data["counter"]["count"] = count + 1
+
+        # each thread has its own connection and transaction, so none of the read-modify-writes are lost
+        threads = [threading.Thread(target=_increment) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(100, store.read()["counter"]["count"])
+
+    def test_row_level_updates(self):
+        store = SqliteStore("create_requests.json", self.tmpdir)
+        store.write({"req-%d" % i: {"requestTime": i} for i in range(100)})
+
+        before = store.conn.total_changes
+        with store as data:
+            data["req-5"]["completed"] = True
+        self.assertEqual(1, store.conn.total_changes - before)
+
+        # unchanged rows are not rewritten
+        before = store.conn.total_changes
+        with store:
+            pass
+        self.assertEqual(0, store.conn.total_changes - before)
+
+        completed = store.conn.execute("SELECT id FROM entries WHERE completed = 1").fetchall()
+        self.assertEqual([("req-5",)], completed)
+
+    def test_rows_loaded_on_use(self):
+        store = SqliteStore("create_requests.json", self.tmpdir)
+        store.write({"req-%d" % i: {"requestTime": i} for i in range(100)})
+        statements = []
+        store.conn.set_trace_callback(statements.append)
+
+        with store as data:
+            data["req-5"]["completed"] = True
+            self.assertNotIn("req-missing", data)
+            self.assertIsNone(data.get("req-missing"))
+            data["req-new"] = {"requestTime": 1000}
+            del data["req-7"]
+        # one lookup per key used, and no listing of the store
+        selects = [x for x in statements if x.startswith("SELECT")]
+        self.assertEqual(3, len(selects))
+        self.assertTrue(all("WHERE id" in x for x in selects))
+        stored = store.read()
+        self.assertTrue(stored["req-5"]["completed"])
+        self.assertEqual({"requestTime": 1000}, stored["req-new"])
+        self.assertNotIn("req-7", stored)
+        self.assertEqual(100, len(stored))
+
+        # iterating loads the rest, and keeps what the block changed
+        with store as data:
+            data["req-9"]["completed"] = True
+            data.pop("req-8")
+            data["req-a"] = {}
+            self.assertEqual(100, len(data))
+            self.assertTrue(data["req-9"]["completed"])
+            self.assertNotIn("req-8", list(data))
+            self.assertEqual(["req-a"], [key for key, value in data.items() if not value])
+        stored = store.read()
+        self.assertTrue(stored["req-9"]["completed"])
+        self.assertNotIn("req-8", stored)
+        self.assertIn("req-a", stored)
+
+    def test_migrate(self):
+        json_store = JsonStore("create_requests.json", self.tmpdir)
+        json_store.write({"req-1": {"requestTime": 100, "lastUpdateTime": 150}})
+
+        store = SqliteStore("create_requests.json", self.tmpdir)
+        self.assertEqual({"req-1": {"requestTime": 100, "lastUpdateTime": 150}}, store.read())
+        json_path = os.path.join(self.tmpdir, "create_requests.json")
+        self.assertFalse(os.path.exists(json_path))
+        self.assertTrue(os.path.exists(json_path + ".migrated"))
+
+        # migrated only once
+        with store as data:
+            data["req-2"] = {"requestTime": 200}
+        self.assertEqual(["req-1", "req-2"], list(SqliteStore("create_requests.json", self.tmpdir).read()))
+
+        # a json file written later (e.g. the backend was switched back) replaces the old rows
+        with open(json_path, "w") as fw:
+            json.dump({"req-3": {"requestTime": 300}}, fw)
+        self.assertEqual(["req-3"], list(SqliteStore("create_requests.json", self.tmpdir).read()))
+
+    def test_new_store(self):
+        self.assertIsInstance(new_store("create_requests.json", self.tmpdir), JsonStore)
+        self.assertIsInstance(new_store("create_requests.json", self.tmpdir, "sqlite"), SqliteStore)
+        self.assertRaises(ConfigError, new_store, "create_requests.json", self.tmpdir, "mongodb")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+'''
+Start up benchmark for the one-shot provider.
+
+Runs every command of cyclecloud_provider.main() in a fresh interpreter with `python -X importtime` and
+reports, per command, the time spent importing modules, the time to the first byte on stdout and the total
+run time (medians over --runs), plus the slowest top level imports.
+
+    PYTHONPATH=test:src python test/startup_bench.py [--runs 5] [--conf-dir $PRO_CONF_DIR] [--save out.json]
+                                                     [--baseline out.json]
+
+Without --conf-dir a throwaway config is generated that points at a local FakeCycleCloud (see
+fake_cyclecloud.py) with retries disabled, so the commands run without a live CycleCloud. With --baseline, the results are compared to an earlier --save.
+'''
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+COMMAND_INPUTS = {
+    "templates": {},
+    "create_machines": {"template": {"templateId": "execute", "machineCount": 1}, "rc_account": "default", "user_data": {}},
+    "create_status": {"requests": [{"requestId": "startup-bench-request"}]},
+    "get_return_requests": {"machines": []},
+    "terminate_machines": {"machines": [{"name": "startup-bench-host", "machineId": "startup-bench-node"}]},
+}
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def write_conf_dir(path, web_server):
+    os.makedirs(os.path.join(path, "conf"), exist_ok=True)
+    config = {"cyclecloud": {"cluster": {"name": "startup-bench"},
+                             "config": {"web_server": web_server, "username": "u", "password": "p"},
+                             "http": {"retries": 0, "connect_timeout": 1}},
+              "log_level": "info"}
+    with open(os.path.join(path, "conf", "azureccprov_config.json"), "w") as fw:
+        json.dump(config, fw)
+    templates = {"templates": [{"templateId": "execute", "maxNumber": 10,
+                                "attributes": {"type": ["String", "X86_64"], "ncpus": ["Numeric", "1"],
+                                               "nram": ["Numeric", "4096"], "ncores": ["Numeric", "1"]},
+                                "vmTypes": {"Standard_D2_v3": 1}}]}
+    with open(os.path.join(path, "conf", "azureccprov_templates.json"), "w") as fw:
+        json.dump(templates, fw)
+
+
+def parse_importtime(stderr):
+    '''
+    Returns the total import time and the cumulative time of each top level import, in milliseconds.
+    '''
+    top_level = {}
+    for line in stderr.splitlines():
+        m = IMPORTTIME_LINE.match(line)
+        if m and len(m.group(3)) == 1:
+            top_level[m.group(4)] = top_level.get(m.group(4), 0) + int(m.group(2)) / 1000.0
+    return sum(top_level.values()), top_level
+
+
+def run_once(cmd, workdir, env):
+    input_path = os.path.join(workdir, "%s_input.json" % cmd)
+    with open(input_path, "w") as fw:
+        json.dump(COMMAND_INPUTS[cmd], fw)
+
+    started = time.time()
+    proc = subprocess.Popen([sys.executable, "-X", "importtime", os.path.join(SRC_DIR, "cyclecloud_provider.py"),
+                             cmd, "-f", input_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+                            cwd=workdir)
+    first = proc.stdout.read(1)
+    first_output = time.time() - started if first else None
+    stdout, stderr = proc.communicate()
+    total = time.time() - started
+    import_ms, top_level = parse_importtime(stderr.decode(errors="replace"))
+    return {"exit_code": proc.returncode,
+            "import_ms": import_ms,
+            "first_output_ms": first_output * 1000 if first_output is not None else None,
+            "total_ms": total * 1000,
+            "top_level": top_level}
+
+
+def _median(values):
+    values = [v for v in values if v is not None]
+    return statistics.median(values) if values else None
+
+
+def bench(commands, runs, conf_dir=None):
+    workdir = tempfile.mkdtemp(prefix="startup_bench_")
+    server = None
+    try:
+        if not conf_dir:
+            from fake_cyclecloud import FakeCycleCloud
+            server = FakeCycleCloud(cluster_name="startup-bench", nodearrays={"execute": {"Standard_D2_v3": 2}},
+                                    node_count=10).start()
+            conf_dir = os.path.join(workdir, "pro_conf")
+            write_conf_dir(conf_dir, server.url)
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([SRC_DIR] + [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p])
+        env["PRO_CONF_DIR"] = conf_dir
+        env["HF_CONFDIR"] = conf_dir
+        for var in ["PRO_DATA_DIR", "HF_WORKDIR", "PRO_LOG_DIR"]:
+            env[var] = workdir
+
+        results = {}
+        for cmd in commands:
+            samples = [run_once(cmd, workdir, env) for _ in range(runs)]
+            top_level = {}
+            for sample in samples:
+                for module, ms in sample["top_level"].items():
+                    top_level.setdefault(module, []).append(ms)
+            results[cmd] = {"exit_code": samples[-1]["exit_code"],
+                            "import_ms": _median([s["import_ms"] for s in samples]),
+                            "first_output_ms": _median([s["first_output_ms"] for s in samples]),
+                            "total_ms": _median([s["total_ms"] for s in samples]),
+                            "slowest_imports": sorted([(m, _median(v)) for m, v in top_level.items()],
+                                                      key=lambda x: -x[1])[:5]}
+        return results
+    finally:
+        if server:
+            server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _fmt(value):
+    return "%8.1f" % value if value is not None else "%8s" % "-"
+
+
+def report(results, baseline=None):
+    print("%-22s %5s %8s %8s %8s" % ("command", "exit", "imports", "1st out", "total"))
+    for cmd, r in results.items():
+        print("%-22s %5s %s %s %s" % (cmd, r["exit_code"], _fmt(r["import_ms"]), _fmt(r["first_output_ms"]),
+                                      _fmt(r["total_ms"])))
+        if baseline and cmd in baseline:
+            b = baseline[cmd]
+            deltas = []
+            for key in ["import_ms", "first_output_ms", "total_ms"]:
+                if r[key] is not None and b.get(key):
+                    deltas.append("%s %+.0f%%" % (key, 100.0 * (r[key] - b[key]) / b[key]))
+            print("%-22s vs baseline: %s" % ("", ", ".join(deltas)))
+        print("%-22s slowest imports: %s" % ("", ", ".join(["%s=%.1fms" % x for x in r["slowest_imports"]])))
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="Start up time of each provider command")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--conf-dir", help="PRO_CONF_DIR to use instead of a generated one")
+    parser.add_argument("--commands", nargs="+", default=list(COMMAND_INPUTS), choices=list(COMMAND_INPUTS))
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare against results written earlier with --save")
+    args = parser.parse_args(argv[1:])
+
+    results = bench(args.commands, args.runs, args.conf_dir)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fr:
+            baseline = json.load(fr)
+    report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as fw:
+            json.dump(results, fw, indent=2)
+
+
+if __name__ == "__main__":
+    main()
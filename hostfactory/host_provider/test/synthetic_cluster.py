@@ -0,0 +1,304 @@
+'''
+Synthetic CycleCloud cluster for benchmarks.
+
+SyntheticCluster is a real cluster.Cluster whose REST calls (_request) and scalelib node manager are
+answered from an in-memory model of a cluster with any number of nodes, so that every provider command can
+run end to end without CycleCloud while the provider-side code paths stay the real ones. Every call that
+would be a round trip to CycleCloud is counted in rest_calls.
+'''
+import collections
+import itertools
+import json
+import math
+import random
+import re
+import threading
+
+import cluster
+from cluster_snapshot import DelayedNodeId
+
+
+NODEARRAYS = {"execute": {"Standard_F2s_v2": 1, "Standard_F4s_v2": 2, "Standard_F8s_v2": 4},
+              "lp_execute": {"Standard_D2_v3": 1, "Standard_D4_v3": 2}}
+
+class SyntheticNode:
+
+    def __init__(self, node_id, name, nodearray, vm_size, weight, request_id=None, state="Ready", target_state="Started"):
+        self.delayed_node_id = DelayedNodeId(node_id)
+        self.name = name
+        self.nodearray = nodearray
+        self.vm_size = vm_size
+        self.resources = {"weight": weight}
+        self.request_id = request_id
+        self.state = state
+        self.target_state = target_state
+        self.status_message = None
+        self.index = int(node_id.rsplit("-", 1)[-1])
+        self.instance_id = None
+        self.private_ip = None
+        self.hostname = None
+        if state in ("Preparing", "Ready", "Failed"):
+            self.assign_instance()
+
+    def assign_instance(self):
+        self.instance_id = "i-%08d" % self.index
+        self.private_ip = "10.%d.%d.%d" % (self.index // 65536 % 256, self.index // 256 % 256, self.index % 256)
+        self.hostname = "ip-%s" % self.private_ip.replace(".", "-")
+
+    def to_json(self, padding=True):
+        ret = {"Name": self.name,
+               "NodeId": self.delayed_node_id.node_id,
+               "Template": self.nodearray,
+               "MachineType": self.vm_size,
+               "Status": self.state,
+               "TargetState": self.target_state,
+               "Hostname": self.hostname,
+               "PrivateIp": self.private_ip,
+               "InstanceId": self.instance_id,
+               "Configuration": {"autoscaling": {"enabled": True}}}
+        if self.status_message:
+            ret["StatusMessage"] = self.status_message
+        if padding:
+            # real node records carry a lot more than the provider reads
+            ret["Configuration"].update({"cyclecloud": {"cluster": {"autoscale": {"idle_time_after_jobs": 300}},
+                                                        "hosts": {"standalone_dns": {"enabled": False}},
+                                                        "node": {"prevent_metadata_access": True}},
+                                         "symphony": {"autoscale": True, "custom_env": "", "ncpus": 1},
+                                         "run_list": ["recipe[cyclecloud]", "role[symphony_execute_role]"]})
+            ret.update({"ClusterName": "synthetic", "Credentials": "azure", "Region": "westus2",
+                        "SubnetId": "/subscriptions/0/resourceGroups/rg/providers/Microsoft.Network/virtualNetworks/vnet/subnets/compute",
+                        "KeyPairLocation": "~/.ssh/cyclecloud.pem", "ImageName": "cycle.image.ubuntu22",
+                        "Instance": {"InstanceId": self.instance_id, "MachineType": self.vm_size, "Region": "westus2",
+                                     "PrivateIp": self.private_ip, "Hostname": self.hostname},
+                        "Tags": {"ClusterName": "synthetic", "Nodearray": self.nodearray},
+                        "Interruptible": self.nodearray.startswith("lp_"), "Fixed": False, "Managed": True,
+                        "Phase": "Running", "Keepalive": False, "Disabled": False})
+        return ret
+
+
+class SyntheticBucket:
+
+    def __init__(self, nodearray, vm_size, weight, max_count):
+        self.nodearray = nodearray
+        self.vm_size = vm_size
+        self.bucket_id = "%s-%s" % (nodearray, vm_size)
+        self.resources = {"weight": weight, "ncores": weight}
+        self.max_count = max_count
+        self.available_count = max_count
+        self.vcpu_count = weight
+        self.pcpu_count = weight
+        self.last_capacity_failure = None
+        self.limits = "max_count=%d" % max_count
+        self.software_configuration = {"autoscaling": {"enabled": True}}
+
+
+class SyntheticResult:
+
+    def __init__(self, nodes, status="success"):
+        self.nodes = nodes
+        self.status = status
+
+    def __bool__(self):
+        return bool(self.nodes)
+
+
+class SyntheticNodeManager:
+    '''
+    The parts of scalelib's NodeManager that cluster.Cluster uses.
+    '''
+
+    def __init__(self, synthetic_cluster):
+        self.cluster = synthetic_cluster
+        self.new_nodes = []
+        self.weights = {}
+
+    def _count(self, call):
+        self.cluster.rest_calls[call] += 1
+
+    def get_buckets(self):
+        return list(self.cluster.buckets.values())
+
+    def add_default_resource(self, selection, resource_name, default_value):
+        if resource_name == "weight" and "node.vm_size" in selection:
+            self.weights[selection["node.vm_size"]] = default_value
+
+    def allocate(self, constraints, slot_count, allow_existing=False):
+        template_id = constraints.get("template_id")
+        vm_size = constraints.get("node.vm_size")
+        candidates = [b for b in self.cluster.buckets.values()
+                      if (not template_id or b.nodearray == template_id) and (not vm_size or b.vm_size == vm_size)
+                      and b.available_count > 0]
+        allocated = []
+        remaining = slot_count
+        for bucket in candidates:
+            weight = self.weights.get(bucket.vm_size, bucket.resources["weight"])
+            count = min(bucket.available_count, int(math.ceil(remaining / float(weight))))
+            for _ in range(count):
+                allocated.append(self.cluster.new_node(bucket.nodearray, bucket.vm_size, weight, state="Allocation"))
+            bucket.available_count -= count
+            remaining -= count * weight
+            if remaining <= 0:
+                break
+        self.new_nodes.extend(allocated)
+        return SyntheticResult(allocated)
+
+    def get_new_nodes(self):
+        return self.new_nodes
+
+    def bootup(self, nodes=None, request_id_start=None, request_id_create=None):
+        with self.cluster.lock:
+            self._count("POST /clusters/{cluster}/nodes/create")
+            if nodes is None:
+                nodes = self.new_nodes
+                self.new_nodes = []
+            else:
+                self.new_nodes = [n for n in self.new_nodes if n not in nodes]
+            request_id = request_id_create.rsplit("-create", 1)[0] if request_id_create else None
+            for node in nodes:
+                node.request_id = request_id
+                self.cluster.add_node(node)
+            self.cluster.operations[request_id_create] = list(nodes)
+        return SyntheticResult(nodes)
+
+    def get_nodes(self):
+        # scalelib lists the nodes once, when the node manager is built
+        return list(self.cluster.nodes.values())
+
+    def get_nodes_by_request_id(self, request_id):
+        self._count("GET /operations?request_id")
+        if request_id not in self.cluster.operations:
+            raise RuntimeError("No operation found for request id %s" % request_id)
+        return list(self.cluster.operations[request_id])
+
+    def shutdown_nodes(self, nodes):
+        self._count("POST /clusters/{cluster}/nodes/shutdown")
+        self.cluster.mark_shutdown([n.delayed_node_id.node_id for n in nodes])
+
+
+class SyntheticResponse:
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.content = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.headers = {}
+
+    def iter_content(self, chunk_size=65536, decode_unicode=False):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class SyntheticCluster(cluster.Cluster):
+
+    def __init__(self, provider_config, node_count=100, cluster_name="synthetic", data_dir=None, logger=None,
+                 padding=True, seed=0):
+        provider_config.set("cyclecloud.config.web_server", provider_config.get("cyclecloud.config.web_server") or "http://synthetic")
+        provider_config.set("cyclecloud.config.username", provider_config.get("cyclecloud.config.username") or "synthetic")
+        provider_config.set("cyclecloud.config.password", provider_config.get("cyclecloud.config.password") or "synthetic")
+        cluster.Cluster.__init__(self, cluster_name, provider_config, logger, data_dir)
+        self.rest_calls = collections.Counter()
+        self.padding = padding
+        self.random = random.Random(seed)
+        self.nodes = collections.OrderedDict()
+        self.operations = {}
+        self._ids = itertools.count(1)
+        self.buckets = collections.OrderedDict()
+        for nodearray, vm_types in NODEARRAYS.items():
+            for vm_size, weight in vm_types.items():
+                self.buckets[(nodearray, vm_size)] = SyntheticBucket(nodearray, vm_size, weight, max(1000, node_count * 2))
+
+        # nodes that belong to no open request, e.g. booted by earlier, completed requests
+        choices = [(na, vm_size, w) for na, vm_types in NODEARRAYS.items() for vm_size, w in vm_types.items()]
+        for _ in range(node_count):
+            nodearray, vm_size, weight = self.random.choice(choices)
+            self.add_node(self.new_node(nodearray, vm_size, weight, state="Ready"))
+        # chunked bootups call in from several threads, each with its own node manager
+        self.lock = threading.Lock()
+        self.synthetic_node_mgr = SyntheticNodeManager(self)
+        self.node_mgr_loaded = False
+
+    @property
+    def node_mgr(self):
+        # building scalelib's node manager fetches the cluster status and every node
+        if not self.node_mgr_loaded:
+            self.rest_calls["GET /clusters/{cluster}/status"] += 1
+            self.rest_calls["GET /clusters/{cluster}/nodes"] += 1
+            self.node_mgr_loaded = True
+        return self.synthetic_node_mgr
+
+    def _new_node_manager(self):
+        # a node manager for another worker thread, see Cluster._map_node_mgrs
+        self.rest_calls["GET /clusters/{cluster}/status"] += 1
+        self.rest_calls["GET /clusters/{cluster}/nodes"] += 1
+        return SyntheticNodeManager(self)
+
+    def refresh(self):
+        # what a new provider process would have to load again
+        self.node_mgr_loaded = False
+
+    def new_node(self, nodearray, vm_size, weight, state="Ready", request_id=None):
+        index = next(self._ids)
+        return SyntheticNode("nid-%d" % index, "%s-%d" % (nodearray, index), nodearray, vm_size, weight,
+                             request_id=request_id, state=state)
+
+    def add_node(self, node):
+        self.nodes[node.delayed_node_id.node_id] = node
+
+    def request_nodes(self, request_id):
+        return [n for n in self.nodes.values() if n.request_id == request_id]
+
+    def advance(self, nodes, ready=0.8, preparing=0.15, failed=0.05):
+        '''
+        Moves freshly booted nodes along the life cycle: the given fractions end up Ready, Preparing and
+        Failed, the rest stay Acquiring.
+        '''
+        for node in nodes:
+            r = self.random.random()
+            if r < ready:
+                node.state = "Ready"
+            elif r < ready + preparing:
+                node.state = "Preparing"
+            elif r < ready + preparing + failed:
+                node.state = "Failed"
+                node.status_message = "Synthetic boot failure"
+            else:
+                node.state = "Acquiring"
+                continue
+            node.assign_instance()
+
+    def mark_shutdown(self, node_ids):
+        # not named shutdown: Cluster has no shutdown method and the provider must not find one here either
+        for node_id in node_ids:
+            node = self.nodes.get(node_id)
+            if node:
+                node.target_state = "Terminated"
+                node.state = "Terminating"
+
+    def status_json(self):
+        nodearrays = []
+        for nodearray in NODEARRAYS:
+            buckets = [{"definition": {"machineType": b.vm_size}, "maxCount": b.max_count,
+                        "availableCount": b.available_count}
+                       for b in self.buckets.values() if b.nodearray == nodearray]
+            nodearrays.append({"name": nodearray, "buckets": buckets,
+                               "nodearray": {"Configuration": {"autoscaling": {"enabled": True}}}})
+        return {"nodearrays": nodearrays}
+
+    def _request(self, method, url, **kwargs):
+        path = url.split("?", 1)[0]
+        path = re.sub("^/clusters/[^/]+", "/clusters/{cluster}", path)
+        self.rest_calls["%s %s" % (method, path)] += 1
+
+        if method == "GET" and path == "/clusters/{cluster}/status":
+            return SyntheticResponse(200, self.status_json())
+        if method == "GET" and path == "/clusters/{cluster}/nodes":
+            operation = (kwargs.get("params") or {}).get("operation")
+            nodes = self.operations.get(operation, []) if operation else self.nodes.values()
+            return SyntheticResponse(200, {"nodes": [n.to_json(self.padding) for n in nodes]})
+        if method == "POST" and path in ("/clusters/{cluster}/nodes/terminate", "/clusters/{cluster}/nodes/shutdown"):
+            ids = (kwargs.get("json") or {}).get("ids", [])
+            self.mark_shutdown(ids)
+            return SyntheticResponse(200, {"nodes": [{"id": i, "status": "OK"} for i in ids]})
+        return SyntheticResponse(404, b"not found: " + url.encode())
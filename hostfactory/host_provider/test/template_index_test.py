@@ -0,0 +1,80 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import template_index
+
+
+class TestTemplateIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, "conf"))
+        self.path = template_index.templates_path(self.tmpdir)
+        template_index._INDEXES.clear()
+
+    def tearDown(self):
+        template_index._INDEXES.clear()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _write(self, templates_json, mtime_ns=None):
+        with open(self.path, "w") as fw:
+            json.dump(templates_json, fw)
+        if mtime_ns:
+            os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def test_index(self):
+        self._write({"templates": [{"templateId": "execute", "vmTypes": {"Standard_F2s_v2": 1}},
+                                   {"templateId": "lp_execute", "vmTypes": {"Standard_D2_v3": 2}},
+                                   {"templateId": "execute", "vmTypes": {"Standard_F4s_v2": 2}}]})
+        index = template_index.load(self.path)
+        self.assertEqual({"Standard_F4s_v2": 2}, index.vm_types("execute"))
+        self.assertEqual({"Standard_D2_v3": 2}, index.vm_types("lp_execute"))
+        self.assertEqual({}, index.vm_types("missing"))
+        self.assertEqual(template_index.TEMPLATES_RESPONSE_MESSAGE, index.response["message"])
+        self.assertEqual(index.response, json.loads(index.serialized_response))
+        self.assertEqual(3, len(index.templates))
+
+        # cached until the file changes
+        self.assertIs(index, template_index.load(self.path))
+        self._write({"templates": [{"templateId": "execute", "vmTypes": {"Standard_F8s_v2": 4}}]}, mtime_ns=10 ** 9)
+        index = template_index.load(self.path)
+        self.assertEqual({"Standard_F8s_v2": 4}, index.vm_types("execute"))
+
+        self._write({"nottemplates": []}, mtime_ns=2 * 10 ** 9)
+        self.assertIsNone(template_index.load(self.path).templates)
+
+    def test_disk_cache(self):
+        self._write({"templates": [{"templateId": "execute", "vmTypes": {"Standard_F2s_v2": 1}}]})
+        template_index.load(self.path, cache_dir=self.tmpdir)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, template_index.CACHE_NAME)))
+
+        # a new process loads the cached index instead of parsing the file
+        template_index._INDEXES.clear()
+        with patch.object(template_index.TemplateIndex, "__init__", side_effect=AssertionError("parsed the template file")):
+            index = template_index.load(self.path, cache_dir=self.tmpdir)
+        self.assertEqual({"Standard_F2s_v2": 1}, index.vm_types("execute"))
+        self.assertEqual(template_index.TEMPLATES_RESPONSE_MESSAGE, index.response["message"])
+        self.assertEqual("execute", index.templates[0]["templateId"])
+
+        # an unreadable cache is ignored and rewritten
+        template_index._INDEXES.clear()
+        with open(os.path.join(self.tmpdir, template_index.CACHE_NAME), "w") as fw:
+            fw.write("not json")
+        self.assertEqual({"Standard_F2s_v2": 1}, template_index.load(self.path, cache_dir=self.tmpdir).vm_types("execute"))
+        with open(os.path.join(self.tmpdir, template_index.CACHE_NAME)) as fr:
+            self.assertEqual({"execute": {"Standard_F2s_v2": 1}}, json.load(fr)["vmTypes"])
+
+        template_index._INDEXES.clear()
+        self._write({"templates": []}, mtime_ns=10 ** 9)
+        self.assertEqual([], template_index.load(self.path, cache_dir=self.tmpdir).templates)
+
+    def test_missing_file(self):
+        self.assertRaises(FileNotFoundError, template_index.load, self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
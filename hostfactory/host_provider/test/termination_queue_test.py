@@ -0,0 +1,209 @@
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import cyclecloud_provider
+import util
+from termination_queue import TerminationQueue, DRAINER_KEY
+
+
+class MockClock:
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class InMemStore(dict):
+
+    def read(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class MockShutdownResult:
+
+    def __init__(self, failed):
+        self.failed = failed
+
+
+class MockShutdown:
+
+    def __init__(self):
+        self.calls = []
+        self.failing = {}
+
+    def __call__(self, machines):
+        self.calls.append([m["machineId"] for m in machines])
+        return MockShutdownResult({m["machineId"]: self.failing[m["machineId"]]
+                                   for m in machines if m["machineId"] in self.failing})
+
+
+def _machines(*machine_ids):
+    return [{"machineId": m, "name": "host-" + m} for m in machine_ids]
+
+
+class TestTerminationQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clock = MockClock(1000)
+        self.shutdown = MockShutdown()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _queue(self, **kwargs):
+        return TerminationQueue(InMemStore(), self.tmpdir, self.shutdown, clock=self.clock, sleep=self.clock.sleep,
+                                **kwargs)
+
+    def test_dedupe_and_batches(self):
+        queue = self._queue(batch_size=2)
+        self.assertEqual(3, queue.enqueue(_machines("a", "b", "c")))
+        self.assertEqual(1, queue.enqueue(_machines("b", "c", "d")))
+        self.assertEqual({"a": "queued", "d": "queued"}, queue.pending(["a", "d", "missing"]))
+
+        self.assertEqual(2, queue.drain())
+        self.assertEqual([["a", "b"], ["c", "d"]], self.shutdown.calls)
+        self.assertEqual({}, queue.pending(["a", "b", "c", "d"]))
+
+        # a done machine that is returned again, e.g. after it was restarted, is shut down again
+        self.assertEqual(1, queue.enqueue(_machines("a")))
+        self.assertEqual(0, queue.enqueue(_machines("a")))
+        self.assertEqual({"a": "queued"}, queue.pending(["a", "b"]))
+        self.assertEqual(1, queue.drain())
+        self.assertEqual(["a"], self.shutdown.calls[-1])
+        self.assertEqual({}, queue.pending(["a"]))
+
+        # but a retry of the request whose shutdown was accepted since is not
+        self.assertEqual(0, queue.enqueue(_machines("a", "b"), {"a": self.clock.now, "b": self.clock.now}))
+        self.assertEqual(1, queue.enqueue(_machines("b"), {"b": self.clock.now + 1}))
+        queue.drain()
+
+        # done machines are forgotten after done_ttl
+        self.clock.now += 3601
+        queue.enqueue(_machines("e"))
+        self.assertEqual(["e"], [k for k in queue.store.read() if k != "__drainer__"])
+
+    def test_failed_ids_retried_after_backoff(self):
+        queue = self._queue(retry_backoff=30)
+        self.shutdown.failing = {"b": "Busy"}
+        queue.enqueue(_machines("a", "b"))
+        self.assertEqual(1, queue.drain())
+        self.assertEqual({"b": "Busy"}, queue.pending(["a", "b"]))
+        self.assertEqual(1030, queue.store["b"]["nextAttempt"])
+        self.assertEqual(0, queue.drain())
+
+        self.shutdown.failing = {}
+        self.clock.now += 30
+        self.assertEqual(1, queue.drain())
+        self.assertEqual([["a", "b"], ["b"]], self.shutdown.calls)
+        self.assertEqual(2, queue.store["b"]["attempts"])
+        self.assertEqual({}, queue.pending(["b"]))
+
+    def test_exception_fails_the_batch(self):
+        def broken(machines):
+            raise ValueError("Service Unavailable")
+
+        queue = TerminationQueue(InMemStore(), self.tmpdir, broken, retry_backoff=0, clock=self.clock)
+        queue.enqueue(_machines("a", "b"))
+        # each id is tried once per drain, even without a backoff
+        self.assertEqual(1, queue.drain())
+        self.assertEqual({"a": "Service Unavailable", "b": "Service Unavailable"}, queue.pending(["a", "b"]))
+
+    def test_rate_limit(self):
+        queue = self._queue(batch_size=1, min_interval=10)
+        queue.enqueue(_machines("a", "b", "c"))
+        # inline, the drain stops instead of waiting
+        self.assertEqual(1, queue.drain())
+        self.assertEqual(1000, queue.store[DRAINER_KEY]["lastCall"])
+
+        self.clock.now += 10
+        self.assertEqual(2, queue.drain(wait=True))
+        self.assertEqual(1020, self.clock.now)
+        self.assertEqual([["a"], ["b"], ["c"]], self.shutdown.calls)
+
+
+class TestProviderTerminationQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_terminate_through_queue(self):
+        from synthetic_cluster import SyntheticCluster
+        provider_config = util.ProviderConfig({"symphony": {"hostfactory": {"db_path": self.tmpdir}}}, {})
+        cluster = SyntheticCluster(provider_config, node_count=4, data_dir=self.tmpdir, padding=False)
+        provider = cyclecloud_provider.CycleCloudProvider(provider_config, cluster, None,
+                                                          cyclecloud_provider.quiet_output(),
+                                                          terminate_requests=InMemStore(),
+                                                          creation_requests=InMemStore(),
+                                                          clock=lambda: (1970, 1, 1, 0, 0, 0))
+        provider.termination_queue = TerminationQueue(InMemStore(), self.tmpdir, cluster.shutdown_nodes)
+        node_ids = list(cluster.nodes)
+
+        response = provider.terminate_machines({"machines": _machines(*node_ids[:3])}, cyclecloud_provider.quiet_output())
+        self.assertEqual("complete", response["status"])
+        self.assertTrue(provider.terminate_json[response["requestId"]]["terminated"])
+        # a machine asked for again by a new request is shut down again, along with the new ones
+        provider.terminate_machines({"machines": _machines(*node_ids[2:])}, cyclecloud_provider.quiet_output())
+        self.assertEqual(2, cluster.rest_calls["POST /clusters/{cluster}/nodes/shutdown"])
+        self.assertTrue(all(node.state == "Terminating" for node in cluster.nodes.values()))
+
+        # in the background, the call only queues and reports the request as running until the drainer ran
+        provider.termination_drain = "background"
+        provider.launch_termination_drainer = lambda: None
+        cluster.add_node(cluster.new_node("execute", "Standard_F2s_v2", 1))
+        new_id = list(cluster.nodes)[-1]
+        response = provider.terminate_machines({"machines": _machines(new_id)}, cyclecloud_provider.quiet_output())
+        self.assertEqual("running", response["status"])
+        self.assertEqual(2, cluster.rest_calls["POST /clusters/{cluster}/nodes/shutdown"])
+        self.assertEqual(1, provider.drain_terminations({}))
+        self.assertEqual(3, cluster.rest_calls["POST /clusters/{cluster}/nodes/shutdown"])
+        status = provider._terminate_status({"requests": [{"requestId": response["requestId"]}]})
+        self.assertEqual("complete", status["requests"][0]["status"])
+
+
+    def test_drainer_does_not_start_a_drainer(self):
+        from synthetic_cluster import SyntheticCluster
+        provider_config = util.ProviderConfig({"symphony": {"hostfactory": {"db_path": self.tmpdir}}}, {})
+        cluster = SyntheticCluster(provider_config, node_count=1, data_dir=self.tmpdir, padding=False)
+        provider = cyclecloud_provider.CycleCloudProvider(provider_config, cluster, None,
+                                                          cyclecloud_provider.quiet_output(),
+                                                          terminate_requests=InMemStore(),
+                                                          creation_requests=InMemStore(),
+                                                          clock=lambda: (1970, 1, 1, 0, 0, 0))
+        shutdown = MockShutdown()
+        shutdown.failing = {"busy": "Busy"}
+        provider.termination_queue = TerminationQueue(InMemStore(), self.tmpdir, shutdown, retry_backoff=30)
+        provider.termination_drain = "background"
+        provider.launch_termination_drainer = MagicMock()
+
+        response = provider.terminate_machines({"machines": _machines("busy")}, cyclecloud_provider.quiet_output())
+        self.assertEqual("running", response["status"])
+        self.assertEqual(1, provider.launch_termination_drainer.call_count)
+
+        # the drainer leaves the id waiting out its backoff, and its cleanup must not start the next drainer
+        provider.drain_terminations({})
+        self.assertEqual({"busy": "Busy"}, provider.termination_queue.pending(["busy"]))
+        provider.periodic_cleanup()
+        self.assertEqual(1, provider.launch_termination_drainer.call_count)
+        self.assertEqual([["busy"]], shutdown.calls)
+        self.assertIn("drain_terminations", cyclecloud_provider.BACKGROUND_COMMANDS)
+
+
+if __name__ == "__main__":
+    unittest.main()
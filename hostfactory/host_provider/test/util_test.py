@@ -1,5 +1,21 @@
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
 
+import metrics
+import provider_config_bench
 import util
 
 
@@ -27,6 +43,231 @@ class UtilTest(unittest.TestCase):
         self.assertEqual({"x": {"y": {"z": "123"}}, "a": "b"}, pc.get(""))
         self.assertEqual({"x": {"y": {"z": "123"}}, "a": "b"}, pc.get(None))
         
+    def test_provider_config_index(self):
+        config, jetpack = provider_config_bench.sample_config()
+        config["symphony"]["flag"] = False
+        config["symphony"]["nothing"] = None
+        config["dotted.key"] = "unreachable"
+        pc = util.ProviderConfig(config, jetpack)
+
+        keys = provider_config_bench.KEYS + ["symphony", "symphony.flag", "symphony.flag.child", "symphony.nothing",
+                                             "symphony.nothing.child", "cyclecloud.config.web_server.x",
+                                             "dotted.key", "cyclecloud.cluster.id", "a..b", "templates"]
+        rand = random.Random(1234)
+        for _ in range(200):
+            path = [rand.choice(["cyclecloud", "symphony", "config", "cluster", "name", "node", "flag", "x"])
+                    for _ in range(rand.randint(1, 4))]
+            keys.append(".".join(path))
+
+        for key in keys:
+            self.assertEqual(provider_config_bench.legacy_get(pc, key, "default"), pc.get(key, "default"), key)
+            # the index is reused
+            self.assertEqual(provider_config_bench.legacy_get(pc, key), pc.get(key), key)
+
+        # set() invalidates the index
+        self.assertEqual("symphony", pc.get("cyclecloud.cluster.name"))
+        pc.set("cyclecloud.cluster.name", "other")
+        self.assertEqual("other", pc.get("cyclecloud.cluster.name"))
+        self.assertEqual("default", pc.get("symphony.missing.key", "default"))
+        pc.set("symphony.missing.key", 1)
+        self.assertEqual(1, pc.get("symphony.missing.key", "default"))
+        pc.set("symphony.flag", {"child": 2})
+        self.assertEqual(2, pc.get("symphony.flag.child"))
+        self.assertEqual({}, pc.get("symphony.flag.child.x"))
+
+    def test_jetpack_snapshot(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        node_json = os.path.join(tmpdir, "node.json")
+        snapshot_path = os.path.join(tmpdir, "jetpack_config.snapshot.json")
+
+        self.assertEqual({}, util.load_jetpack_config(node_json, snapshot_path))
+        with open(node_json, "w") as fw:
+            json.dump({"cyclecloud": {"node": {"name": "n1"}}}, fw)
+        self.assertEqual({"cyclecloud": {"node": {"name": "n1"}}}, util.load_jetpack_config(node_json, snapshot_path))
+        self.assertTrue(os.path.exists(snapshot_path))
+
+        # served from the snapshot, node.json is not read again
+        st = os.stat(node_json)
+        with open(node_json, "w") as fw:
+            fw.write("x" * st.st_size)
+        os.utime(node_json, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual({"cyclecloud": {"node": {"name": "n1"}}}, util.load_jetpack_config(node_json, snapshot_path))
+        with open(snapshot_path) as fr:
+            self.assertEqual([st.st_mtime_ns, st.st_size], json.load(fr)["signature"])
+
+        # a changed node.json is picked up
+        with open(node_json, "w") as fw:
+            json.dump({"cyclecloud": {"node": {"name": "node-2"}}}, fw)
+        os.utime(node_json, ns=(1, 1))
+        self.assertEqual({"cyclecloud": {"node": {"name": "node-2"}}}, util.load_jetpack_config(node_json, snapshot_path))
+
+    def test_hostnamer(self):
+        lookups = []
+
+        def gethostbyaddr(ip):
+            lookups.append(ip)
+            if ip == "10.0.0.9":
+                raise socket.herror(1, "Unknown host")
+            return ("ip-%s.internal" % ip.replace(".", "-"), ["ip-%s" % ip.replace(".", "-")], [ip])
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache_path = os.path.join(tmpdir, "hostnames_cache.json")
+            clock = [1000]
+            with patch("socket.gethostbyaddr", gethostbyaddr):
+                hostnamer = util.Hostnamer(cache_path=cache_path, positive_ttl=100, negative_ttl=10, clock=lambda: clock[0])
+                self.assertEqual("ip-10-0-0-1.internal", hostnamer.hostname("10.0.0.1"))
+                self.assertEqual("ip-10-0-0-1", util.Hostnamer(use_fqdn=False).hostname("10.0.0.1"))
+                self.assertRaises(RuntimeError, hostnamer.hostname, "10.0.0.9")
+
+                resolved = hostnamer.resolve_many(["10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.9", None])
+                self.assertEqual({"10.0.0.1": "ip-10-0-0-1.internal", "10.0.0.2": "ip-10-0-0-2.internal",
+                                  "10.0.0.3": "ip-10-0-0-3.internal", "10.0.0.9": None}, resolved)
+                # 10.0.0.1 and the failed 10.0.0.9 were cached
+                self.assertEqual(5, len(lookups))
+
+                # the cache is shared with the next process
+                lookups.clear()
+                hostnamer = util.Hostnamer(use_fqdn=False, cache_path=cache_path, positive_ttl=100, negative_ttl=10,
+                                           clock=lambda: clock[0])
+                self.assertEqual("ip-10-0-0-2", hostnamer.hostname("10.0.0.2"))
+                self.assertRaises(RuntimeError, hostnamer.hostname, "10.0.0.9")
+                self.assertEqual([], lookups)
+
+                # failures expire before successes
+                clock[0] += 11
+                self.assertRaises(RuntimeError, hostnamer.hostname, "10.0.0.9")
+                self.assertEqual("ip-10-0-0-2", hostnamer.hostname("10.0.0.2"))
+                self.assertEqual(["10.0.0.9"], lookups)
+
+                clock[0] += 100
+                hostnamer.hostname("10.0.0.2")
+                self.assertEqual(["10.0.0.9", "10.0.0.2"], lookups)
+
+                # an ip that Azure handed to a new node is resolved again, however fresh its entry is
+                lookups.clear()
+                self.assertEqual("ip-10-0-0-4", hostnamer.hostname("10.0.0.4", "node-a"))
+                self.assertEqual({"10.0.0.4": "ip-10-0-0-4"}, hostnamer.resolve_many(["10.0.0.4"], {"10.0.0.4": "node-a"}))
+                self.assertEqual(["10.0.0.4"], lookups)
+                self.assertEqual({"10.0.0.4": "ip-10-0-0-4"}, hostnamer.resolve_many(["10.0.0.4"], {"10.0.0.4": "node-b"}))
+                self.assertEqual(["10.0.0.4", "10.0.0.4"], lookups)
+                hostnamer.hostname("10.0.0.4", "node-a")
+                self.assertEqual(3, len(lookups))
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def test_hostnamer_concurrent_save(self):
+        def gethostbyaddr(ip):
+            return ("ip-%s" % ip.replace(".", "-"), [], [ip])
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        cache_path = os.path.join(tmpdir, "hostnames_cache.json")
+        ips = ["10.0.1.%d" % i for i in range(40)]
+        dumps = json.dumps
+
+        def slow_dump(obj, fw):
+            # slow enough for the writes of other threads to overlap
+            data = dumps(obj)
+            fw.write(data[:len(data) // 2])
+            fw.flush()
+            time.sleep(0.01)
+            fw.write(data[len(data) // 2:])
+
+        with patch("socket.gethostbyaddr", gethostbyaddr), patch("json.dump", slow_dump), \
+                patch.object(logging.getLogger("cyclecloud"), "exception") as logged:
+            hostnamer = util.Hostnamer(cache_path=cache_path)
+            # status calls resolve and save from several threads at once
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(hostnamer.hostname, ips))
+        # no write of the cache failed, e.g. because another thread had already moved the tmp file
+        self.assertFalse(logged.called)
+        with open(cache_path) as fr:
+            self.assertEqual(sorted(ips), sorted(json.load(fr)))
+        self.assertEqual(["hostnames_cache.json"], os.listdir(tmpdir))
+
+    def _hold_lock(self, lock_path, seconds):
+        # fcntl locks are per process, so hold it from another one
+        holder = subprocess.Popen([sys.executable, "-c",
+                                   "import fcntl, sys, time\n"
+                                   "fp = open(sys.argv[1], 'a')\n"
+                                   "fcntl.lockf(fp, fcntl.LOCK_EX)\n"
+                                   "print('locked', flush=True)\n"
+                                   "time.sleep(float(sys.argv[2]))\n",
+                                   lock_path, str(seconds)], stdout=subprocess.PIPE)
+
+        def _cleanup():
+            holder.wait()
+            holder.stdout.close()
+        self.addCleanup(_cleanup)
+        self.assertEqual(b"locked\n", holder.stdout.readline())
+
+    def test_file_lease(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        self.addCleanup(metrics.METRICS.reset)
+        lock_path = os.path.join(tmpdir, "allocation_execute.lock")
+
+        self._hold_lock(lock_path, 0.5)
+        self.assertRaises(util.LockTimeout, util.FileLease(lock_path, timeout=0.1).__enter__)
+
+        metrics.METRICS.reset()
+        with util.allocation_lease(tmpdir, "execute", timeout=10):
+            pass
+        wait = metrics.METRICS.histograms["allocation_lease.lock_wait"]
+        self.assertEqual(1, wait.count)
+        # woke up soon after the holder released it, well before the timeout
+        self.assertLess(wait.sum, 5)
+        self.assertEqual(1, metrics.METRICS.histograms["allocation_lease.lock_hold"].count)
+        self.assertEqual(1, metrics.METRICS.counters["allocation_lease.lock_contended"])
+
+    def test_json_store_lock(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        self.addCleanup(metrics.METRICS.reset)
+        metrics.METRICS.reset()
+
+        store = util.JsonStore("create_requests.json", tmpdir, lock_timeout=0.2)
+        with store as data:
+            data["a"] = 1
+        self.assertEqual({"a": 1}, store.read())
+
+        self._hold_lock(store.lockpath, 1)
+        # blocking acquisition in the main thread gives up at the deadline
+        started = time.time()
+        self.assertRaises(RuntimeError, store.__enter__)
+        self.assertLess(time.time() - started, 0.9)
+        self.assertEqual(1, metrics.METRICS.counters["store.create_requests.json.lock_timeouts"])
+
+        # other threads poll, and get the lock soon after it is released
+        results = []
+        store.lock_timeout = 10
+        thread = threading.Thread(target=lambda: results.append(store.read()))
+        thread.start()
+        thread.join(10)
+        self.assertEqual([{"a": 1}], results)
+        self.assertLess(metrics.METRICS.histograms["store.create_requests.json.lock_wait"].max, 5)
+        self.assertEqual(2, metrics.METRICS.counters["store.create_requests.json.lock_contended"])
+
+    def test_lock_keeps_outer_timer(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        lock_path = os.path.join(tmpdir, "outer.lock")
+        fired = []
+        previous_handler = signal.signal(signal.SIGALRM, lambda signum, frame: fired.append(signum))
+        self.addCleanup(signal.signal, signal.SIGALRM, previous_handler)
+        self.addCleanup(signal.setitimer, signal.ITIMER_REAL, 0)
+
+        self._hold_lock(lock_path, 1)
+        signal.setitimer(signal.ITIMER_REAL, 30)
+        with open(lock_path, "a") as fp:
+            self.assertRaises(util.LockTimeout, util.lock_file, fp, lock_path, 0.1)
+        # the caller's timer is still armed, with its own handler
+        self.assertGreater(signal.getitimer(signal.ITIMER_REAL)[0], 25)
+        signal.setitimer(signal.ITIMER_REAL, 0.01)
+        time.sleep(0.2)
+        self.assertEqual([signal.SIGALRM], fired)
 
 if __name__ == "__main__":
     unittest.main()